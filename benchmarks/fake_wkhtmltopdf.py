@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Deterministic stand-in for wkhtmltopdf binary used by benchmarks.
+
+It accepts wkhtmltopdf command line, reads input from stdin when it is '-',
+waits for a configured delay and writes a valid PDF to the output path or
+stdout. Every page shows its number and the last input of the command. With
+``--dump-outline`` an outline with an item per page is written. Behaviour is
+configured with environment variables:
+
+* ``FAKE_WKHTMLTOPDF_DELAY`` - seconds to sleep before writing output (0)
+* ``FAKE_WKHTMLTOPDF_SIZE`` - approximate size of PDF in bytes (2048)
+* ``FAKE_WKHTMLTOPDF_PAGES`` - number of pages (1)
+* ``FAKE_WKHTMLTOPDF_EXIT_CODE`` - exit code, non-zero also prints an error (0)
+
+Use it with ``pdfkit.configuration(wkhtmltopdf='benchmarks/fake_wkhtmltopdf.py')``.
+"""
+import os
+import sys
+import time
+from html import escape
+
+VERSION = 'wkhtmltopdf 0.12.6 (with patched qt)'
+
+
+def make_pdf(pages=1, size=2048, label=''):
+    """
+    Builds a minimal valid PDF with given number of pages, padded with content
+    stream comments to approximately ``size`` bytes. Pages show their number
+    followed by ``label``.
+    """
+    pages = max(pages, 1)
+    page_ids = [4 + 2 * i for i in range(pages)]
+    objects = {
+        1: b'<< /Type /Catalog /Pages 2 0 R >>',
+        2: ('<< /Type /Pages /Kids [%s] /Count %d >>' % (
+            ' '.join('%d 0 R' % i for i in page_ids), pages)).encode('ascii'),
+        3: b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+    }
+
+    # Estimated size of everything except padding
+    overhead = 400 + 250 * pages
+    padding = max(size - overhead, 0) // pages
+
+    for number, page_id in enumerate(page_ids, 1):
+        title = ('Page %d %s' % (number, label)).strip()
+        title = title.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+        text = ('BT /F1 24 Tf 72 720 Td (%s) Tj ET\n' % title).encode('latin-1', 'replace')
+        filler = b''
+        if padding:
+            line = b'% ' + b'pdfkit benchmark padding ' * 3 + b'\n'
+            filler = (line * (padding // len(line) + 1))[:padding - 1] + b'\n'
+        content = text + filler
+        objects[page_id] = (
+            '<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] '
+            '/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>' % (page_id + 1)
+        ).encode('ascii')
+        objects[page_id + 1] = (b'<< /Length %d >>\nstream\n' % len(content)
+                                + content + b'\nendstream')
+
+    out = [b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n']
+    offsets = {}
+    position = len(out[0])
+    for number in sorted(objects):
+        offsets[number] = position
+        data = b'%d 0 obj\n' % number + objects[number] + b'\nendobj\n'
+        out.append(data)
+        position += len(data)
+
+    count = max(objects) + 1
+    xref = [b'xref\n0 %d\n' % count, b'0000000000 65535 f \n']
+    for number in range(1, count):
+        xref.append(b'%010d 00000 n \n' % offsets[number])
+    out.extend(xref)
+    out.append(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (count, position))
+    return b''.join(out)
+
+
+def main(args):
+    if '--version' in args or '-V' in args:
+        sys.stdout.write(VERSION + '\n')
+        return 0
+    if '--extended-help' in args or '-H' in args:
+        # No option table, so options are not validated against the fake
+        return 0
+
+    if len(args) < 2:
+        sys.stderr.write('You need to specify at least one input file, and exactly one output file\n')
+        return 1
+
+    output = args[-1]
+    if '-' in args[:-1]:
+        # Consume input like wkhtmltopdf does, so writer doesn't get a broken pipe
+        stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+        while stdin.read(64 * 1024):
+            pass
+
+    time.sleep(float(os.environ.get('FAKE_WKHTMLTOPDF_DELAY', 0)))
+
+    exit_code = int(os.environ.get('FAKE_WKHTMLTOPDF_EXIT_CODE', 0))
+    if exit_code:
+        sys.stderr.write('Error: fake wkhtmltopdf failure\n')
+        return exit_code
+
+    pages = int(os.environ.get('FAKE_WKHTMLTOPDF_PAGES', 1))
+    pdf = make_pdf(pages, int(os.environ.get('FAKE_WKHTMLTOPDF_SIZE', 2048)), args[-2])
+
+    if '--dump-outline' in args:
+        offset = int(args[args.index('--page-offset') + 1]) if '--page-offset' in args else 0
+        with open(args[args.index('--dump-outline') + 1], 'w') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    '<outline xmlns="http://wkhtmltopdf.org/outline">\n'
+                    ' <item title="" page="0" link="" backLink="">\n')
+            for number in range(1, pages + 1):
+                f.write('  <item title="%s page %d" page="%d" link="" backLink=""/>\n'
+                        % (escape(args[-2], True), number, number + offset))
+            f.write(' </item>\n</outline>\n')
+
+    if output == '-':
+        stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+        stdout.write(pdf)
+        stdout.flush()
+    else:
+        with open(output, 'wb') as f:
+            f.write(pdf)
+
+    if '--quiet' not in args and '-q' not in args:
+        sys.stderr.write('Loading pages (1/6)\nPrinting pages (6/6)\nDone\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
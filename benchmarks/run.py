@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of pdfkit's own overhead and throughput.
+
+By default wkhtmltopdf is replaced with ``fake_wkhtmltopdf.py`` from this
+directory, so results measure pdfkit and process handling only. Results are
+printed as JSON, use ``--output`` to write them to a file and compare runs
+between releases.
+
+Usage::
+
+    python benchmarks/run.py [--quick] [--real] [--output results.json] [--only NAME ...]
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+BENCHMARKS_ROOT = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.realpath(os.path.join(BENCHMARKS_ROOT, '..')))
+
+import pdfkit
+from pdfkit.configuration import Configuration
+
+FAKE_WKHTMLTOPDF = os.path.join(BENCHMARKS_ROOT, 'fake_wkhtmltopdf.py')
+CSS = os.path.join(BENCHMARKS_ROOT, '..', 'tests', 'fixtures', 'example.css')
+
+
+def measure(func, repeat, number=1):
+    """
+    Calls ``func`` ``number`` times per round for ``repeat`` rounds and returns
+    timings of a single call in seconds
+    """
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - started) / number)
+    return {
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'max': max(timings),
+        'repeat': repeat,
+        'number': number,
+    }
+
+
+def html_document(size):
+    """HTML document of approximately ``size`` bytes with meta tags in head"""
+    head = ('<html><head><meta name="pdfkit-page-size" content="Legal"/>'
+            '<meta name="pdfkit-orientation" content="Landscape"/></head><body>')
+    row = '<tr><td>pdfkit</td><td>benchmark</td><td>row</td></tr>\n'
+    rows = max(size - len(head), 0) // len(row)
+    return head + '<table>' + row * rows + '</table></body></html>'
+
+
+def bench_configuration(config, args):
+    results = {
+        'explicit_path': measure(lambda: Configuration(wkhtmltopdf=config.wkhtmltopdf),
+                                 args.repeat, 100),
+        'cached': measure(lambda: pdfkit.cached_configuration(wkhtmltopdf=config.wkhtmltopdf),
+                          args.repeat, 1000),
+    }
+    try:
+        Configuration()
+    except IOError:
+        pass
+    else:
+        results['lookup_in_path'] = measure(Configuration, args.repeat, 10)
+    return results
+
+
+def bench_command(config, args):
+    options = {'page-size': 'Letter', 'margin-top': '0.75in', 'margin-bottom': '0.75in',
+               'encoding': 'UTF-8', 'custom-header': [('Accept-Encoding', 'gzip')]}
+    template = pdfkit.RenderTemplate(options=options, configuration=config)
+    return {
+        'pdfkit_command': measure(
+            lambda: pdfkit.PDFKit('html', 'string', options=options, configuration=config).command(),
+            args.repeat, 1000),
+        'template_command': measure(lambda: template.command('html'), args.repeat, 1000),
+    }
+
+
+def bench_meta_tags(config, args):
+    results = {}
+    r = pdfkit.PDFKit('', 'string', configuration=config)
+    for size in args.sizes:
+        document = html_document(size)
+        results[str(size)] = measure(lambda: r._find_options_in_meta(document), args.repeat, 10)
+    return results
+
+
+def bench_css(config, args):
+    results = {}
+    for size in args.sizes:
+        document = html_document(size)
+
+        def prepend():
+            r = pdfkit.PDFKit(document, 'string', css=CSS, configuration=config)
+            r._prepend_css(CSS)
+            for chunk in r._stdin_chunks():
+                pass
+
+        results[str(size)] = measure(prepend, args.repeat, 10)
+    return results
+
+
+def bench_render(config, args):
+    results = {}
+    for size in args.sizes:
+        document = html_document(size)
+        results[str(size)] = measure(
+            lambda: pdfkit.from_string(document, configuration=config), args.repeat, 5)
+    return results
+
+
+def bench_throughput(config, args):
+    results = {}
+    jobs = args.jobs
+    for workers in args.concurrency:
+        started = time.perf_counter()
+        for _, result in pdfkit.render_many(({'source': 'html', 'configuration': config}
+                                             for _ in range(jobs)), max_workers=workers):
+            if isinstance(result, Exception):
+                raise result
+        elapsed = time.perf_counter() - started
+        results[str(workers)] = {'jobs': jobs, 'seconds': elapsed, 'per_second': jobs / elapsed}
+    return results
+
+
+def bench_real(args):
+    """Profile of real wkhtmltopdf with render hooks, if it is installed"""
+    try:
+        config = Configuration()
+    except IOError:
+        return {'skipped': 'wkhtmltopdf not found'}
+
+    records = []
+    pdfkit.add_render_hook(records.append)
+    try:
+        for size in args.sizes:
+            pdfkit.from_string(html_document(size), configuration=config)
+    finally:
+        pdfkit.remove_render_hook(records.append)
+
+    return dict((str(size), dict((key, value) for key, value in stats.as_dict().items()
+                                 if key not in ('argv', 'error')))
+                for size, stats in zip(args.sizes, records))
+
+
+BENCHMARKS = [
+    ('configuration', bench_configuration),
+    ('command', bench_command),
+    ('meta_tags', bench_meta_tags),
+    ('css', bench_css),
+    ('render', bench_render),
+    ('throughput', bench_throughput),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--quick', action='store_true', help='fewer rounds and smaller inputs')
+    parser.add_argument('--real', action='store_true', help='also profile real wkhtmltopdf')
+    parser.add_argument('--output', help='write JSON results to this file')
+    parser.add_argument('--only', nargs='+', choices=[name for name, _ in BENCHMARKS],
+                        help='run only given benchmarks')
+    parser.add_argument('--delay', type=float, default=0.05,
+                        help='render delay of fake wkhtmltopdf for throughput benchmark')
+    args = parser.parse_args()
+
+    args.repeat = 3 if args.quick else 7
+    args.sizes = [10 * 1024, 1024 * 1024] if args.quick else [10 * 1024, 1024 * 1024, 10 * 1024 * 1024]
+    args.concurrency = [1, 4] if args.quick else [1, 2, 4, 8, 16]
+    args.jobs = 16 if args.quick else 64
+
+    results = {
+        'pdfkit': pdfkit.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'timestamp': time.time(),
+        'benchmarks': {},
+    }
+
+    for name, bench in BENCHMARKS:
+        if args.only and name not in args.only:
+            continue
+        os.environ['FAKE_WKHTMLTOPDF_DELAY'] = str(args.delay if name == 'throughput' else 0)
+        # Configuration copies the environment, so it is made after the delay is set
+        config = Configuration(wkhtmltopdf=FAKE_WKHTMLTOPDF)
+        sys.stderr.write('Running %s\n' % name)
+        results['benchmarks'][name] = bench(config, args)
+
+    if args.real:
+        sys.stderr.write('Running real\n')
+        results['benchmarks']['real'] = bench_real(args)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        sys.stdout.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -8,4 +8,22 @@ __version__ = '2.0.0'
 __license__ = 'MIT'
 
 from .pdfkit import PDFKit
+from .image import ImageKit
+from .cache import RenderCache
+from .prefetch import AssetCache
+from .configuration import cached_configuration, clear_configuration_cache
 from .api import from_url, from_file, from_string, configuration
+from .api import from_url_async, from_file_async, from_string_async
+from .api import from_url_image, from_file_image, from_string_image
+from .batch import render_many
+from .css import preload_css, clear_css_cache
+from .template import RenderTemplate
+from .sections import SectionedDocument
+from .optimizer import optimize_pdf, optimize_file
+from .scheduler import RenderScheduler, AIMDController, QueueFull
+from .xvfb import XvfbPool
+from .instrumentation import add_render_hook, remove_render_hook, RenderStats
+from .backends import Backend, SubprocessBackend, LoopbackBackend, register_backend
+
+RenderTimeout = PDFKit.RenderTimeout
+InvalidOption = PDFKit.InvalidOption
@@ -2,38 +2,48 @@
 
 from .pdfkit import PDFKit
 from .pdfkit import Configuration
+from .image import ImageKit
 
 
 def from_url(url, output_path=None, options=None, toc=None, cover=None,
-             configuration=None, cover_first=False, verbose=False):
+             configuration=None, cover_first=False, verbose=False, timeout=None,
+             parallel=None, priority=None, optimize=None):
     """
     Convert file of files from URLs to PDF document
 
     :param url: URL or list of URLs to be saved
-    :param output_path: (optional) path to output PDF file. By default, PDF will be returned for assigning to a variable.
+    :param output_path: (optional) path to output PDF file or an open file, socket or file descriptor to write PDF to. By default, PDF will be returned for assigning to a variable.
     :param options: (optional) dict with wkhtmltopdf global and page options, with or w/o '--'
     :param toc: (optional) dict with toc-specific wkhtmltopdf options, with or w/o '--'
     :param cover: (optional) string with url/filename with a cover html page
     :param configuration: (optional) instance of pdfkit.configuration.Configuration()
     :param cover_first: (optional) if True, cover always precedes TOC
     :param verbose: (optional) By default '--quiet' is passed to all calls, set this to False to get wkhtmltopdf output to stdout.
+    :param timeout: (optional) seconds to wait for wkhtmltopdf before killing it and raising PDFKit.RenderTimeout
+    :param parallel: (optional) number of wkhtmltopdf processes rendering chunks of a list of inputs
+                     concurrently, or True for one per CPU. Parts are merged into one PDF
+    :param priority: (optional) priority class of the render in ``scheduler`` of configuration
+    :param optimize: (optional) 'fast', 'size' or True for 'fast', optimize size of PDF after rendering,
+                     see pdfkit.optimizer.optimize_pdf()
 
     Returns: True on success
     """
 
     r = PDFKit(url, 'url', options=options, toc=toc, cover=cover,
-               configuration=configuration, cover_first=cover_first, verbose=verbose)
+               configuration=configuration, cover_first=cover_first, verbose=verbose,
+               parallel=parallel, priority=priority, optimize=optimize)
 
-    return r.to_pdf(output_path)
+    return r.to_pdf(output_path, timeout=timeout)
 
 
 def from_file(input, output_path=None, options=None, toc=None, cover=None, css=None,
-              configuration=None, cover_first=False, verbose=False):
+              configuration=None, cover_first=False, verbose=False, cache=None,
+              timeout=None, parallel=None, prefetch=None, priority=None, optimize=None):
     """
     Convert HTML file or files to PDF document
 
     :param input: path to HTML file or list with paths or file-like object
-    :param output_path: (optional) path to output PDF file. By default, PDF will be returned for assigning to a variable.
+    :param output_path: (optional) path to output PDF file or an open file, socket or file descriptor to write PDF to. By default, PDF will be returned for assigning to a variable.
     :param options: (optional) dict with wkhtmltopdf options, with or w/o '--'
     :param toc: (optional) dict with toc-specific wkhtmltopdf options, with or w/o '--'
     :param cover: (optional) string with url/filename with a cover html page
@@ -41,23 +51,35 @@ def from_file(input, output_path=None, options=None, toc=None, cover=None, css=N
     :param configuration: (optional) instance of pdfkit.configuration.Configuration()
     :param cover_first: (optional) if True, cover always precedes TOC
     :param verbose: (optional) By default '--quiet' is passed to all calls, set this to False to get wkhtmltopdf output to stdout.
+    :param timeout: (optional) seconds to wait for wkhtmltopdf before killing it and raising PDFKit.RenderTimeout
+    :param cache: (optional) instance of pdfkit.cache.RenderCache() to reuse identical renders
+    :param parallel: (optional) number of wkhtmltopdf processes rendering chunks of a list of inputs
+                     concurrently, or True for one per CPU. Parts are merged into one PDF
+    :param prefetch: (optional) instance of pdfkit.prefetch.AssetCache() to fetch subresources of a single file
+                     into a local cache before rendering
+    :param priority: (optional) priority class of the render in ``scheduler`` of configuration
+    :param optimize: (optional) 'fast', 'size' or True for 'fast', optimize size of PDF after rendering,
+                     see pdfkit.optimizer.optimize_pdf()
 
     Returns: True on success
     """
 
     r = PDFKit(input, 'file', options=options, toc=toc, cover=cover, css=css,
-               configuration=configuration, cover_first=cover_first, verbose=verbose)
+               configuration=configuration, cover_first=cover_first, verbose=verbose, cache=cache,
+               parallel=parallel, prefetch=prefetch, priority=priority, optimize=optimize)
 
-    return r.to_pdf(output_path)
+    return r.to_pdf(output_path, timeout=timeout)
 
 
 def from_string(input, output_path=None, options=None, toc=None, cover=None, css=None,
-                configuration=None, cover_first=False, verbose=False):
+                configuration=None, cover_first=False, verbose=False, cache=None,
+                timeout=None, prefetch=None, priority=None, optimize=None):
     """
     Convert given string or strings to PDF document
 
-    :param input: string with a desired text. Could be a raw text or a html file
-    :param output_path: (optional) path to output PDF file. By default, PDF will be returned for assigning to a variable.
+    :param input: string with a desired text. Could be a raw text or a html file. Also could be bytes,
+                  memoryview, file-like object or iterable of str/bytes chunks
+    :param output_path: (optional) path to output PDF file or an open file, socket or file descriptor to write PDF to. By default, PDF will be returned for assigning to a variable.
     :param options: (optional) dict with wkhtmltopdf options, with or w/o '--'
     :param toc: (optional) dict with toc-specific wkhtmltopdf options, with or w/o '--'
     :param cover: (optional) string with url/filename with a cover html page
@@ -65,14 +87,134 @@ def from_string(input, output_path=None, options=None, toc=None, cover=None, css
     :param configuration: (optional) instance of pdfkit.configuration.Configuration()
     :param cover_first: (optional) if True, cover always precedes TOC
     :param verbose: (optional) By default '--quiet' is passed to all calls, set this to False to get wkhtmltopdf output to stdout.
+    :param timeout: (optional) seconds to wait for wkhtmltopdf before killing it and raising PDFKit.RenderTimeout
+    :param cache: (optional) instance of pdfkit.cache.RenderCache() to reuse identical renders
+    :param prefetch: (optional) instance of pdfkit.prefetch.AssetCache() to fetch subresources into a local cache
+                     before rendering
+    :param priority: (optional) priority class of the render in ``scheduler`` of configuration
+    :param optimize: (optional) 'fast', 'size' or True for 'fast', optimize size of PDF after rendering,
+                     see pdfkit.optimizer.optimize_pdf()
 
     Returns: True on success
     """
 
     r = PDFKit(input, 'string', options=options, toc=toc, cover=cover, css=css,
-               configuration=configuration, cover_first=cover_first, verbose=verbose)
+               configuration=configuration, cover_first=cover_first, verbose=verbose, cache=cache,
+               prefetch=prefetch, priority=priority, optimize=optimize)
 
-    return r.to_pdf(output_path)
+    return r.to_pdf(output_path, timeout=timeout)
+
+
+async def from_url_async(url, output_path=None, options=None, toc=None, cover=None,
+                         configuration=None, cover_first=False, verbose=False, timeout=None,
+                         parallel=None, priority=None, optimize=None):
+    """
+    Coroutine version of :func:`from_url`, doesn't block the running event loop
+    while wkhtmltopdf works. Takes the same arguments.
+
+    Returns: PDF as bytes or True on success if output_path is given
+    """
+
+    r = PDFKit(url, 'url', options=options, toc=toc, cover=cover,
+               configuration=configuration, cover_first=cover_first, verbose=verbose,
+               parallel=parallel, priority=priority, optimize=optimize)
+
+    return await r.to_pdf_async(output_path, timeout=timeout)
+
+
+async def from_file_async(input, output_path=None, options=None, toc=None, cover=None, css=None,
+                          configuration=None, cover_first=False, verbose=False, cache=None,
+                          timeout=None, parallel=None, prefetch=None, priority=None,
+                          optimize=None):
+    """
+    Coroutine version of :func:`from_file`, doesn't block the running event loop
+    while wkhtmltopdf works. Takes the same arguments.
+
+    Returns: PDF as bytes or True on success if output_path is given
+    """
+
+    r = PDFKit(input, 'file', options=options, toc=toc, cover=cover, css=css,
+               configuration=configuration, cover_first=cover_first, verbose=verbose, cache=cache,
+               parallel=parallel, prefetch=prefetch, priority=priority, optimize=optimize)
+
+    return await r.to_pdf_async(output_path, timeout=timeout)
+
+
+async def from_string_async(input, output_path=None, options=None, toc=None, cover=None, css=None,
+                            configuration=None, cover_first=False, verbose=False, cache=None,
+                            timeout=None, prefetch=None, priority=None, optimize=None):
+    """
+    Coroutine version of :func:`from_string`, doesn't block the running event loop
+    while wkhtmltopdf works. Takes the same arguments.
+
+    Returns: PDF as bytes or True on success if output_path is given
+    """
+
+    r = PDFKit(input, 'string', options=options, toc=toc, cover=cover, css=css,
+               configuration=configuration, cover_first=cover_first, verbose=verbose, cache=cache,
+               prefetch=prefetch, priority=priority, optimize=optimize)
+
+    return await r.to_pdf_async(output_path, timeout=timeout)
+
+
+def from_url_image(url, output_path=None, options=None, format='png', width=None, quality=None,
+                   crop=None, configuration=None, verbose=False, timeout=None, priority=None):
+    """
+    Render image of a page from URL with wkhtmltoimage
+
+    :param url: URL to be saved
+    :param output_path: (optional) path to output image file or an open file, socket or file descriptor to write image to. By default, image will be returned for assigning to a variable.
+    :param options: (optional) dict with wkhtmltoimage options, with or w/o '--'
+    :param format: (optional) image format: 'png', 'jpg', 'bmp' or 'svg'
+    :param width: (optional) width of the viewport and image in pixels
+    :param quality: (optional) compression quality, 0-100
+    :param crop: (optional) 4-tuple (x, y, width, height) of the rendered area to keep, in pixels
+    :param configuration: (optional) instance of pdfkit.configuration.Configuration()
+    :param verbose: (optional) By default '--quiet' is passed to all calls, set this to False to get wkhtmltoimage output to stdout.
+    :param timeout: (optional) seconds to wait for wkhtmltoimage before killing it and raising PDFKit.RenderTimeout
+    :param priority: (optional) priority class of the render in ``scheduler`` of configuration
+
+    Returns: image as bytes or True on success if output_path is given
+    """
+
+    r = ImageKit(url, 'url', options=options, format=format, width=width, quality=quality,
+                 crop=crop, configuration=configuration, verbose=verbose, priority=priority)
+
+    return r.to_image(output_path, timeout=timeout)
+
+
+def from_file_image(input, output_path=None, options=None, format='png', width=None, quality=None,
+                    crop=None, css=None, configuration=None, verbose=False, cache=None,
+                    timeout=None, prefetch=None, priority=None):
+    """
+    Render image of HTML file with wkhtmltoimage. Takes the same arguments as
+    :func:`from_url_image` and :func:`from_file`.
+
+    Returns: image as bytes or True on success if output_path is given
+    """
+
+    r = ImageKit(input, 'file', options=options, format=format, width=width, quality=quality,
+                 crop=crop, css=css, configuration=configuration, verbose=verbose, cache=cache,
+                 prefetch=prefetch, priority=priority)
+
+    return r.to_image(output_path, timeout=timeout)
+
+
+def from_string_image(input, output_path=None, options=None, format='png', width=None, quality=None,
+                      crop=None, css=None, configuration=None, verbose=False, cache=None,
+                      timeout=None, prefetch=None, priority=None):
+    """
+    Render image of given string with wkhtmltoimage. Takes the same arguments as
+    :func:`from_url_image` and :func:`from_string`.
+
+    Returns: image as bytes or True on success if output_path is given
+    """
+
+    r = ImageKit(input, 'string', options=options, format=format, width=width, quality=quality,
+                 crop=crop, css=css, configuration=configuration, verbose=verbose, cache=cache,
+                 prefetch=prefetch, priority=priority)
+
+    return r.to_image(output_path, timeout=timeout)
 
 
 def configuration(**kwargs):
@@ -81,6 +223,14 @@ def configuration(**kwargs):
 
     :param wkhtmltopdf: path to binary
     :param meta_tag_prefix: the prefix for ``pdfkit`` specific meta tags
+    :param meta_tags: set to False to skip looking for options in meta tags
+    :param timeout: default number of seconds to wait for wkhtmltopdf
+    :param backend: name or instance of rendering backend
+    :param check_eof: set to True to reject PDF output without '%%EOF' trailer
+    :param validate_options: set to False to skip checking options against wkhtmltopdf help
+    :param scheduler: instance of pdfkit.scheduler.RenderScheduler() limiting concurrent wkhtmltopdf processes
+    :param xvfb: True or instance of pdfkit.xvfb.XvfbPool() to run wkhtmltopdf on pooled Xvfb displays
+    :param wkhtmltoimage: path to wkhtmltoimage binary, looked up next to wkhtmltopdf by default
     """
 
     return Configuration(**kwargs)
@@ -0,0 +1,486 @@
+# -*- coding: utf-8 -*-
+"""
+Engines which execute wkhtmltopdf commands built by :class:`PDFKit`.
+
+A backend gets the full command (binary, options, inputs and output) and
+bytes to pipe to stdin, and returns stdout, stderr and exit code. Backends are
+selected with ``backend`` configuration option, either by instance or by name
+registered with :func:`register_backend`.
+"""
+import abc
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from . import instrumentation
+from .capabilities import PROBE_FLAGS
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+class ExecutionTimeout(Exception):
+    """Command didn't finish in time and was aborted"""
+
+    def __init__(self, stderr):
+        self.stderr = stderr
+        super(ExecutionTimeout, self).__init__('Command timed out')
+
+
+class Execution(abc.ABC):
+    """
+    Running command returned by :meth:`Backend.start`.
+
+    Iterating it yields chunks of stdout. Once iteration is over ``exit_code``,
+    ``stderr`` and ``timed_out`` are set. :meth:`close` aborts the command.
+    """
+
+    exit_code = None
+    stderr = b''
+    timed_out = False
+
+    @abc.abstractmethod
+    def __iter__(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class Backend(abc.ABC):
+    """
+    Base class of execution engines.
+
+    Subclasses implement :meth:`start`, other methods are built on it and may be
+    overridden with more efficient versions.
+    """
+
+    #: Whether wkhtmltopdf binary has to be found by :class:`Configuration`
+    requires_binary = True
+
+    @abc.abstractmethod
+    def start(self, argv, stdin=None, env=None, timeout=None, chunk_size=64 * 1024, stats=None,
+              stdout=None):
+        """
+        Starts a command and returns :class:`Execution` streaming its stdout.
+
+        :param argv: list with command
+        :param stdin: iterable of bytes chunks to pipe to stdin or None
+        :param env: environment mapping
+        :param timeout: seconds after which the command is aborted
+        :param chunk_size: max size of stdout chunks
+        :param stats: :class:`pdfkit.instrumentation.RenderStats` to fill with
+                      spawn and stdin timings and resource usage, or None
+        :param stdout: file descriptor to write stdout to instead of yielding it
+        """
+
+    def execute(self, argv, stdin=None, env=None, timeout=None, stats=None, stdout=None):
+        """
+        Runs a command to completion.
+
+        Returns: tuple (stdout, stderr, exit_code), stdout is empty if it was
+                 written to ``stdout`` file descriptor
+        Raises: :class:`ExecutionTimeout` on timeout
+        """
+        execution = self.start(argv, stdin, env=env, timeout=timeout, stats=stats, stdout=stdout)
+        output = b''.join(execution)
+        if execution.timed_out:
+            raise ExecutionTimeout(execution.stderr)
+        return output, execution.stderr, execution.exit_code
+
+    async def execute_async(self, argv, stdin=None, env=None, timeout=None, stats=None,
+                            stdout=None):
+        """
+        Coroutine version of :meth:`execute`, by default runs it in the default
+        executor of the running loop.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, lambda: self.execute(argv, stdin, env=env, timeout=timeout, stats=stats,
+                                       stdout=stdout))
+
+
+def _write_stdin(stream, chunks, stats=None):
+    """Writes chunks of data to a child's stdin and closes it"""
+    started = time.monotonic()
+    try:
+        if chunks is not None:
+            for chunk in chunks:
+                stream.write(chunk)
+                if stats is not None:
+                    stats.input_bytes += len(chunk)
+    except (BrokenPipeError, OSError):
+        # wkhtmltopdf exited early, its error is reported through stderr
+        pass
+    finally:
+        try:
+            stream.close()
+        except (BrokenPipeError, OSError):
+            pass
+        if stats is not None:
+            stats.stdin_time = time.monotonic() - started
+
+
+def _read_stream(stream, chunks):
+    """Reads a child's output stream into a list of chunks until EOF"""
+    for chunk in iter(lambda: stream.read(64 * 1024), b''):
+        chunks.append(chunk)
+    stream.close()
+
+
+def write_fd(fd, data):
+    """Writes all data to a file descriptor"""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def kill(process):
+    """Kills a child process started by :class:`SubprocessBackend` with its whole process group"""
+    try:
+        if sys.platform == 'win32':
+            process.kill()
+        else:
+            os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        # Already exited
+        pass
+
+
+class _SubprocessExecution(Execution):
+
+    def __init__(self, process, stdin, timeout, chunk_size, stats):
+        self.process = process
+        self.chunk_size = chunk_size
+        self.stats = stats
+
+        self._stderr = []
+        self._threads = [
+            threading.Thread(target=_write_stdin, args=(process.stdin, stdin, stats)),
+            threading.Thread(target=_read_stream, args=(process.stderr, self._stderr)),
+        ]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+        self._expired = threading.Event()
+        self._watchdog = None
+        if timeout is not None:
+            self._watchdog = threading.Timer(timeout, self._expire)
+            self._watchdog.daemon = True
+            self._watchdog.start()
+
+        self._done = False
+
+    def _expire(self):
+        self._expired.set()
+        kill(self.process)
+
+    def __iter__(self):
+        finished = False
+        try:
+            if self.process.stdout is not None:
+                for chunk in iter(lambda: self.process.stdout.read(self.chunk_size), b''):
+                    yield chunk
+            finished = True
+        finally:
+            self._finalize(abort=not finished)
+
+    def close(self):
+        self._finalize(abort=True)
+
+    def _finalize(self, abort):
+        if self._done:
+            return
+        self._done = True
+
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+        if abort and self.process.poll() is None:
+            kill(self.process)
+        if self.process.stdout is not None:
+            self.process.stdout.close()
+        for thread in self._threads:
+            thread.join()
+
+        rusage = instrumentation.wait(self.process)
+        if self.stats is not None and rusage is not None:
+            self.stats.set_rusage(rusage)
+
+        self.stderr = b''.join(self._stderr)
+        self.exit_code = self.process.returncode
+        self.timed_out = self._expired.is_set()
+
+
+def _set_limits(memory_limit, cpu_limit):
+    """Returns function setting resource limits in a forked child before exec"""
+    def set_limits():
+        if memory_limit:
+            resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+        if cpu_limit:
+            # SIGXCPU at soft limit, SIGKILL a second later if it is ignored
+            resource.setrlimit(resource.RLIMIT_CPU, (cpu_limit, cpu_limit + 1))
+    return set_limits
+
+
+class SubprocessBackend(Backend):
+    """
+    Default backend, runs the wkhtmltopdf binary as a child process.
+
+    Input is written and stderr is drained in background threads to avoid pipe
+    deadlocks. The child runs in its own process group (session on POSIX), which
+    is killed as a whole on timeout or when the execution is closed early.
+
+    On POSIX, resource limits can be set for each child, so a runaway document
+    fails fast instead of pushing the machine into swap.
+
+    :param memory_limit: (optional) max address space of a child in bytes
+                         (``RLIMIT_AS``). wkhtmltopdf reserves a lot of virtual
+                         memory, leave a generous margin.
+    :param cpu_limit: (optional) max CPU time of a child in seconds
+                      (``RLIMIT_CPU``), it is killed with ``SIGXCPU`` when exceeded
+    """
+
+    def __init__(self, memory_limit=None, cpu_limit=None):
+        if (memory_limit or cpu_limit) and resource is None:
+            raise ValueError('Resource limits are supported only on POSIX systems')
+        self.memory_limit = memory_limit
+        self.cpu_limit = cpu_limit
+
+    def popen_kwargs(self, env):
+        """
+        Keyword arguments shared by every wkhtmltopdf subprocess
+        """
+        kwargs = {'env': env}
+
+        if sys.platform == 'win32':
+            # hide cmd window
+            startupinfo = subprocess.STARTUPINFO()
+            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+            startupinfo.wShowWindow = subprocess.SW_HIDE
+            kwargs['startupinfo'] = startupinfo
+            kwargs['creationflags'] = subprocess.CREATE_NEW_PROCESS_GROUP
+        else:
+            # Own process group, so helpers started by wkhtmltopdf can be killed too
+            kwargs['start_new_session'] = True
+            if self.memory_limit or self.cpu_limit:
+                kwargs['preexec_fn'] = _set_limits(self.memory_limit, self.cpu_limit)
+
+        return kwargs
+
+    def start(self, argv, stdin=None, env=None, timeout=None, chunk_size=64 * 1024, stats=None,
+              stdout=None):
+        started = time.monotonic()
+        process = subprocess.Popen(
+            argv,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE if stdout is None else stdout,
+            stderr=subprocess.PIPE,
+            **self.popen_kwargs(env)
+        )
+        if stats is not None:
+            stats.spawn_time = time.monotonic() - started
+
+        return _SubprocessExecution(process, stdin, timeout, chunk_size, stats)
+
+    async def execute_async(self, argv, stdin=None, env=None, timeout=None, stats=None,
+                            stdout=None):
+        """
+        Runs command with ``asyncio.create_subprocess_exec``, so pipes are served by
+        the running event loop. The child is killed if the task is cancelled.
+        Resource usage is not collected, the child is reaped by the event loop.
+        """
+        started = time.monotonic()
+        process = await asyncio.create_subprocess_exec(
+            *argv,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE if stdout is None else stdout,
+            stderr=asyncio.subprocess.PIPE,
+            **self.popen_kwargs(env)
+        )
+        if stats is not None:
+            stats.spawn_time = time.monotonic() - started
+
+        async def feed(chunks):
+            started = time.monotonic()
+            try:
+                if chunks is not None:
+                    # Chunks may be read from files or generated, so they are
+                    # taken in the executor to keep the loop responsive
+                    loop = asyncio.get_running_loop()
+                    chunks = iter(chunks)
+                    while True:
+                        chunk = await loop.run_in_executor(None, next, chunks, None)
+                        if chunk is None:
+                            break
+                        process.stdin.write(chunk)
+                        await process.stdin.drain()
+                        if stats is not None:
+                            stats.input_bytes += len(chunk)
+            except (BrokenPipeError, ConnectionResetError):
+                # wkhtmltopdf exited early, its error is reported through stderr
+                pass
+            finally:
+                process.stdin.close()
+                if stats is not None:
+                    stats.stdin_time = time.monotonic() - started
+
+        stderr = []
+
+        async def drain_stderr():
+            while True:
+                chunk = await process.stderr.read(64 * 1024)
+                if not chunk:
+                    return
+                stderr.append(chunk)
+
+        async def read_stdout():
+            if process.stdout is None:
+                return b''
+            return await process.stdout.read()
+
+        async def communicate():
+            output, _, _ = await asyncio.gather(read_stdout(), drain_stderr(), feed(stdin))
+            await process.wait()
+            return output
+
+        try:
+            output = await asyncio.wait_for(communicate(), timeout)
+        except asyncio.TimeoutError:
+            kill(process)
+            await process.wait()
+            raise ExecutionTimeout(b''.join(stderr))
+        finally:
+            if process.returncode is None:
+                kill(process)
+                await process.wait()
+
+        return output, b''.join(stderr), process.returncode
+
+
+# Smallest valid single page PDF, returned by LoopbackBackend by default
+MINIMAL_PDF = (
+    b'%PDF-1.4\n'
+    b'1 0 obj\n<< /Type /Catalog /Pages 2 0 R >>\nendobj\n'
+    b'2 0 obj\n<< /Type /Pages /Kids [3 0 R] /Count 1 >>\nendobj\n'
+    b'3 0 obj\n<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] >>\nendobj\n'
+    b'xref\n0 4\n'
+    b'0000000000 65535 f \n'
+    b'0000000009 00000 n \n'
+    b'0000000058 00000 n \n'
+    b'0000000115 00000 n \n'
+    b'trailer\n<< /Size 4 /Root 1 0 R >>\nstartxref\n186\n%%EOF\n'
+)
+
+
+class _LoopbackExecution(Execution):
+
+    def __init__(self, backend, argv, stdin, chunk_size, stats, fd):
+        started = time.monotonic()
+        data = b''.join(bytes(chunk) for chunk in stdin) if stdin is not None else b''
+        if stats is not None:
+            stats.input_bytes = len(data)
+            stats.stdin_time = time.monotonic() - started
+
+        backend.calls.append((list(argv), data))
+        stdout, self._stderr, self._exit_code = backend.respond(argv, data)
+
+        # Probes print to stdout, their last argument is not an output path
+        output = '-' if argv[1:] and argv[-1] in PROBE_FLAGS else argv[-1]
+        if output != '-' and self._exit_code == 0:
+            with open(output, 'wb') as f:
+                f.write(stdout)
+            stdout = b''
+        elif fd is not None:
+            write_fd(fd, stdout)
+            stdout = b''
+
+        self._stdout = stdout
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        for i in range(0, len(self._stdout), self.chunk_size):
+            yield self._stdout[i:i + self.chunk_size]
+        self.stderr = self._stderr
+        self.exit_code = self._exit_code
+
+
+class LoopbackBackend(Backend):
+    """
+    In-process backend which doesn't run wkhtmltopdf at all. It consumes input
+    and answers with a fixed PDF, which makes it useful for tests and for
+    benchmarking the Python layer alone. Commands and inputs it received are
+    recorded in ``calls``.
+
+    :param pdf: (optional) bytes returned for every command, a minimal one page PDF by default
+    :param stderr: (optional) bytes written to stderr
+    :param exit_code: (optional) exit code of every command
+    :param responder: (optional) callable (argv, input) -> (stdout, stderr, exit_code)
+                      which overrides fixed answers
+    """
+
+    requires_binary = False
+
+    def __init__(self, pdf=MINIMAL_PDF, stderr=b'', exit_code=0, responder=None):
+        self.pdf = pdf
+        self.stderr = stderr
+        self.exit_code = exit_code
+        self.responder = responder
+        self.calls = []
+
+    def respond(self, argv, data):
+        if self.responder is not None:
+            return self.responder(argv, data)
+        return self.pdf, self.stderr, self.exit_code
+
+    def start(self, argv, stdin=None, env=None, timeout=None, chunk_size=64 * 1024, stats=None,
+              stdout=None):
+        return _LoopbackExecution(self, argv, stdin, chunk_size, stats, stdout)
+
+    async def execute_async(self, argv, stdin=None, env=None, timeout=None, stats=None,
+                            stdout=None):
+        return self.execute(argv, stdin, env=env, timeout=timeout, stats=stats, stdout=stdout)
+
+
+def _libwkhtmltox_backend():
+    from .wkhtmltox import LibwkhtmltoxBackend
+    return LibwkhtmltoxBackend()
+
+
+_backends = {
+    'subprocess': SubprocessBackend,
+    'loopback': LoopbackBackend,
+    'libwkhtmltox': _libwkhtmltox_backend,
+}
+
+
+def register_backend(name, factory):
+    """
+    Registers a backend, so it can be selected by name with ``backend``
+    configuration option.
+
+    :param name: name of the backend
+    :param factory: callable without arguments returning :class:`Backend`, e.g. its class
+    """
+    _backends[name] = factory
+
+
+def get_backend(backend):
+    """
+    Returns backend instance for given name or instance
+    """
+    if isinstance(backend, Backend):
+        return backend
+    try:
+        factory = _backends[backend]
+    except KeyError:
+        raise ValueError('Unknown pdfkit backend: %r. Available backends: %s'
+                         % (backend, ', '.join(sorted(_backends))))
+    return factory()
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .pdfkit import PDFKit
+
+
+def _render_job(job, configuration, cache):
+    """
+    Renders a single job spec, see :func:`render_many` for its keys
+    """
+    spec = dict(job)
+    source = spec.pop('source')
+    type_ = spec.pop('type', 'string')
+    output_path = spec.pop('output_path', None)
+    timeout = spec.pop('timeout', None)
+
+    if spec.get('configuration') is None:
+        spec['configuration'] = configuration
+    if spec.get('cache') is None:
+        spec['cache'] = cache
+
+    return PDFKit(source, type_, **spec).to_pdf(output_path, timeout=timeout)
+
+
+def render_many(jobs, max_workers=None, ordered=False, configuration=None, cache=None):
+    """
+    Renders many documents with a bounded number of concurrent wkhtmltopdf
+    processes.
+
+    Jobs are pulled lazily from ``jobs``, at most ``2 * max_workers`` of them are
+    in flight at any time, so the input may be a generator of any length.
+    A failing job doesn't stop the batch, its exception is yielded instead of
+    a result.
+
+    :param jobs: iterable of dicts with a required ``source`` key and optional
+                 ``type`` ('url', 'file' or 'string', 'string' by default),
+                 ``output_path``, ``options``, ``toc``, ``cover``, ``css``,
+                 ``configuration``, ``cover_first``, ``verbose``, ``cache`` and
+                 ``timeout`` keys that have the same meaning as in
+                 :func:`pdfkit.from_string`
+    :param max_workers: (optional) number of concurrent renders, number of CPUs by default
+    :param ordered: (optional) if True, results are yielded in input order,
+                    otherwise as soon as they are ready
+    :param configuration: (optional) instance of pdfkit.configuration.Configuration()
+                          used by jobs without their own
+    :param cache: (optional) instance of pdfkit.cache.RenderCache() used by jobs
+                  without their own
+
+    Returns: iterator of 2-tuples (job, result) where result is PDF, True or
+             exception raised by the job
+    """
+    return imap_bounded(lambda job: _render_job(job, configuration, cache),
+                        jobs, max_workers=max_workers, ordered=ordered)
+
+
+def imap_bounded(func, items, max_workers=None, ordered=False):
+    """
+    Calls ``func`` for each item on a thread pool, pulling items lazily with at
+    most ``2 * max_workers`` calls in flight.
+
+    Returns: iterator of 2-tuples (item, result) where result is the return value
+             of ``func`` or exception raised by it
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    window = 2 * max_workers
+    items = iter(items)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+
+        def fill():
+            while len(pending) < window:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                pending.append((executor.submit(func, item), item))
+
+        def outcome(future):
+            try:
+                return future.result()
+            except Exception as e:
+                return e
+
+        try:
+            fill()
+            while pending:
+                if ordered:
+                    future, item = pending.popleft()
+                    result = outcome(future)
+                else:
+                    done, _ = wait([f for f, _ in pending], return_when=FIRST_COMPLETED)
+                    index = next(i for i, (f, _) in enumerate(pending) if f in done)
+                    future, item = pending[index]
+                    del pending[index]
+                    result = outcome(future)
+
+                fill()
+                yield item, result
+        finally:
+            # Consumer stopped early, don't start calls that are still queued
+            for future, _ in pending:
+                future.cancel()
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+def cache_key(args, binary_identity, chunks=None, files=None):
+    """
+    Builds a content address for a render: hash of wkhtmltopdf arguments,
+    identity of the binary and all input data.
+
+    :param args: list with wkhtmltopdf command, output path should be replaced with '-'
+    :param binary_identity: value of :meth:`Configuration.binary_identity`
+    :param chunks: (optional) iterable of bytes piped to wkhtmltopdf stdin
+    :param files: (optional) list of input files read by wkhtmltopdf itself
+    """
+    digest = hashlib.sha256()
+    digest.update(repr(binary_identity).encode('utf-8'))
+    for arg in args:
+        digest.update(b'\0')
+        digest.update(arg.encode('utf-8') if isinstance(arg, str) else bytes(arg))
+
+    digest.update(b'\0stdin\0')
+    for chunk in chunks or ():
+        digest.update(chunk)
+
+    for path in files or ():
+        digest.update(b'\0file\0')
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b''):
+                digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+class RenderCache(object):
+    """
+    Two tier LRU cache of rendered PDFs keyed by :func:`cache_key`.
+
+    PDFs are kept in memory up to ``max_memory_bytes`` and, if ``directory`` is
+    given, on disk up to ``max_disk_bytes``. Disk entries are written atomically
+    and read without locks, so several processes can share one directory.
+
+    :param max_memory_bytes: (optional) size limit of in-memory tier, 0 disables it
+    :param directory: (optional) path to directory for on-disk tier
+    :param max_disk_bytes: (optional) size limit of on-disk tier
+    :param ttl: (optional) max age of entries in seconds, entries never expire by default
+    """
+
+    def __init__(self, max_memory_bytes=64 * 1024 * 1024, directory=None,
+                 max_disk_bytes=1024 * 1024 * 1024, ttl=None):
+        self.max_memory_bytes = max_memory_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        # Size of disk tier, None until the directory is scanned
+        self._disk_bytes = None
+        self._lock = threading.Lock()
+
+        if self.directory and not os.path.isdir(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+
+    def stats(self):
+        """Returns dict with hit/miss counters and current memory tier size"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'disk_hits': self.disk_hits,
+                'memory_items': len(self._memory),
+                'memory_bytes': self._memory_bytes,
+            }
+
+    def get(self, key):
+        """Returns cached PDF for given key or None"""
+        now = time.time()
+
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created, data = entry
+                if self.ttl is None or now - created < self.ttl:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return data
+                self._memory_discard(key)
+
+        data = self._disk_get(key, now)
+
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+
+        self._memory_set(key, data, now)
+        return data
+
+    def set(self, key, data):
+        """Stores PDF in all tiers"""
+        now = time.time()
+        self._memory_set(key, data, now)
+        self._disk_set(key, data)
+
+    def clear(self):
+        """Removes all entries from both tiers"""
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+            self._disk_bytes = 0
+
+        for entry in self._disk_entries():
+            _remove(entry.path)
+
+    def _memory_set(self, key, data, created):
+        if len(data) > self.max_memory_bytes:
+            return
+
+        with self._lock:
+            self._memory_discard(key)
+            self._memory[key] = (created, data)
+            self._memory_bytes += len(data)
+            while self._memory_bytes > self.max_memory_bytes:
+                self._memory_discard(next(iter(self._memory)))
+
+    def _memory_discard(self, key):
+        entry = self._memory.pop(key, None)
+        if entry is not None:
+            self._memory_bytes -= len(entry[1])
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.pdf')
+
+    def _disk_get(self, key, now):
+        if not self.directory:
+            return None
+
+        path = self._path(key)
+        try:
+            st = os.stat(path)
+            # mtime is the time entry was written, atime is its last use
+            if self.ttl is not None and now - st.st_mtime >= self.ttl:
+                _remove(path)
+                return None
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path, (now, st.st_mtime))
+        except (IOError, OSError):
+            # Missing or removed by another process meanwhile
+            return None
+        return data
+
+    def _disk_set(self, key, data):
+        if not self.directory or len(data) > self.max_disk_bytes:
+            return
+
+        path = self._path(key)
+        try:
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            # Atomic on POSIX and Windows, readers see either old or new file
+            os.replace(tmp, path)
+        except (IOError, OSError):
+            _remove(tmp)
+            return
+
+        # Size is tracked incrementally, the directory is only scanned when the
+        # limit may be exceeded. Then entries of other processes are counted too.
+        with self._lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes += len(data) - replaced
+            scan = self._disk_bytes is None or self._disk_bytes > self.max_disk_bytes
+        if scan:
+            self._disk_evict()
+
+    def _disk_entries(self):
+        if not self.directory:
+            return []
+        try:
+            return [entry for entry in os.scandir(self.directory)
+                    if entry.name.endswith('.pdf')]
+        except OSError:
+            return []
+
+    def _disk_evict(self):
+        now = time.time()
+        entries = []
+        total = 0
+        for entry in self._disk_entries():
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            if self.ttl is not None and now - st.st_mtime >= self.ttl:
+                _remove(entry.path)
+                continue
+            entries.append((st.st_atime, st.st_size, entry.path))
+            total += st.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_disk_bytes:
+                break
+            _remove(path)
+            total -= size
+
+        with self._lock:
+            self._disk_bytes = total
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Options supported by the installed wkhtmltopdf or wkhtmltoimage, read from
+its help.
+
+wkhtmltopdf lists every option it accepts in ``--extended-help``, grouped into
+sections which define where an option may appear in a command. Builds without
+patched Qt don't list, or mark with ``*``, options which need the patches.
+"""
+import re
+import subprocess
+from collections import namedtuple
+
+# Help section -> where options of the section may be used
+SECTIONS = {
+    'global options': 'global',
+    # wkhtmltoimage has a single section
+    'general options': 'global',
+    'outline options': 'global',
+    'page options': 'page',
+    'headers and footer options': 'page',
+    'toc options': 'toc',
+}
+
+_SECTION = re.compile(r'^(\S[^:]*):\s*$')
+_OPTION = re.compile(r'^  (?:(-[A-Za-z]), |    )(--[\w-]+)((?: <[^>]*>)*)( \*)?(?:\s|$)')
+_VERSION = re.compile(r'wkhtmlto(?:pdf|image)\s+(\S+)(.*)')
+
+PROBE_TIMEOUT = 10
+
+#: Flags the binary is probed with, one per run
+PROBE_FLAGS = ('--version', '--extended-help')
+
+#: Option supported by wkhtmltopdf: number of values and section scope
+Option = namedtuple('Option', 'name arity scope')
+
+
+class Capabilities(object):
+    """
+    Version and option table of a wkhtmltopdf binary
+
+    :param version: version string, e.g. '0.12.6'
+    :param patched_qt: whether the binary is built with patched Qt
+    :param options: dict option name -> :class:`Option`, short names included
+    """
+
+    def __init__(self, version, patched_qt, options):
+        self.version = version
+        self.patched_qt = patched_qt
+        self.options = options
+
+    def check(self, key, value, toc=False):
+        """
+        Checks that an option is supported, has right number of values and is
+        used in a part of command where wkhtmltopdf accepts it.
+
+        :param key: normalized option name, e.g. '--page-size'
+        :param value: option value as generated by ``_normalize_options``
+        :param toc: whether the option is given for TOC object
+        Returns: error message or None if the option is valid
+        """
+        option = self.options.get(key)
+        if option is None:
+            return 'Unknown option %s for wkhtmltopdf %s' % (key, self.version)
+
+        if toc and option.scope == 'global':
+            return 'Option %s is a global option and can not be used for TOC' % key
+        if not toc and option.scope == 'toc':
+            return 'Option %s can be used only for TOC, pass it in toc' % key
+
+        if isinstance(value, (list, tuple)):
+            count = len(value)
+        else:
+            count = 1 if value else 0
+        if count != option.arity:
+            return 'Option %s takes %d value%s, got %d' % (
+                key, option.arity, '' if option.arity == 1 else 's', count)
+        return None
+
+
+def parse(version_output, help_output):
+    """
+    Parses output of ``wkhtmltopdf --version`` and ``--extended-help``.
+
+    Returns: :class:`Capabilities` or None if no options were found
+    """
+    match = _VERSION.search(version_output)
+    version = match.group(1) if match else 'unknown'
+    patched_qt = bool(match) and 'with patched qt' in match.group(2)
+
+    options = {}
+    scope = None
+    for line in help_output.splitlines():
+        section = _SECTION.match(line)
+        if section:
+            scope = SECTIONS.get(section.group(1).strip().lower())
+            continue
+        option = _OPTION.match(line)
+        if option is None or scope is None:
+            continue
+        if option.group(4) and not patched_qt:
+            # Needs patched Qt which this build doesn't have
+            continue
+        entry = Option(option.group(2), option.group(3).count('<'), scope)
+        options[entry.name] = entry
+        if option.group(1):
+            options[option.group(1)] = entry
+
+    if not options:
+        return None
+    return Capabilities(version, patched_qt, options)
+
+
+def probe(binary, env=None):
+    """
+    Runs wkhtmltopdf with ``--version`` and ``--extended-help`` and parses its
+    output.
+
+    Returns: :class:`Capabilities` or None if the binary can't be probed
+    """
+    outputs = []
+    for flag in PROBE_FLAGS:
+        try:
+            result = subprocess.run([binary, flag], stdin=subprocess.DEVNULL,
+                                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                    env=env or None, timeout=PROBE_TIMEOUT)
+        except (OSError, subprocess.SubprocessError):
+            return None
+        outputs.append(result.stdout.decode('utf-8', errors='replace'))
+    return parse(*outputs)
@@ -2,6 +2,12 @@
 import os
 import subprocess
 import sys
+import threading
+from collections import OrderedDict
+
+from .backends import Backend, get_backend
+from .capabilities import probe
+from .xvfb import shared_pool
 try:
     FileNotFoundError
 except NameError:
@@ -9,24 +15,36 @@ except NameError:
 
 
 class Configuration(object):
-    def __init__(self, wkhtmltopdf='', meta_tag_prefix='pdfkit-', environ=''):
+    def __init__(self, wkhtmltopdf='', meta_tag_prefix='pdfkit-', environ='', meta_tags=True,
+                 timeout=None, backend='subprocess', check_eof=False, validate_options=True,
+                 scheduler=None, xvfb=None, wkhtmltoimage=''):
         self.meta_tag_prefix = meta_tag_prefix
+        self.meta_tags = meta_tags
+        self.timeout = timeout
+        self.check_eof = check_eof
+        self.validate_options = validate_options
+        self.scheduler = scheduler
+        self.xvfb = shared_pool() if xvfb is True else xvfb
+        self.backend = get_backend(backend)
+        # Backends given as instances are closed by their owners
+        self._owned = [self.backend] if not isinstance(backend, Backend) else []
 
         self.wkhtmltopdf = wkhtmltopdf
+        # Looked up on first image render, see image_binary()
+        self.wkhtmltoimage = wkhtmltoimage
+        self._image_binary = None
+
+        if self.backend.requires_binary:
+            self._find_binary()
+        elif not self.wkhtmltopdf:
+            self.wkhtmltopdf = 'wkhtmltopdf'
+
+        self.environ = _environ_snapshot(environ)
 
+    def _find_binary(self):
         try:
             if not self.wkhtmltopdf:
-                if sys.platform == 'win32':
-                    #hide cmd window
-                    startupinfo = subprocess.STARTUPINFO()
-                    startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-                    startupinfo.wShowWindow = subprocess.SW_HIDE
-
-                    self.wkhtmltopdf = subprocess.Popen(
-                        ['where.exe', 'wkhtmltopdf'], stdout=subprocess.PIPE, startupinfo=startupinfo).communicate()[0]
-                else:
-                    self.wkhtmltopdf = subprocess.Popen(
-                        ['which', 'wkhtmltopdf'], stdout=subprocess.PIPE).communicate()[0]
+                self.wkhtmltopdf = _which('wkhtmltopdf')
 
             lines = self.wkhtmltopdf.splitlines()
             if len(lines) > 0:
@@ -41,12 +59,220 @@ class Configuration(object):
                           'check README. Otherwise please install wkhtmltopdf - '
                           'https://github.com/JazzCore/python-pdfkit/wiki/Installing-wkhtmltopdf' % self.wkhtmltopdf)
 
+    def image_binary(self):
+        """
+        Returns path to wkhtmltoimage. Unless given with ``wkhtmltoimage``, it
+        is looked up next to the wkhtmltopdf binary, which both come with
+        wkhtmltopdf packages, and then with ``which`` or ``where``.
+
+        Raises: IOError if wkhtmltoimage can't be found
+        """
+        if self._image_binary is not None:
+            return self._image_binary
+
+        binary = self.wkhtmltoimage
+        if not binary and not self.backend.requires_binary:
+            binary = 'wkhtmltoimage'
+        if not binary:
+            pdf_binary = os.fsdecode(self.wkhtmltopdf)
+            sibling = os.path.join(os.path.dirname(pdf_binary),
+                                   os.path.basename(pdf_binary).replace('wkhtmltopdf', 'wkhtmltoimage'))
+            if sibling != pdf_binary and os.path.isfile(sibling):
+                binary = sibling
+        if not binary:
+            try:
+                lines = _which('wkhtmltoimage').splitlines()
+            except (IOError, OSError):
+                lines = []
+            binary = lines[0].strip() if lines else ''
+        binary = os.fsdecode(binary)
+
+        if self.backend.requires_binary and not os.path.isfile(binary):
+            raise IOError('No wkhtmltoimage executable found: "%s"\n'
+                          'It is installed with wkhtmltopdf, you can pass path to it '
+                          'with wkhtmltoimage configuration option' % binary)
+        self._image_binary = binary
+        return binary
+
+    def binary_identity(self, binary=None):
+        """
+        Returns a tuple identifying the wkhtmltopdf binary, or another binary if
+        given, on disk (device, inode, mtime and size), or None if it can not be
+        stat'ed.
+        """
+        return _binary_identity(self.wkhtmltopdf if binary is None else binary)
+
+    def capabilities(self, binary=None):
+        """
+        Returns :class:`pdfkit.capabilities.Capabilities` of the wkhtmltopdf
+        binary, or another binary if given, or None if options are not validated
+        or the binary can't be probed. Results are shared by all configurations,
+        a binary is probed once and again only when it changes on disk.
+        """
+        if not self.validate_options or not self.backend.requires_binary:
+            return None
+
+        binary = self.wkhtmltopdf if binary is None else binary
+        identity = self.binary_identity(binary)
+        if identity is None:
+            return None
+
+        key = (binary, identity)
+        with _capabilities_cache_lock:
+            if key in _capabilities_cache:
+                return _capabilities_cache[key]
+
+        capabilities = probe(binary, self.environ)
+        with _capabilities_cache_lock:
+            # Entries of a replaced binary at the same path are stale
+            for stale in [k for k in _capabilities_cache if k[0] == binary]:
+                del _capabilities_cache[stale]
+            _capabilities_cache[key] = capabilities
+        return capabilities
+
+    def close(self):
+        """
+        Releases workers of a backend given by name. The shared Xvfb pool of
+        ``xvfb=True`` and instances passed in are left running.
+        """
+        owned, self._owned = self._owned, []
+        for resource in owned:
+            close = getattr(resource, 'close', None)
+            if close is not None:
+                close()
+
+
+# (binary path, binary identity) -> capabilities, shared by all configurations
+_capabilities_cache = {}
+_capabilities_cache_lock = threading.Lock()
+
+
+def _which(name):
+    """Returns output of ``which``, or ``where`` on Windows, for a binary name"""
+    if sys.platform == 'win32':
+        #hide cmd window
+        startupinfo = subprocess.STARTUPINFO()
+        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+        startupinfo.wShowWindow = subprocess.SW_HIDE
+
+        return subprocess.Popen(
+            ['where.exe', name], stdout=subprocess.PIPE, startupinfo=startupinfo).communicate()[0]
+    return subprocess.Popen(
+        ['which', name], stdout=subprocess.PIPE).communicate()[0]
+
+
+def _binary_identity(path):
+    try:
+        st = os.stat(path)
+    except (IOError, OSError):
+        return None
+    return (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def _environ_snapshot(environ):
+    """
+    Returns the environment passed to wkhtmltopdf, copied once so later changes
+    of ``os.environ`` or the given mapping don't affect renders. Values of
+    mappings other than ``os.environ`` are cast to str.
+    """
+    if not environ or environ is os.environ:
+        return dict(os.environ)
+
+    return dict((key, value if isinstance(value, str) else str(value))
+                for key, value in environ.items())
+
+
+# Copy of os.environ contents and a version bumped when they change
+_environ_state = {'data': None, 'version': 0}
+_environ_lock = threading.Lock()
+
+
+def _environ_version():
+    """
+    Returns a number which changes when contents of ``os.environ`` change.
+    The mapping behind ``os.environ`` is compared to a copy, which is much
+    cheaper than building a key of its items.
+    """
+    data = getattr(os.environ, '_data', None)
+    if data is None:
+        data = dict(os.environ)
+    with _environ_lock:
+        if _environ_state['data'] != data:
+            _environ_state['data'] = dict(data)
+            _environ_state['version'] += 1
+        return _environ_state['version']
+
+
+def _environ_key(environ, version):
+    if not environ or environ is os.environ:
+        # Configuration copies the process environment
+        return version
+    return tuple(sorted((key, str(value)) for key, value in environ.items()))
+
+
+# Least recently used configurations are dropped above this number
+MAX_CACHED_CONFIGURATIONS = 16
+
+_configuration_cache = OrderedDict()
+_configuration_cache_lock = threading.Lock()
+
+
+def _freeze(value):
+    if isinstance(value, dict) or value is os.environ:
+        return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def cached_configuration(**kwargs):
+    """
+    Returns a shared :class:`Configuration` for given arguments, building it only
+    on first use. Takes the same arguments as :class:`Configuration`.
+
+    Entries are keyed on all arguments and are rebuilt when the binary is
+    replaced or modified on disk. Above :data:`MAX_CACHED_CONFIGURATIONS`
+    least recently used entries are dropped and closed. Without ``environ``, or without
+    ``wkhtmltopdf`` which is then looked up in ``$PATH``, changes of the process
+    environment trigger a new configuration and binary lookup.
+    """
+    version = _environ_version()
+    key = tuple(sorted((name, _freeze(value)) for name, value in kwargs.items()
+                       if name != 'environ'))
+    key += (_environ_key(kwargs.get('environ'), version),)
+    key += (None if kwargs.get('wkhtmltopdf') else version,)
+
+    with _configuration_cache_lock:
+        entry = _configuration_cache.get(key)
+        if entry is not None:
+            _configuration_cache.move_to_end(key)
+
+    if entry is not None:
+        config, identity = entry
+        if config.binary_identity() == identity and (
+                identity is not None or not config.backend.requires_binary):
+            return config
+
+    config = Configuration(**kwargs)
+
+    dropped = []
+    with _configuration_cache_lock:
+        previous = _configuration_cache.pop(key, None)
+        if previous is not None:
+            dropped.append(previous[0])
+        _configuration_cache[key] = (config, config.binary_identity())
+        while len(_configuration_cache) > MAX_CACHED_CONFIGURATIONS:
+            dropped.append(_configuration_cache.popitem(last=False)[1][0])
 
-        self.environ = environ
+    for stale in dropped:
+        stale.close()
+    return config
 
-        if not self.environ:
-            self.environ = os.environ
 
-        for key in self.environ.keys():
-            if not isinstance(self.environ[key], str):
-                self.environ[key] = str(self.environ[key])
+def clear_configuration_cache():
+    """Drops and closes all configurations stored by :func:`cached_configuration`"""
+    with _configuration_cache_lock:
+        entries = list(_configuration_cache.values())
+        _configuration_cache.clear()
+    for config, _ in entries:
+        config.close()
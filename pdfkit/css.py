@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import codecs
+import os
+import threading
+from collections import OrderedDict
+
+_OPEN = b'<style>'
+_CLOSE = b'</style>'
+
+
+class StylesheetCache(object):
+    """
+    LRU cache of combined stylesheet contents.
+
+    Entries are keyed by paths together with their mtime and size, so a changed
+    file is read again on next use. Contents are kept as the UTF-8 encoded
+    ``<style>`` tag added to input, so it is built once per change.
+
+    :param max_entries: (optional) max number of cached path combinations
+    :param max_bytes: (optional) max total size of cached style tags in bytes.
+                      Tags larger than that are not cached.
+    """
+
+    def __init__(self, max_entries=128, max_bytes=16 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, paths):
+        """
+        Returns contents of given CSS files joined with newlines
+
+        :param paths: list of paths to CSS files
+        """
+        return self.style_tag(paths)[len(_OPEN):-len(_CLOSE)].decode('utf-8')
+
+    def style_tag(self, paths):
+        """
+        Returns UTF-8 encoded ``<style>`` tag with contents of given CSS files
+
+        :param paths: list of paths to CSS files
+        """
+        key = tuple((p, _file_identity(p)) for p in paths)
+
+        with self._lock:
+            tag = self._entries.get(key)
+            if tag is not None:
+                self._entries.move_to_end(key)
+                return tag
+
+        css_data = []
+        for p in paths:
+            with codecs.open(p, encoding="UTF-8") as f:
+                css_data.append(f.read())
+        tag = _OPEN + "\n".join(css_data).encode('utf-8') + _CLOSE
+
+        if len(tag) > self.max_bytes:
+            return tag
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous)
+            self._entries[key] = tag
+            self._size += len(tag)
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                self._size -= len(self._entries.popitem(last=False)[1])
+
+        return tag
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+def _file_identity(path):
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+
+stylesheets = StylesheetCache()
+
+
+def preload_css(css):
+    """
+    Reads CSS files into the stylesheet cache, e.g. on application startup
+
+    :param css: path to CSS file or list of paths, same as ``css`` argument of API calls
+    """
+    if not isinstance(css, list):
+        css = [css]
+    stylesheets.style_tag(css)
+
+
+def clear_css_cache():
+    """Drops all stylesheets read by :func:`preload_css` or API calls"""
+    stylesheets.clear()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Images of pages rendered by wkhtmltoimage, which comes with wkhtmltopdf.
+
+A preview of the first screen of a page is much cheaper to get from
+wkhtmltoimage with a crop than by rendering a whole PDF and rasterizing it.
+Renders run through the same backend, scheduler, Xvfb pool and render cache
+as PDFs.
+"""
+from collections import OrderedDict
+
+from .pdfkit import PDFKit
+
+# Image format -> signatures its output starts with
+FORMATS = {
+    'png': (b'\x89PNG',),
+    'jpg': (b'\xff\xd8',),
+    'jpeg': (b'\xff\xd8',),
+    'bmp': (b'BM',),
+    'svg': (b'<?xm', b'<svg'),
+}
+
+
+class ImageKit(PDFKit):
+    """
+    Renders an image of a URL, file or string with wkhtmltoimage.
+
+    Takes the same arguments as :class:`PDFKit` except TOC, cover and
+    ``parallel``. Options are wkhtmltoimage options. Meta tag options are not
+    read from the input, as they are meant for wkhtmltopdf.
+
+    :param format: (optional) image format: 'png', 'jpg', 'bmp' or 'svg'
+    :param width: (optional) width of the viewport and image in pixels
+    :param quality: (optional) compression quality, 0-100
+    :param crop: (optional) 4-tuple (x, y, width, height) of the rendered area
+                 to keep, in pixels
+    """
+
+    def __init__(self, url_or_file, type_, options=None, format='png', width=None,
+                 quality=None, crop=None, css=None, configuration=None, verbose=False,
+                 cache=None, prefetch=None, priority=None):
+        format = format.lower()
+        if format not in FORMATS:
+            raise ValueError('Unknown image format %r, expected one of: %s'
+                             % (format, ', '.join(sorted(FORMATS))))
+
+        super(ImageKit, self).__init__(url_or_file, type_, options=options, css=css,
+                                       configuration=configuration, verbose=verbose,
+                                       cache=cache, prefetch=prefetch, priority=priority)
+        self.wkhtmltopdf = self.configuration.image_binary()
+        self.format = format
+
+        # Format is required when the image is written to stdout. Values are
+        # passed as strings, as falsy values like 0 are taken for flags
+        self.options['--format'] = format
+        if width is not None:
+            self.options['--width'] = str(width)
+        if quality is not None:
+            self.options['--quality'] = str(quality)
+        if crop is not None:
+            x, y, crop_width, crop_height = crop
+            self.options.update(OrderedDict([
+                ('--crop-x', str(x)), ('--crop-y', str(y)),
+                ('--crop-w', str(crop_width)), ('--crop-h', str(crop_height)),
+            ]))
+
+    def _find_options_in_meta(self, content):
+        return {}
+
+    def _capabilities(self):
+        capabilities = getattr(self.configuration, 'capabilities', None)
+        return capabilities(self.wkhtmltopdf) if capabilities is not None else None
+
+    def _binary_identity(self):
+        return self.configuration.binary_identity(self.wkhtmltopdf)
+
+    def _check_pdf(self, args, head, tail):
+        """Checks that output starts with a signature of the image format"""
+        if head is not None and not any(head.startswith(signature[:len(head)])
+                                        for signature in FORMATS[self.format]):
+            raise IOError('Command failed: %s\n'
+                          'Output is not a %s image, check wkhtmltoimage output '
+                          'without \'quiet\' option' % (' '.join(args), self.format.upper()))
+
+    def to_image(self, path=None, timeout=None):
+        """
+        Renders the image, see :meth:`PDFKit.to_pdf` for arguments
+
+        Returns: image or True on success if path is given
+        """
+        return self.to_pdf(path, timeout=timeout)
+
+    async def to_image_async(self, path=None, timeout=None):
+        """Coroutine version of :meth:`to_image`"""
+        return await self.to_pdf_async(path, timeout=timeout)
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+import time
+
+_hooks = []
+_hooks_lock = threading.Lock()
+
+
+def add_render_hook(hook):
+    """
+    Registers a callable which receives :class:`RenderStats` after every
+    wkhtmltopdf run. Instrumentation is only collected while at least one hook
+    is registered.
+    """
+    with _hooks_lock:
+        _hooks.append(hook)
+
+
+def remove_render_hook(hook):
+    """Unregisters a hook added with :func:`add_render_hook`"""
+    with _hooks_lock:
+        _hooks.remove(hook)
+
+
+def enabled():
+    return bool(_hooks)
+
+
+def emit(stats):
+    with _hooks_lock:
+        hooks = list(_hooks)
+    for hook in hooks:
+        hook(stats)
+
+
+class RenderStats(object):
+    """
+    Record of a single wkhtmltopdf run. Durations are in seconds measured with
+    a monotonic clock, a phase that didn't happen is None.
+
+    :ivar argv: wkhtmltopdf command
+    :ivar queue_time: time waiting for a slot of :class:`pdfkit.RenderScheduler`
+    :ivar spawn_time: time to start the process
+    :ivar stdin_time: time to write input to stdin and close it
+    :ivar render_time: time from start until first byte of output or exit when
+                       output goes to a file, i.e. wkhtmltopdf load and layout
+    :ivar drain_time: time from first byte of output until end of stdout
+    :ivar exit_time: time from end of stdout until the process is reaped
+    :ivar validation_time: time to check exit status and output
+    :ivar total_time: time of the whole run
+    :ivar input_bytes: bytes written to stdin
+    :ivar output_bytes: bytes of PDF read from stdout or written to output file
+    :ivar exit_code: exit code of wkhtmltopdf
+    :ivar user_time: CPU time of the child in user mode (POSIX only)
+    :ivar system_time: CPU time of the child in system mode (POSIX only)
+    :ivar max_rss: max resident set size of the child in kilobytes, as reported
+                   by the OS (POSIX only)
+    :ivar minor_faults: page faults served without I/O (POSIX only)
+    :ivar major_faults: page faults that required I/O (POSIX only)
+    :ivar error: exception raised for this run or None
+    """
+
+    FIELDS = ('argv', 'queue_time', 'spawn_time', 'stdin_time', 'render_time', 'drain_time',
+              'exit_time', 'validation_time', 'total_time', 'input_bytes',
+              'output_bytes', 'exit_code', 'user_time', 'system_time', 'max_rss',
+              'minor_faults', 'major_faults', 'error')
+
+    def __init__(self, argv):
+        for field in self.FIELDS:
+            setattr(self, field, None)
+        self.argv = list(argv)
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.started = time.monotonic()
+        self.first_output = None
+
+    def set_rusage(self, rusage):
+        self.user_time = rusage.ru_utime
+        self.system_time = rusage.ru_stime
+        self.max_rss = rusage.ru_maxrss
+        self.minor_faults = rusage.ru_minflt
+        self.major_faults = rusage.ru_majflt
+
+    def as_dict(self):
+        return dict((field, getattr(self, field)) for field in self.FIELDS)
+
+    def __repr__(self):
+        return 'RenderStats(%s)' % ', '.join('%s=%r' % item for item in self.as_dict().items()
+                                             if item[0] != 'argv')
+
+
+def wait(process):
+    """
+    Waits for a Popen process, reaping it with ``os.wait4`` when available to
+    collect its resource usage.
+
+    Returns: resource usage of the child or None
+    """
+    if not hasattr(os, 'wait4') or process.returncode is not None:
+        process.wait()
+        return None
+
+    try:
+        _, status, rusage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        # Already reaped by Popen
+        process.wait()
+        return None
+
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return rusage
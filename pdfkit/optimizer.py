@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+Pure Python size optimizer for rendered PDFs.
+
+wkhtmltopdf embeds fonts and images separately for every input, so documents
+made of many inputs, and merged documents, carry copies of the same objects.
+The optimizer copies objects reachable from the document catalog (dropping
+unused ones), merges identical objects, compresses streams and writes a new
+cross-reference table, optionally with object streams.
+"""
+import hashlib
+import mmap
+import os
+import stat
+import tempfile
+import zlib
+from collections import namedtuple
+
+from .pdf import Document, Name, Raw, Ref, Stream, Writer, decode, serialize
+
+#: Optimization modes: zlib level, whether Flate streams are recompressed,
+#: whether identical objects are merged until none are left (or in one pass)
+#: and whether object streams are written by default
+MODES = {
+    'fast': (1, False, False, False),
+    'size': (9, True, True, True),
+}
+
+# Objects which have an identity in the document and must not be shared
+_UNIQUE_TYPES = ('Catalog', 'Pages', 'Page', 'Annot', 'Outlines', 'XRef', 'ObjStm')
+_UNIQUE_KEYS = ('Parent', 'P', 'Prev', 'Next', 'First', 'Last', 'FT')
+
+
+class OptimizeResult(namedtuple('OptimizeResult',
+                                'data original_size size objects_removed objects_merged')):
+    """
+    Result of :func:`optimize_pdf`: optimized PDF (None if it was written to
+    ``output``), sizes in bytes before and after, number of unused objects
+    dropped and number of duplicates merged into other objects
+    """
+
+    @property
+    def bytes_saved(self):
+        return self.original_size - self.size
+
+
+def _mode(mode):
+    if mode is True:
+        mode = 'fast'
+    try:
+        return MODES[mode]
+    except KeyError:
+        raise ValueError('Unknown optimize mode %r, expected one of: %s'
+                         % (mode, ', '.join(sorted(MODES))))
+
+
+def _reachable(doc):
+    """Returns dict number -> object of objects reachable from the trailer"""
+    objects = {}
+    pending = [value for key, value in doc.trailer.items() if key in ('Root', 'Info')]
+    while pending:
+        value = pending.pop()
+        if isinstance(value, Ref):
+            if value.num in objects:
+                continue
+            obj = doc.get(value)
+            objects[value.num] = obj
+            value = obj
+        if isinstance(value, Stream):
+            # Length is written directly
+            pending.extend(item for key, item in value.dictionary.items() if key != 'Length')
+        elif isinstance(value, dict):
+            pending.extend(value.values())
+        elif isinstance(value, list):
+            pending.extend(value)
+    return objects
+
+
+def _remap(obj, mapping):
+    """Returns object with references replaced according to ``mapping``"""
+    if isinstance(obj, Ref):
+        return mapping.get(obj.num, obj)
+    if isinstance(obj, dict):
+        return dict((key, _remap(value, mapping)) for key, value in obj.items())
+    if isinstance(obj, list):
+        return [_remap(item, mapping) for item in obj]
+    if isinstance(obj, Stream):
+        return Stream(_remap(obj.dictionary, mapping), obj.data)
+    return obj
+
+
+def _shareable(obj):
+    dictionary = obj.dictionary if isinstance(obj, Stream) else obj
+    if isinstance(dictionary, dict):
+        return (dictionary.get('Type') not in _UNIQUE_TYPES
+                and not any(key in dictionary for key in _UNIQUE_KEYS))
+    return obj is not None
+
+
+def _merge_duplicates(objects, repeat, protected=()):
+    """
+    Points references to identical objects to one of them, until no more
+    objects become identical if ``repeat`` is set. Objects with numbers in
+    ``protected`` are kept. Modifies ``objects``.
+
+    Returns: number of merged objects
+    """
+    merged = 0
+    while True:
+        seen = {}
+        mapping = {}
+        for num in sorted(objects):
+            obj = objects[num]
+            if num in protected or not _shareable(obj):
+                continue
+            digest = hashlib.sha256(serialize(obj)).digest()
+            if digest in seen:
+                mapping[num] = Ref(seen[digest], 0)
+            else:
+                seen[digest] = num
+        if not mapping:
+            return merged
+        merged += len(mapping)
+        for num in mapping:
+            del objects[num]
+        for num, obj in objects.items():
+            objects[num] = _remap(obj, mapping)
+        if not repeat:
+            return merged
+
+
+def _compress(stream, level, recompress):
+    """Returns stream compressed with FlateDecode if that makes it smaller"""
+    dictionary = stream.dictionary
+    if dictionary.get('Type') == 'Metadata':
+        # XMP metadata is meant to stay readable without decoding
+        return stream
+    filters = dictionary.get('Filter')
+    if filters is None:
+        data = bytes(stream.data)
+    elif recompress and filters in ('FlateDecode', [Name('FlateDecode')]) and 'DecodeParms' not in dictionary:
+        try:
+            data = decode(stream)
+        except IOError:
+            return stream
+    else:
+        return stream
+
+    compressed = zlib.compress(data, level)
+    if len(compressed) >= len(stream.data):
+        return stream
+    dictionary = dict(dictionary)
+    dictionary['Filter'] = Name('FlateDecode')
+    dictionary.pop('DecodeParms', None)
+    return Stream(dictionary, compressed)
+
+
+def _writer(doc, level, recompress, repeat):
+    """Copies and optimizes objects of a document, returns (writer, root, info, removed, merged)"""
+    objects = _reachable(doc)
+    removed = max(len(doc.offsets) + len(doc.compressed) - len(objects), 0)
+
+    for num, obj in objects.items():
+        if isinstance(obj, Stream):
+            obj.dictionary.pop('Length', None)
+            objects[num] = _compress(obj, level, recompress)
+    trailer_refs = [doc.trailer[key] for key in ('Root', 'Info') if isinstance(doc.trailer.get(key), Ref)]
+    merged = _merge_duplicates(objects, repeat, set(ref.num for ref in trailer_refs))
+
+    writer = Writer(doc.version)
+    # Objects are renumbered densely in their original order
+    mapping = dict((num, writer.reserve()) for num in sorted(objects))
+    missing = Raw(b'null')
+    for num, obj in objects.items():
+        obj = _remap(obj, mapping)
+        writer.set(mapping[num], missing if obj is None else obj)
+
+    root = _remap(doc.trailer['Root'], mapping)
+    info = _remap(doc.trailer['Info'], mapping) if 'Info' in doc.trailer else None
+    return writer, root, info, removed, merged
+
+
+def optimize_pdf(data, mode='fast', object_streams=None, output=None):
+    """
+    Optimizes a PDF: drops unused objects, merges identical ones (e.g. fonts
+    and images embedded by every input of a merged document), compresses
+    streams and writes a new cross-reference table.
+
+    :param data: bytes or another buffer with PDF, e.g. ``mmap`` of a file
+    :param mode: (optional) 'fast' compresses uncompressed streams with a low
+                 level and merges duplicates in one pass, 'size' also
+                 recompresses Flate streams with the highest level, merges
+                 objects which became identical after merging their parts and
+                 writes object streams
+    :param object_streams: (optional) pack objects into object streams, by
+                           default only in 'size' mode
+    :param output: (optional) file-like object to write optimized PDF to, in
+                   chunks
+
+    Returns: :class:`OptimizeResult`
+    """
+    level, recompress, repeat, default_object_streams = _mode(mode)
+    if object_streams is None:
+        object_streams = default_object_streams
+
+    writer, root, info, removed, merged = _writer(Document(data), level, recompress, repeat)
+    chunks = writer.chunks(root, info, object_streams, level)
+    if output is None:
+        result = b''.join(chunks)
+        return OptimizeResult(result, len(data), len(result), removed, merged)
+
+    size = 0
+    for chunk in chunks:
+        output.write(chunk)
+        size += len(chunk)
+    return OptimizeResult(None, len(data), size, removed, merged)
+
+
+def optimize_file(path, output_path=None, mode='fast', object_streams=None):
+    """
+    Optimizes a PDF file in place, or into ``output_path``. The file is mapped
+    into memory instead of being read, optimized PDF is written to a temporary
+    file which replaces the target atomically. A symlinked target is resolved,
+    so the file it points to is replaced, and the permissions of an existing
+    target are kept.
+
+    Returns: :class:`OptimizeResult` without data
+    """
+    output_path = os.path.realpath(output_path or path)
+    directory = os.path.dirname(output_path)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        os.chmod(tmp, _target_mode(output_path))
+        with open(path, 'rb') as source, os.fdopen(fd, 'wb') as output:
+            with mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                result = optimize_pdf(data, mode, object_streams, output)
+        os.replace(tmp, output_path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    return result
+
+
+def _target_mode(path):
+    # mkstemp creates 0600 files, a new output gets the usual umask'd mode
+    try:
+        return stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel rendering of jobs with many input URLs or files.
+
+wkhtmltopdf renders inputs of one command one after another on a single core.
+Here inputs are split into contiguous chunks rendered by concurrent wkhtmltopdf
+processes and the partial PDFs are merged in order with :func:`pdfkit.pdf.merge`.
+
+Cover is rendered as a separate part. TOC can't be generated by wkhtmltopdf
+for the whole document, so outlines of chunks are dumped with
+``--dump-outline``, combined and rendered as a page styled like the default
+wkhtmltopdf TOC. When headers or footers show page numbers, chunks are
+rendered again with ``--page-offset`` so the numbers continue across chunks.
+Page counts of earlier chunks aren't known before they are rendered, so this
+doubles the work of all chunks but the first (and the first too if there is a
+TOC, which is rendered before it).
+"""
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from html import escape
+from xml.etree import ElementTree
+
+from .batch import imap_bounded
+from . import pdf
+
+# Options which need the whole document in one process
+UNSUPPORTED_OPTIONS = ('--dump-outline',)
+UNSUPPORTED_TOC_OPTIONS = ('--xsl-style-sheet',)
+
+HEADER_FOOTER_PREFIXES = ('--header-', '--footer-')
+
+# Header and footer variables which depend on --page-offset. HTML headers and
+# footers get them in the query string, so they are assumed to use them.
+PAGE_VARIABLES = ('[page]', '[frompage]', '[topage]')
+HTML_HEADER_FOOTER_OPTIONS = ('--header-html', '--footer-html')
+
+# TOC page is rendered again until its length stops changing
+MAX_TOC_PASSES = 5
+
+TOC_TEMPLATE = """<!DOCTYPE html>
+<html>
+  <head>
+    <meta charset="UTF-8">
+    <style>
+      h1 {{ text-align: center; font-size: 20px; font-family: arial; }}
+      div {{ {dots} }}
+      span {{ float: right; }}
+      li {{ list-style: none; }}
+      ul {{ font-size: 20px; font-family: arial; padding-left: 0em; }}
+      ul ul {{ font-size: {shrink}%; padding-left: {indentation}; }}
+    </style>
+  </head>
+  <body>
+    <h1>{caption}</h1>
+    {items}
+  </body>
+</html>
+"""
+
+
+def split(items, parts):
+    """Splits a list into at most ``parts`` contiguous chunks of similar size"""
+    parts = max(min(parts, len(items)), 1)
+    size, extra = divmod(len(items), parts)
+    chunks = []
+    start = 0
+    for i in range(parts):
+        end = start + size + (1 if i < extra else 0)
+        chunks.append(items[start:end])
+        start = end
+    return chunks
+
+
+def _grouped(pairs):
+    """Groups normalized (option, value) pairs into option -> list of values"""
+    options = OrderedDict()
+    for key, value in pairs:
+        options.setdefault(key, []).append(value)
+    return options
+
+
+def numbered(options):
+    """
+    Whether headers or footers in grouped options show page numbers, which
+    depend on ``--page-offset``
+    """
+    for key, values in options.items():
+        if key in HTML_HEADER_FOOTER_OPTIONS:
+            return True
+        if key.startswith(HEADER_FOOTER_PREFIXES) and any(
+                variable in str(value) for value in values for variable in PAGE_VARIABLES):
+            return True
+    return False
+
+
+def read_outline(path):
+    """
+    Reads outline dumped by wkhtmltopdf.
+
+    Returns: list of (level, title, page) tuples in document order
+    """
+    items = []
+
+    def walk(element, level):
+        for child in element:
+            if not child.tag.endswith('item'):
+                continue
+            title = child.get('title', '')
+            if title:
+                items.append((level, title, int(child.get('page', 0))))
+                walk(child, level + 1)
+            else:
+                # Items without title group headings of an input document
+                walk(child, level)
+
+    walk(ElementTree.parse(path).getroot(), 0)
+    return items
+
+
+def toc_html(items, toc_options):
+    """
+    Returns HTML of a TOC page for given (level, title, page) items, styled like
+    the default wkhtmltopdf TOC
+    """
+    def option(key, default):
+        values = toc_options.get(key)
+        return values[0] if values and values[0] else default
+
+    parts = []
+    level = -1
+    for item_level, title, page in items:
+        while level < item_level:
+            parts.append('<ul>')
+            level += 1
+        while level > item_level:
+            parts.append('</li></ul>')
+            level -= 1
+        if parts[-1] != '<ul>':
+            parts.append('</li>')
+        parts.append('<li><div>%s<span>%d</span></div>' % (escape(title), page))
+    while level >= 0:
+        parts.append('</li></ul>')
+        level -= 1
+
+    dots = ('' if '--disable-dotted-lines' in toc_options
+            else 'border-bottom: 1px dashed rgb(200,200,200);')
+    shrink = '%g' % (float(option('--toc-text-size-shrink', 0.8)) * 100)
+    return TOC_TEMPLATE.format(
+        caption=escape(option('--toc-header-text', 'Table of Contents')),
+        dots=dots, shrink=shrink,
+        indentation=option('--toc-level-indentation', '1em'),
+        items='\n    '.join(parts))
+
+
+def render(kit, path=None, timeout=None):
+    """
+    Renders a :class:`PDFKit` with a list of URLs or files using
+    ``kit.parallel`` concurrent wkhtmltopdf processes.
+
+    If headers or footers show page numbers, every chunk except the first is
+    rendered twice: once to count pages and again with ``--page-offset``. With
+    a TOC the first chunk is rendered twice as well.
+
+    Returns: PDF or True if path is given, or None if the job can't be split
+    """
+    sources = kit.source.source
+    if not isinstance(sources, list) or len(sources) < 2 or kit._options_argv is not None:
+        return None
+
+    options = _grouped(kit._normalize_options(kit.options))
+    toc = _grouped(kit._normalize_options(kit.toc)) if kit.toc else None
+    if any(key in options for key in UNSUPPORTED_OPTIONS):
+        return None
+    if toc is not None and any(key in toc for key in UNSUPPORTED_TOC_OPTIONS):
+        return None
+
+    workers = (os.cpu_count() or 1) if kit.parallel is True else kit.parallel
+    page_offset = int(options.pop('--page-offset', [0])[0] or 0)
+    renumber = numbered(options)
+    chunks = split(sources, workers)
+    # Without TOC pages before it, the first chunk gets its final offset now
+    first_offset = renumber and toc is None
+
+    def part(source, type_, extra=None, exclude=()):
+        opts = OrderedDict((k, v) for k, v in options.items()
+                           if not k.startswith(exclude))
+        opts.update(extra or {})
+        return type(kit)(source, type_, options=opts, configuration=kit.configuration,
+                         verbose=kit.verbose, cache=kit.cache, priority=kit.priority)
+
+    def run(kits):
+        results = []
+        for _, result in imap_bounded(lambda k: k.to_pdf(timeout=timeout), kits,
+                                      workers, ordered=True):
+            if isinstance(result, Exception):
+                raise result
+            results.append(result)
+        return results
+
+    tmpdir = tempfile.mkdtemp(prefix='pdfkit-')
+    try:
+        outlines = [os.path.join(tmpdir, '%d.xml' % i) for i in range(len(chunks))]
+        kits = [part(chunk, kit.source.type,
+                     {'--dump-outline': [outline]} if toc is not None else None)
+                for chunk, outline in zip(chunks, outlines)]
+        if first_offset:
+            kits[0] = part(chunks[0], kit.source.type, {'--page-offset': [str(page_offset)]})
+        if kit.cover:
+            # Cover has no headers, footers or outline entries like in wkhtmltopdf
+            kits.append(part(kit.cover, 'url', {'--exclude-from-outline': [None]},
+                             exclude=HEADER_FOOTER_PREFIXES))
+
+        results = run(kits)
+        cover_pdf = results.pop() if kit.cover else None
+        counts = [pdf.page_count(result) for result in results]
+        starts = [sum(counts[:i]) for i in range(len(counts))]
+
+        toc_pdf = None
+        toc_pages = 0
+        if toc is not None:
+            items = []
+            for outline, start in zip(outlines, starts):
+                items.extend((level, title, start + page) for level, title, page in read_outline(outline))
+
+            toc_pages = 1
+            for _ in range(MAX_TOC_PASSES):
+                base = page_offset + toc_pages
+                html = toc_html([(level, title, base + page) for level, title, page in items], toc)
+                toc_kit = part(html, 'string',
+                               {'--page-offset': [str(page_offset)]} if renumber else None)
+                toc_pdf = toc_kit.to_pdf(timeout=timeout)
+                pages = pdf.page_count(toc_pdf)
+                if pages == toc_pages:
+                    break
+                toc_pages = pages
+
+        if renumber:
+            skip = 1 if first_offset else 0
+            results[skip:] = run([part(chunk, kit.source.type,
+                                       {'--page-offset': [str(page_offset + toc_pages + start)]})
+                                  for chunk, start in zip(chunks[skip:], starts[skip:])])
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    front = [toc_pdf, cover_pdf] if not kit.cover_first else [cover_pdf, toc_pdf]
+    merged = pdf.merge([part_pdf for part_pdf in front if part_pdf is not None] + results)
+
+    if path:
+        with open(path, 'wb') as f:
+            f.write(merged)
+        return True
+    return merged
@@ -0,0 +1,737 @@
+# -*- coding: utf-8 -*-
+"""
+Minimal pure Python PDF reader and writer, enough to count pages of PDFs
+produced by wkhtmltopdf, merge and optimize them.
+
+Objects are parsed into Python values: ``int`` for integers, :class:`Name`,
+:class:`String`, :class:`Ref`, ``list`` for arrays, ``dict`` with :class:`Name`
+keys for dictionaries and :class:`Stream` for streams. Reals, booleans and null
+are kept as :class:`Raw` tokens and written back unchanged. Stream data is
+decoded only for cross-reference and object streams, and only with
+``FlateDecode`` filter.
+
+Input may be any buffer with ``find`` and ``rfind`` methods, e.g. ``mmap`` of a
+file, so it doesn't have to be read into memory.
+"""
+import re
+import zlib
+from collections import namedtuple
+
+
+class Name(str):
+    """PDF name, stored without leading slash"""
+
+
+class String(bytes):
+    """PDF string"""
+
+
+class Raw(bytes):
+    """Token written back as is"""
+
+
+Ref = namedtuple('Ref', 'num gen')
+
+# Max number of objects packed into one object stream
+OBJECT_STREAM_SIZE = 100
+
+
+class Stream(object):
+    def __init__(self, dictionary, data):
+        self.dictionary = dictionary
+        self.data = data
+
+
+_WHITESPACE = re.compile(br'(?:[\x00\t\n\x0c\r ]|%[^\r\n]*)*')
+_REF = re.compile(br'(\d+)\s+(\d+)\s+R(?![^\x00\t\n\x0c\r ()<>\[\]{}/%])')
+_TOKEN = re.compile(br'[^\x00\t\n\x0c\r ()<>\[\]{}/%]+')
+_INTEGER = re.compile(br'[+-]?\d+$')
+_OBJ = re.compile(br'(\d+)\s+(\d+)\s+obj')
+_OBJ_ANYWHERE = re.compile(br'(?<![0-9])(\d+)\s+(\d+)\s+obj\b')
+_XREF_SECTION = re.compile(br'(\d+)\s+(\d+)\s*[\r\n]')
+_XREF_ENTRY = re.compile(br'(\d{10}) (\d{5}) ([nf])')
+_HEADER = re.compile(br'%PDF-(\d\.\d)')
+
+_ESCAPES = {
+    b'n': b'\n', b'r': b'\r', b't': b'\t', b'b': b'\b', b'f': b'\f',
+    b'(': b'(', b')': b')', b'\\': b'\\',
+}
+
+
+def _find(data, sub, pos=0):
+    """``data.index`` for buffers without it, like mmap"""
+    index = data.find(sub, pos)
+    if index < 0:
+        raise ValueError('%r not found' % sub)
+    return index
+
+
+def _unpredict(data, columns):
+    """Reverses PNG predictors of rows with one byte per pixel"""
+    out = bytearray()
+    previous = bytearray(columns)
+    for pos in range(0, len(data), columns + 1):
+        kind = data[pos]
+        row = bytearray(data[pos + 1:pos + 1 + columns])
+        for i in range(len(row)):
+            left = row[i - 1] if i else 0
+            up = previous[i]
+            if kind == 1:
+                row[i] = (row[i] + left) & 0xff
+            elif kind == 2:
+                row[i] = (row[i] + up) & 0xff
+            elif kind == 3:
+                row[i] = (row[i] + (left + up) // 2) & 0xff
+            elif kind == 4:
+                corner = previous[i - 1] if i else 0
+                estimate = left + up - corner
+                pa, pb, pc = abs(estimate - left), abs(estimate - up), abs(estimate - corner)
+                row[i] = (row[i] + (left if pa <= pb and pa <= pc else up if pb <= pc else corner)) & 0xff
+        out += row
+        previous = row
+    return bytes(out)
+
+
+def decode(stream):
+    """
+    Returns decoded data of a stream without filters or with ``FlateDecode``.
+
+    Raises: IOError for other filters
+    """
+    filters = stream.dictionary.get('Filter')
+    params = stream.dictionary.get('DecodeParms')
+    if isinstance(filters, list):
+        if len(filters) > 1:
+            raise IOError('Unsupported stream filters %s' % ', '.join(filters))
+        filters = filters[0] if filters else None
+        params = params[0] if isinstance(params, list) and params else params
+    if filters is None:
+        return bytes(stream.data)
+    if filters != 'FlateDecode':
+        raise IOError('Unsupported stream filter %s' % filters)
+
+    try:
+        data = zlib.decompress(stream.data)
+    except zlib.error as e:
+        raise IOError('Malformed PDF: %s' % e)
+    predictor = params.get('Predictor', 1) if isinstance(params, dict) else 1
+    if predictor >= 10:
+        data = _unpredict(data, params.get('Columns', 1))
+    elif predictor != 1:
+        raise IOError('Unsupported predictor %s' % predictor)
+    return data
+
+
+class Parser(object):
+    """Parses PDF objects from bytes"""
+
+    def __init__(self, data):
+        self.data = data
+
+    def skip(self, pos):
+        return _WHITESPACE.match(self.data, pos).end()
+
+    def parse(self, pos):
+        """
+        Parses object starting at ``pos``.
+
+        Returns: tuple (object, position after it)
+        """
+        data = self.data
+        pos = self.skip(pos)
+        c = data[pos:pos + 1]
+
+        if c == b'<':
+            if data[pos + 1:pos + 2] == b'<':
+                return self._parse_dict(pos + 2)
+            end = _find(data, b'>', pos)
+            digits = re.sub(br'\s', b'', data[pos + 1:end])
+            if len(digits) % 2:
+                digits += b'0'
+            return String(bytes.fromhex(digits.decode('ascii'))), end + 1
+        if c == b'[':
+            items = []
+            pos += 1
+            while True:
+                pos = self.skip(pos)
+                if data[pos:pos + 1] == b']':
+                    return items, pos + 1
+                item, pos = self.parse(pos)
+                items.append(item)
+        if c == b'(':
+            return self._parse_string(pos + 1)
+        if c == b'/':
+            token = _TOKEN.match(data, pos + 1)
+            end = token.end() if token else pos + 1
+            return Name(data[pos + 1:end].decode('latin-1')), end
+
+        ref = _REF.match(data, pos)
+        if ref:
+            return Ref(int(ref.group(1)), int(ref.group(2))), ref.end()
+
+        token = _TOKEN.match(data, pos)
+        if token is None:
+            raise IOError('Malformed PDF: unexpected %r at %d' % (data[pos:pos + 10], pos))
+        value = token.group()
+        if _INTEGER.match(value):
+            return int(value), token.end()
+        return Raw(value), token.end()
+
+    def _parse_dict(self, pos):
+        data = self.data
+        result = {}
+        while True:
+            pos = self.skip(pos)
+            if data[pos:pos + 2] == b'>>':
+                return result, pos + 2
+            key, pos = self.parse(pos)
+            if not isinstance(key, Name):
+                raise IOError('Malformed PDF: dictionary key %r at %d' % (key, pos))
+            result[key], pos = self.parse(pos)
+
+    def _parse_string(self, pos):
+        data = self.data
+        out = bytearray()
+        depth = 1
+        while True:
+            c = data[pos:pos + 1]
+            if not c:
+                raise IOError('Malformed PDF: unterminated string')
+            pos += 1
+            if c == b'\\':
+                e = data[pos:pos + 1]
+                pos += 1
+                if e in _ESCAPES:
+                    out += _ESCAPES[e]
+                elif e.isdigit():
+                    octal = re.match(br'[0-7]{1,3}', data[pos - 1:pos + 2]).group()
+                    out.append(int(octal, 8) & 0xff)
+                    pos += len(octal) - 1
+                elif e == b'\r':
+                    if data[pos:pos + 1] == b'\n':
+                        pos += 1
+                elif e != b'\n':
+                    out += e
+            elif c == b'(':
+                depth += 1
+                out += c
+            elif c == b')':
+                depth -= 1
+                if not depth:
+                    return String(bytes(out)), pos
+                out += c
+            else:
+                out += c
+
+
+def serialize(obj):
+    """Returns PDF representation of a parsed object"""
+    if isinstance(obj, Name):
+        return b'/' + obj.encode('latin-1')
+    if isinstance(obj, Ref):
+        return b'%d %d R' % obj
+    if isinstance(obj, Raw):
+        return bytes(obj)
+    if isinstance(obj, String):
+        return b'(' + obj.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)') \
+            .replace(b'\r', b'\\r') + b')'
+    if isinstance(obj, bool):
+        return b'true' if obj else b'false'
+    if isinstance(obj, int):
+        return b'%d' % obj
+    if isinstance(obj, float):
+        return ('%.6f' % obj).rstrip('0').rstrip('.').encode('ascii')
+    if isinstance(obj, list):
+        return b'[' + b' '.join(serialize(item) for item in obj) + b']'
+    if isinstance(obj, dict):
+        return b'<<' + b''.join(serialize(Name(k)) + b' ' + serialize(v) for k, v in obj.items()) + b'>>'
+    if isinstance(obj, Stream):
+        dictionary = dict(obj.dictionary)
+        dictionary['Length'] = len(obj.data)
+        return serialize(dictionary) + b'\nstream\n' + obj.data + b'\nendstream'
+    if obj is None:
+        return b'null'
+    raise TypeError('Can not serialize %r' % (obj,))
+
+
+class Document(object):
+    """
+    Parsed PDF document. Objects are read lazily through the cross-reference
+    table. When it is missing or broken, objects are found by scanning the file.
+
+    :param data: bytes with PDF
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.parser = Parser(data)
+        self._objects = {}
+        # Number of object in an object stream -> (stream number, index)
+        self.compressed = {}
+        self._object_streams = {}
+
+        header = _HEADER.match(data)
+        if header is None:
+            raise IOError('Not a PDF document')
+        self.version = header.group(1).decode('ascii')
+
+        try:
+            self.offsets, self.trailer = self._read_xref()
+        except (IOError, ValueError, IndexError):
+            self.offsets, self.trailer = self._scan()
+
+    def _read_xref(self):
+        data = self.data
+        startxref = data.rfind(b'startxref')
+        if startxref < 0:
+            raise ValueError('Missing startxref')
+        offset = int(data[startxref + 9:startxref + 30].split()[0])
+
+        offsets = {}
+        trailer = None
+        seen = set()
+        while offset is not None and offset not in seen:
+            seen.add(offset)
+            pos = self.parser.skip(offset)
+            if data[pos:pos + 4] != b'xref':
+                section_trailer = self._read_xref_stream(pos, offsets)
+                if trailer is None:
+                    trailer = section_trailer
+                offset = section_trailer.get('Prev')
+                continue
+            pos += 4
+            while True:
+                pos = self.parser.skip(pos)
+                section = _XREF_SECTION.match(data, pos)
+                if section is None:
+                    break
+                start, count = int(section.group(1)), int(section.group(2))
+                pos = section.end()
+                for num in range(start, start + count):
+                    pos = self.parser.skip(pos)
+                    entry = _XREF_ENTRY.match(data, pos)
+                    if entry is None:
+                        raise ValueError('Malformed cross-reference entry')
+                    pos = entry.end()
+                    if entry.group(3) == b'n' and num not in offsets:
+                        offsets[num] = int(entry.group(1))
+            if data[pos:pos + 7] != b'trailer':
+                raise ValueError('Missing trailer')
+            section_trailer, _ = self.parser.parse(pos + 7)
+            if trailer is None:
+                trailer = section_trailer
+            offset = section_trailer.get('Prev')
+
+        for num, offset in offsets.items():
+            if not _OBJ.match(data, offset):
+                raise ValueError('Cross-reference table points to wrong offset')
+        return offsets, trailer
+
+    def _read_xref_stream(self, pos, offsets):
+        """
+        Reads entries of a cross-reference stream at ``pos`` into ``offsets``
+        and :attr:`compressed`, entries of later sections take precedence.
+
+        Returns: stream dictionary, which is also the trailer
+        """
+        match = _OBJ.match(self.data, pos)
+        if match is None:
+            raise ValueError('Malformed cross-reference stream')
+        stream = self._read_at(match)
+        if not isinstance(stream, Stream) or stream.dictionary.get('Type') != 'XRef':
+            raise ValueError('Malformed cross-reference stream')
+
+        dictionary = stream.dictionary
+        widths = dictionary['W']
+        index = dictionary.get('Index', [0, dictionary['Size']])
+        rows = decode(stream)
+        pos = 0
+        for i in range(0, len(index) - 1, 2):
+            for num in range(index[i], index[i] + index[i + 1]):
+                fields = []
+                for width in widths:
+                    fields.append(int.from_bytes(rows[pos:pos + width], 'big'))
+                    pos += width
+                kind = fields[0] if widths[0] else 1
+                if num in offsets or num in self.compressed:
+                    continue
+                if kind == 1:
+                    offsets[num] = fields[1]
+                elif kind == 2:
+                    self.compressed[num] = (fields[1], fields[2])
+        return dictionary
+
+    def _scan(self):
+        data = self.data
+        offsets = {}
+        for match in _OBJ_ANYWHERE.finditer(data):
+            offsets[int(match.group(1))] = match.start()
+        pos = data.rfind(b'trailer')
+        if pos < 0:
+            raise IOError('Malformed PDF: no trailer found')
+        trailer, _ = self.parser.parse(pos + 7)
+        return offsets, trailer
+
+    def get(self, ref):
+        """Returns object for a reference, or the object itself if it isn't one"""
+        if not isinstance(ref, Ref):
+            return ref
+        if ref.num not in self._objects:
+            self._objects[ref.num] = self._read(ref.num)
+        return self._objects[ref.num]
+
+    def _read(self, num):
+        if num in self.compressed:
+            return self._read_compressed(num)
+        offset = self.offsets.get(num)
+        if offset is None:
+            return None
+        return self._read_at(_OBJ.match(self.data, offset))
+
+    def _read_compressed(self, num):
+        stream_num, index = self.compressed[num]
+        entry = self._object_streams.get(stream_num)
+        if entry is None:
+            stream = self.get(Ref(stream_num, 0))
+            if not isinstance(stream, Stream):
+                raise IOError('Malformed PDF: missing object stream %d' % stream_num)
+            data = decode(stream)
+            first = self.get(stream.dictionary['First'])
+            numbers = [int(value) for value in data[:first].split()]
+            positions = dict(zip(numbers[0::2], numbers[1::2]))
+            entry = self._object_streams[stream_num] = (Parser(data), first, positions)
+        parser, first, positions = entry
+        if num not in positions:
+            return None
+        return parser.parse(first + positions[num])[0]
+
+    def _read_at(self, match):
+        """Reads object which header was matched by ``_OBJ``"""
+        data = self.data
+        obj, pos = self.parser.parse(match.end())
+
+        pos = self.parser.skip(pos)
+        if isinstance(obj, dict) and data[pos:pos + 6] == b'stream':
+            pos += 6
+            if data[pos:pos + 2] == b'\r\n':
+                pos += 2
+            elif data[pos:pos + 1] in (b'\n', b'\r'):
+                pos += 1
+            length = self.get(obj.get('Length'))
+            end = pos + length if isinstance(length, int) else -1
+            if end < 0 or not re.match(br'\s*endstream', data[end:end + 20]):
+                end = _find(data, b'endstream', pos)
+                if data[end - 2:end] == b'\r\n':
+                    end -= 2
+                elif data[end - 1:end] in (b'\n', b'\r'):
+                    end -= 1
+            obj = Stream(obj, data[pos:end])
+        return obj
+
+    @property
+    def root(self):
+        return self.get(self.trailer['Root'])
+
+    def page_refs(self):
+        """
+        Returns references to page objects in document order. Attributes
+        inherited from the page tree are copied into page dictionaries.
+        """
+        pages = []
+
+        def walk(ref, inherited, depth):
+            node = self.get(ref)
+            if depth > 64 or not isinstance(node, dict):
+                raise IOError('Malformed PDF: broken page tree')
+            attrs = dict(inherited)
+            for key in ('Resources', 'MediaBox', 'CropBox', 'Rotate'):
+                if key in node:
+                    attrs[key] = node[key]
+            if node.get('Type') == 'Pages' or 'Kids' in node:
+                for kid in self.get(node['Kids']):
+                    walk(kid, attrs, depth + 1)
+            else:
+                for key, value in attrs.items():
+                    node.setdefault(key, value)
+                pages.append(ref)
+
+        walk(self.root['Pages'], {}, 0)
+        return pages
+
+    def named_destinations(self):
+        """Returns dict of named destinations, from name tree and old style /Dests"""
+        result = {}
+        root = self.root
+
+        dests = self.get(root.get('Dests'))
+        if isinstance(dests, dict):
+            for name, dest in dests.items():
+                result[name.encode('latin-1')] = dest
+
+        def walk(node, depth):
+            node = self.get(node)
+            if depth > 64 or not isinstance(node, dict):
+                return
+            names = self.get(node.get('Names', []))
+            for i in range(0, len(names) - 1, 2):
+                result[bytes(self.get(names[i]))] = names[i + 1]
+            for kid in self.get(node.get('Kids', [])):
+                walk(kid, depth + 1)
+
+        tree = self.get(self.get(root.get('Names', {})).get('Dests'))
+        if tree is not None:
+            walk(tree, 0)
+        return result
+
+
+def page_count(data):
+    """Returns number of pages of a PDF"""
+    doc = Document(data)
+    count = doc.get(doc.get(doc.root['Pages']).get('Count'))
+    if isinstance(count, int):
+        return count
+    return len(doc.page_refs())
+
+
+class Writer(object):
+    """Collects objects and writes a PDF"""
+
+    def __init__(self, version='1.4'):
+        self.version = version
+        self.objects = [None]
+
+    def reserve(self):
+        self.objects.append(None)
+        return Ref(len(self.objects) - 1, 0)
+
+    def set(self, ref, obj):
+        self.objects[ref.num] = obj
+
+    def add(self, obj):
+        ref = self.reserve()
+        self.set(ref, obj)
+        return ref
+
+    def get(self, ref):
+        return self.objects[ref.num]
+
+    def write(self, root, info=None, object_streams=False):
+        """Returns the PDF as bytes, see :meth:`chunks`"""
+        return b''.join(self.chunks(root, info, object_streams))
+
+    def chunks(self, root, info=None, object_streams=False, compress_level=6):
+        """
+        Generates the PDF in chunks.
+
+        :param object_streams: pack objects other than streams into compressed
+                               object streams and write a cross-reference
+                               stream, PDF 1.5 is required to read them
+        :param compress_level: zlib level of object and cross-reference streams
+        """
+        version = max(self.version, '1.5') if object_streams else self.version
+        header = b'%PDF-' + version.encode('ascii') + b'\n%\xe2\xe3\xcf\xd3\n'
+        yield header
+        position = len(header)
+
+        if not object_streams:
+            offsets = []
+            for num in range(1, len(self.objects)):
+                offsets.append(position)
+                chunk = b'%d 0 obj\n' % num + serialize(self.objects[num]) + b'\nendobj\n'
+                yield chunk
+                position += len(chunk)
+
+            trailer = {'Size': len(self.objects), 'Root': root}
+            if info is not None:
+                trailer['Info'] = info
+            yield (b'xref\n0 %d\n0000000000 65535 f \n' % len(self.objects)
+                   + b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+                   + b'trailer\n' + serialize(trailer) + b'\nstartxref\n%d\n%%%%EOF\n' % position)
+            return
+
+        # Cross-reference entries (type, field 2, field 3) by object number
+        entries = {0: (0, 0, 0xffff)}
+        packed = []
+        for num in range(1, len(self.objects)):
+            obj = self.objects[num]
+            if isinstance(obj, Stream):
+                entries[num] = (1, position, 0)
+                chunk = b'%d 0 obj\n' % num + serialize(obj) + b'\nendobj\n'
+                yield chunk
+                position += len(chunk)
+            else:
+                packed.append(num)
+
+        num = len(self.objects)
+        for start in range(0, len(packed), OBJECT_STREAM_SIZE):
+            group = packed[start:start + OBJECT_STREAM_SIZE]
+            index = []
+            bodies = []
+            offset = 0
+            for i, packed_num in enumerate(group):
+                body = serialize(self.objects[packed_num])
+                index.append(b'%d %d' % (packed_num, offset))
+                bodies.append(body)
+                offset += len(body) + 1
+                entries[packed_num] = (2, num, i)
+            first = b' '.join(index) + b'\n'
+            stream = Stream({'Type': Name('ObjStm'), 'N': len(group), 'First': len(first),
+                             'Filter': Name('FlateDecode')},
+                            zlib.compress(first + b'\n'.join(bodies), compress_level))
+            entries[num] = (1, position, 0)
+            chunk = b'%d 0 obj\n' % num + serialize(stream) + b'\nendobj\n'
+            yield chunk
+            position += len(chunk)
+            num += 1
+
+        entries[num] = (1, position, 0)
+        size = num + 1
+        width = max(1, (max(position, num).bit_length() + 7) // 8)
+        rows = b''.join(bytes([kind]) + field.to_bytes(width, 'big') + extra.to_bytes(2, 'big')
+                        for kind, field, extra in (entries.get(i, (0, 0, 0)) for i in range(size)))
+        trailer = {'Type': Name('XRef'), 'Size': size, 'W': [1, width, 2], 'Root': root,
+                   'Filter': Name('FlateDecode')}
+        if info is not None:
+            trailer['Info'] = info
+        stream = Stream(trailer, zlib.compress(rows, compress_level))
+        yield (b'%d 0 obj\n' % num + serialize(stream) + b'\nendobj\n'
+               + b'startxref\n%d\n%%%%EOF\n' % position)
+
+
+class _Copier(object):
+    """Copies objects reachable from given ones from a document to a writer"""
+
+    def __init__(self, doc, writer, mapping, rename):
+        self.doc = doc
+        self.writer = writer
+        self.mapping = mapping
+        self.rename = rename
+        self.pending = []
+
+    def ref(self, ref):
+        if ref.num not in self.mapping:
+            self.mapping[ref.num] = self.writer.reserve()
+            self.pending.append(ref)
+        return self.mapping[ref.num]
+
+    def value(self, obj, key=None):
+        if isinstance(obj, Ref):
+            return self.ref(obj)
+        if isinstance(obj, dict):
+            return dict((k, self.value(v, k)) for k, v in obj.items())
+        if isinstance(obj, list):
+            return [self.value(item) for item in obj]
+        if isinstance(obj, Stream):
+            return Stream(self.value(obj.dictionary), obj.data)
+        if isinstance(obj, String) and key in ('Dest', 'D'):
+            # Named destination
+            return self.rename(obj)
+        return obj
+
+    def run(self):
+        while self.pending:
+            ref = self.pending.pop()
+            obj = self.doc.get(ref)
+            if isinstance(obj, Stream):
+                obj.dictionary.pop('Length', None)
+            self.writer.set(self.mapping[ref.num], self.value(obj))
+
+
+def merge(pdfs):
+    """
+    Merges PDF documents into one, keeping pages, links, named destinations
+    and outlines of every part.
+
+    :param pdfs: iterable of bytes with PDF documents
+
+    Returns: bytes with merged PDF
+    """
+    writer = Writer()
+    catalog_ref = writer.reserve()
+    pages_ref = writer.reserve()
+    outlines_ref = writer.reserve()
+
+    kids = []
+    outline_items = []
+    outline_count = 0
+    destinations = {}
+    info = None
+    page_mode = None
+    version = '1.4'
+
+    for index, data in enumerate(pdfs):
+        doc = Document(data)
+        version = max(version, doc.version)
+        root = doc.root
+        page_refs = doc.page_refs()
+        names = doc.named_destinations()
+        prefix = b'p%d-' % index
+
+        def rename(name, names=names, prefix=prefix):
+            return String(prefix + name) if name in names else name
+
+        mapping = {}
+        copier = _Copier(doc, writer, mapping, rename)
+
+        outlines = doc.get(root.get('Outlines'))
+        if isinstance(outlines, dict) and 'First' in outlines:
+            # Top level items get the merged root as parent
+            mapping[root['Outlines'].num] = outlines_ref
+
+        # Pages are copied without their parents, links to pages of the same
+        # part resolve to the new page objects
+        for ref in page_refs:
+            mapping[ref.num] = writer.reserve()
+        for ref in page_refs:
+            page = dict(doc.get(ref))
+            page.pop('Parent', None)
+            page = copier.value(page)
+            page['Parent'] = pages_ref
+            writer.set(mapping[ref.num], page)
+            kids.append(mapping[ref.num])
+
+        for name, dest in names.items():
+            destinations[prefix + name] = copier.value(dest)
+
+        if isinstance(outlines, dict) and 'First' in outlines:
+            first, last = copier.ref(outlines['First']), copier.ref(outlines['Last'])
+            copier.run()
+            if outline_items:
+                previous = outline_items[-1]
+                writer.get(previous)['Next'] = first
+                writer.get(first)['Prev'] = previous
+            item = first
+            while item is not None and len(outline_items) < len(writer.objects):
+                outline_items.append(item)
+                item = writer.get(item).get('Next') if item != last else None
+            count = doc.get(outlines.get('Count'))
+            outline_count += abs(count) if isinstance(count, int) else 0
+            page_mode = page_mode or root.get('PageMode')
+
+        copier.run()
+
+        if info is None and 'Info' in doc.trailer:
+            info = copier.ref(doc.trailer['Info'])
+            copier.run()
+
+    writer.version = version
+    writer.set(pages_ref, {'Type': Name('Pages'), 'Kids': kids, 'Count': len(kids)})
+
+    catalog = {'Type': Name('Catalog'), 'Pages': pages_ref}
+    if outline_items:
+        writer.set(outlines_ref, {'Type': Name('Outlines'), 'First': outline_items[0],
+                                  'Last': outline_items[-1],
+                                  'Count': outline_count or len(outline_items)})
+        catalog['Outlines'] = outlines_ref
+        if page_mode is not None:
+            catalog['PageMode'] = page_mode
+    else:
+        writer.set(outlines_ref, None)
+    if destinations:
+        flat = []
+        for name in sorted(destinations):
+            flat.extend([String(name), destinations[name]])
+        catalog['Names'] = {'Dests': writer.add({'Names': flat})}
+    writer.set(catalog_ref, catalog)
+
+    return writer.write(catalog_ref, info)
@@ -1,12 +1,133 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import itertools
+import os
 import re
-import subprocess
+import signal
+import stat
 import sys
+import time
 from collections import OrderedDict
-from .source import Source
-from .configuration import Configuration
+from pathlib import Path
+from .source import Source, BYTES_TYPES, unicode, splice
+from .configuration import Configuration, cached_configuration
+from .cache import cache_key
+from .css import stylesheets
+from . import backends, instrumentation
 import io
-import codecs
+
+
+_HEAD_END = re.compile(b'</head>')
+
+# Bytes read from the start of output to check its signature
+_HEAD_SIZE = 4
+# Bytes read from the end of output to look for %%EOF marker
+_TAIL_SIZE = 1024
+
+# Arguments followed by path of a file wkhtmltopdf reads, contents of these
+# files are part of cache keys
+_FILE_ARGS = frozenset(['cover', '--header-html', '--footer-html', '--user-style-sheet',
+                        '--xsl-style-sheet'])
+
+
+def _is_sink(output):
+    """Whether output is an open file, socket or file descriptor and not a path"""
+    return (isinstance(output, int) and not isinstance(output, bool)
+            or hasattr(output, 'write') or hasattr(output, 'fileno'))
+
+
+def _output_fd(sink):
+    """
+    Returns file descriptor of an output sink or None if it doesn't have one
+    (e.g. ``io.BytesIO``). Buffered data of file objects is flushed first.
+    """
+    if isinstance(sink, int):
+        return sink
+    try:
+        fd = sink.fileno()
+    except (AttributeError, io.UnsupportedOperation, OSError, ValueError):
+        return None
+    flush = getattr(sink, 'flush', None)
+    if flush is not None:
+        flush()
+    return fd
+
+
+class _FdOutput(object):
+    """
+    Output written by wkhtmltopdf straight to a file descriptor. Regular files
+    can be read back for validation, pipes and sockets can't.
+    """
+
+    def __init__(self, fd, name=None):
+        self.fd = fd
+        self.name = name if isinstance(name, str) else None
+        try:
+            self.start = os.lseek(fd, 0, os.SEEK_CUR) if stat.S_ISREG(os.fstat(fd).st_mode) else None
+        except OSError:
+            self.start = None
+
+    def size(self):
+        if self.start is None:
+            return None
+        return os.lseek(self.fd, 0, os.SEEK_CUR) - self.start
+
+    def read_ends(self, tail_size):
+        """Returns first _HEAD_SIZE and last ``tail_size`` bytes written, or (None, None)"""
+        if self.start is None:
+            return None, None
+        end = os.lseek(self.fd, 0, os.SEEK_CUR)
+        tail_start = max(end - tail_size, self.start)
+        try:
+            return (os.pread(self.fd, _HEAD_SIZE, self.start),
+                    os.pread(self.fd, end - tail_start, tail_start))
+        except (AttributeError, OSError):
+            # Opened write-only or no pread on this platform
+            if self.name is None:
+                return None, None
+            with open(self.name, 'rb') as f:
+                f.seek(self.start)
+                head = f.read(_HEAD_SIZE)
+                f.seek(tail_start)
+                return head, f.read(end - tail_start)
+
+
+def _read_ends(path, tail_size):
+    """Returns first _HEAD_SIZE and last ``tail_size`` bytes of output"""
+    if isinstance(path, _FdOutput):
+        return path.read_ends(tail_size)
+    with open(path, 'rb') as f:
+        head = f.read(_HEAD_SIZE)
+        size = f.seek(0, os.SEEK_END)
+        f.seek(max(size - tail_size, 0))
+        return head, f.read()
+
+_meta_patterns_cache = {}
+
+
+def _meta_patterns(prefix, binary=False):
+    """
+    Returns compiled (tag, name, content) patterns for given meta tag prefix.
+
+    Tag pattern matches meta tags and also the end of head or start of body,
+    after which no more meta tags are expected.
+    """
+    key = (prefix, binary)
+    patterns = _meta_patterns_cache.get(key)
+    if patterns is None:
+        sources = [r'(?P<meta><meta\s[^>]*>)|</head\s*>|<body[\s>]',
+                   r'name=["\']%s([^"\']*)' % re.escape(prefix),
+                   r'content=["\']([^"\']*)']
+        if binary:
+            sources = [p.encode('utf-8') for p in sources]
+        compiled = [re.compile(sources[0], re.IGNORECASE)]
+        compiled += [re.compile(p) for p in sources[1:]]
+        patterns = _meta_patterns_cache[key] = tuple(compiled)
+    return patterns
+
+
+def _to_text(value):
+    return value if isinstance(value, unicode) else unicode(value, 'utf-8', 'replace')
 
 
 class PDFKit(object):
@@ -14,12 +135,17 @@ class PDFKit(object):
     Main class that does all generation routine.
 
     :param url_or_file: str - either a URL, a path to a file or a string containing HTML
-                       to convert
+                       to convert. For 'string' type HTML can be also given as bytes,
+                       bytearray, memoryview, file-like object or iterable of
+                       str/bytes chunks, it is piped to wkhtmltopdf in chunks
     :param type_: str - either 'url', 'file' or 'string'
     :param options: dict (optional) with wkhtmltopdf options, with or w/o '--'
     :param toc: dict (optional) - toc-specific wkhtmltopdf options, with or w/o '--'
     :param cover: str (optional) - url/filename with a cover html page
     :param configuration: (optional) instance of pdfkit.configuration.Configuration()
+    :param cache: (optional) instance of pdfkit.cache.RenderCache() used by to_pdf
+    :param optimize: (optional) 'fast', 'size' or True for 'fast', optimize size of
+                     PDF after rendering with :func:`pdfkit.optimizer.optimize_pdf`
     """
 
     class ImproperSourceError(Exception):
@@ -31,11 +157,25 @@ class PDFKit(object):
         def __str__(self):
             return self.msg
 
+    class InvalidOption(IOError):
+        """Option is not supported by wkhtmltopdf binary or used in a wrong place"""
+
+    class RenderTimeout(IOError):
+        """wkhtmltopdf didn't finish in given time and was killed"""
+
+        def __init__(self, timeout, stderr):
+            self.timeout = timeout
+            self.stderr = stderr
+            super(PDFKit.RenderTimeout, self).__init__(
+                'wkhtmltopdf did not finish in {0} seconds and was killed. '
+                'error:\n{1}'.format(timeout, stderr))
+
     def __init__(self, url_or_file, type_, options=None, toc=None, cover=None,
-                 css=None, configuration=None, cover_first=False, verbose=False):
+                 css=None, configuration=None, cover_first=False, verbose=False,
+                 cache=None, parallel=None, prefetch=None, priority=None, optimize=None):
 
         self.source = Source(url_or_file, type_)
-        self.configuration = (Configuration() if configuration is None
+        self.configuration = (cached_configuration() if configuration is None
                               else configuration)
         try:
             self.wkhtmltopdf = self.configuration.wkhtmltopdf.decode('utf-8')
@@ -43,8 +183,9 @@ class PDFKit(object):
             self.wkhtmltopdf = self.configuration.wkhtmltopdf
 
         self.options = OrderedDict()
-        if self.source.isString():
-            self.options.update(self._find_options_in_meta(url_or_file))
+        if self.source.isString() and self.configuration.meta_tags:
+            self.options.update(self._find_options_in_meta(
+                self.source.peek() if self.source.isStream() else url_or_file))
 
         self.environ = self.configuration.environ
 
@@ -57,14 +198,37 @@ class PDFKit(object):
         self.verbose = verbose
         self.css = css
         self.stylesheets = []
-
-    def _genargs(self, opts):
+        self.cache = cache
+        self.parallel = parallel
+        self.prefetch = prefetch
+        self.priority = priority
+        self.optimize = optimize
+        # :class:`pdfkit.optimizer.OptimizeResult` of last optimized output, without data
+        self.optimize_stats = None
+        # <style> tag with CSS, inserted into input while it is piped to wkhtmltopdf
+        self._style = None
+        self._options_argv = None
+        self.render_stats = None
+
+    def _genargs(self, opts, toc=False):
         """
         Generator of args parts based on options specification.
 
+        Options are checked against options supported by wkhtmltopdf binary, if
+        it could be probed, so bad options fail before wkhtmltopdf is started.
+
+        :param toc: whether options are given for TOC object
+
         Note: Empty parts will be filtered out at _command generator
         """
+        capabilities = self._capabilities()
+
         for optkey, optval in self._normalize_options(opts):
+            if capabilities is not None:
+                error = capabilities.check(optkey, optval, toc)
+                if error is not None:
+                    raise self.InvalidOption(error)
+
             yield optkey
 
             if isinstance(optval, (list, tuple)):
@@ -74,19 +238,25 @@ class PDFKit(object):
             else:
                 yield optval
 
-    def _command(self, path=None):
-        """
-        Generator of all command parts
-        """
-        if self.css:
-            self._prepend_css(self.css)
+    def _capabilities(self):
+        """Returns capabilities of the binary options are checked against, or None"""
+        return getattr(self.configuration, 'capabilities', lambda: None)()
 
-        yield self.wkhtmltopdf
+    def _binary_identity(self):
+        """Returns identity of the binary for cache keys"""
+        return self.configuration.binary_identity()
 
+    def _options_args(self):
+        """
+        Generator of command parts between binary and input: global and page
+        options, cover and TOC
+        """
+        options = self.options
         if not self.verbose:
-            self.options.update({'--quiet': ''})
+            options = OrderedDict(options)
+            options['--quiet'] = ''
 
-        for argpart in self._genargs(self.options):
+        for argpart in self._genargs(options):
             if argpart:
                 yield argpart
 
@@ -96,7 +266,7 @@ class PDFKit(object):
 
         if self.toc:
             yield 'toc'
-            for argpart in self._genargs(self.toc):
+            for argpart in self._genargs(self.toc, toc=True):
                 if argpart:
                     yield argpart
 
@@ -104,9 +274,32 @@ class PDFKit(object):
             yield 'cover'
             yield self.cover
 
+    def _command(self, path=None):
+        """
+        Generator of all command parts
+        """
+        if self.css and self._style is None:
+            self._prepend_css(self.css)
+
+        yield self.wkhtmltopdf
+
+        # Let wkhtmltopdf read subresources rewritten to local files
+        for directory in self._allowed_directories():
+            yield '--allow'
+            yield directory
+
+        # Options part may be precompiled by RenderTemplate
+        if self._options_argv is not None:
+            for argpart in self._options_argv:
+                yield argpart
+        else:
+            for argpart in self._options_args():
+                yield argpart
+
         # If the source is a string then we will pipe it into wkhtmltopdf
-        # If the source is file-like then we will read from it and pipe it in
-        if self.source.isString() or self.source.isFileObj():
+        # If the source is file-like or CSS is added to a file then we will read
+        # from it and pipe it in
+        if self._pipes_input():
             yield '-'
         else:
             if isinstance(self.source.source, str):
@@ -140,57 +333,91 @@ class PDFKit(object):
 
         if 'cannot connect to X server' in stderr:
             raise IOError('%s\n'
-                          'You will need to run wkhtmltopdf within a "virtual" X server.\n'
+                          'You will need to run wkhtmltopdf within a "virtual" X server,\n'
+                          'e.g. with pool of Xvfb servers started by xvfb configuration option.\n'
                           'Go to the link below for more information\n'
                           'https://github.com/JazzCore/python-pdfkit/wiki/Using-wkhtmltopdf-without-X-server' % stderr)
 
         if 'Error' in stderr:
             raise IOError('wkhtmltopdf reported an error:\n' + stderr)
 
+        if exit_code is not None and exit_code == -getattr(signal, 'SIGXCPU', 0):
+            raise IOError('wkhtmltopdf exceeded CPU time limit and was killed. error:\n' + stderr)
+
         error_msg = stderr or 'Unknown Error'
         raise IOError("wkhtmltopdf exited with non-zero code {0}. error:\n{1}".format(exit_code, error_msg))
 
-    def to_pdf(self, path=None):
-        args = self.command(path)
-
-        if sys.platform == 'win32':
-            # hide cmd window
-            startupinfo = subprocess.STARTUPINFO()
-            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-            startupinfo.wShowWindow = subprocess.SW_HIDE
-
-            result = subprocess.Popen(
-                args,
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                env=self.environ,
-                startupinfo=startupinfo
-            )
-        else:
-            result = subprocess.Popen(
-                args,
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                env=self.environ
-            )
+    def _timeout(self, timeout):
+        return getattr(self.configuration, 'timeout', None) if timeout is None else timeout
 
+    def _stdin_chunks(self):
+        """
+        Returns iterator of bytes chunks to pipe into wkhtmltopdf or None if it
+        reads input by itself
+        """
         # If the source is a string then we will pipe it into wkhtmltopdf.
         # If we want to add custom CSS to file then we read input file to
         # string and prepend css to it and then pass it to stdin.
         # This is a workaround for a bug in wkhtmltopdf (look closely in README)
-        if self.source.isString() or (self.source.isFile() and self.css):
-            input = self.source.to_s().encode('utf-8')
-        elif self.source.isFileObj():
-            input = self.source.source.read().encode('utf-8')
+        if self._pipes_input():
+            chunks = self.source.chunks()
+            if self._style is not None:
+                chunks = self._css_chunks(chunks)
+            if self._prefetches():
+                chunks = self._prefetch_chunks(chunks)
+            return chunks
         else:
-            input = None
-
-        stdout, stderr = result.communicate(input=input)
+            return None
+
+    def _pipes_input(self):
+        """Whether input is piped to wkhtmltopdf stdin"""
+        return (self.source.isString() or self.source.isFileObj()
+                or (self.source.isFile() and (self.css or self._prefetches())))
+
+    def _prefetches(self):
+        """Whether subresources of input are fetched by :attr:`prefetch` cache"""
+        return self.prefetch is not None and (
+            self.source.isString() or isinstance(self.source.source, str)
+            or self.source.isFileObj())
+
+    def _base_url(self):
+        """URL of an input file, references relative to it are made absolute"""
+        if self.source.isFile() and not self.source.isFileObj():
+            return Path(os.path.abspath(self.source.source)).as_uri()
+        return None
+
+    def _allowed_directories(self):
+        if not self._prefetches():
+            return []
+        directories = [self.prefetch.directory]
+        if self._base_url() is not None:
+            directories.append(os.path.dirname(os.path.abspath(self.source.source)))
+        return directories
+
+    def _input_size(self):
+        """Size of input in bytes (characters for str) or None if unknown"""
+        source = self.source.source
+        if self.source.isFile() and not self.source.isFileObj():
+            try:
+                return sum(os.path.getsize(p) for p in (source if isinstance(source, list) else [source]))
+            except OSError:
+                return None
+        if isinstance(source, unicode):
+            return len(source)
+        if self.source.isBytes():
+            return memoryview(source).nbytes
+        return None
+
+    def _prefetch_chunks(self, chunks):
+        """Generates input with subresources rewritten to cached files"""
+        return self.prefetch.rewrite_chunks(chunks, self._base_url())
+
+    def _finish(self, args, path, stdout, stderr, exit_code):
+        """
+        Checks results of a finished wkhtmltopdf run and returns PDF or True
+        """
         stderr = stderr or stdout or b""
         stderr = stderr.decode('utf-8', errors='replace')
-        exit_code = result.returncode
         self.handle_error(exit_code, stderr)
 
         # Since wkhtmltopdf sends its output to stderr we will capture it
@@ -202,18 +429,348 @@ class PDFKit(object):
             return stdout
 
         try:
-            with codecs.open(path, encoding='utf-8') as f:
-                # read 4 bytes to get PDF signature '%PDF'
-                text = f.read(4)
-                if text == '':
-                    raise IOError('Command failed: %s\n'
-                                  'Check whhtmltopdf output without \'quiet\' '
-                                  'option' % ' '.join(args))
-                return True
+            head, tail = _read_ends(path, _TAIL_SIZE)
         except (IOError, OSError) as e:
             raise IOError('Command failed: %s\n'
                           'Check whhtmltopdf output without \'quiet\' option\n'
                           '%s ' % (' '.join(args), e))
+        self._check_pdf(args, head, tail)
+        return True
+
+    def _check_pdf(self, args, head, tail):
+        """
+        Checks that output starts with '%PDF' signature and, if ``check_eof``
+        configuration option is set, that its trailer ends with '%%EOF'. Parts
+        given as None can't be read and are not checked.
+        """
+        if head is not None and head != b'%PDF':
+            raise IOError('Command failed: %s\n'
+                          'Check whhtmltopdf output without \'quiet\' '
+                          'option' % ' '.join(args))
+        if (tail is not None and getattr(self.configuration, 'check_eof', False)
+                and b'%%EOF' not in tail):
+            raise IOError('Command failed: %s\n'
+                          'PDF is truncated, %%%%EOF marker not found' % ' '.join(args))
+
+    def to_pdf(self, path=None, timeout=None):
+        """
+        Converts source to PDF document
+
+        :param path: (optional) path to output PDF file or an output sink: open file,
+                     socket or file descriptor. Sinks with a file descriptor are
+                     passed to wkhtmltopdf as its stdout, so PDF doesn't pass through
+                     Python. By default, PDF will be returned.
+        :param timeout: (optional) seconds to wait for wkhtmltopdf before killing it
+                        and raising :class:`RenderTimeout`, defaults to
+                        ``timeout`` of configuration
+
+        Returns: PDF or True on success if path is given
+        """
+        timeout = self._timeout(timeout)
+
+        if _is_sink(path):
+            return self._to_sink(path, timeout)
+
+        result = self._render_pdf(path, timeout)
+        if self.optimize:
+            result = self._optimize_output(path, result)
+        return result
+
+    def _render_pdf(self, path, timeout):
+        if self.parallel and (self.source.isUrl() or self.source.isFile()):
+            from . import parallel
+            result = parallel.render(self, path, timeout)
+            if result is not None:
+                return result
+
+        args = self.command(path)
+
+        if self.cache is not None and not self.source.isUrl():
+            return self._to_pdf_cached(args, path, timeout)
+
+        stdout = b''.join(self._run(args, self._stdin_chunks(), path, timeout=timeout))
+        if not path:
+            self._check_pdf(args, stdout[:_HEAD_SIZE], stdout[-_TAIL_SIZE:])
+
+        return True if path else stdout
+
+    def _optimize_output(self, path, result):
+        """
+        Runs :mod:`pdfkit.optimizer` on rendered PDF, in place for output file
+        """
+        from . import optimizer
+        if path:
+            stats = optimizer.optimize_file(path, mode=self.optimize)
+        else:
+            stats = optimizer.optimize_pdf(result, mode=self.optimize)
+            result = stats.data
+        self.optimize_stats = stats._replace(data=None)
+        return result
+
+    def _to_sink(self, sink, timeout):
+        """
+        Renders into an output sink. If it has a file descriptor wkhtmltopdf
+        writes to it directly, otherwise PDF is rendered to memory and written to
+        the sink.
+        """
+        fd = _output_fd(sink)
+        if fd is None or self.cache is not None or self.parallel or self.optimize:
+            pdf = self.to_pdf(timeout=timeout)
+            if fd is None:
+                sink.write(pdf)
+            else:
+                backends.write_fd(fd, pdf)
+            return True
+
+        args = self.command()
+        output = _FdOutput(fd, getattr(sink, 'name', None))
+        for _ in self._run(args, self._stdin_chunks(), output, timeout=timeout, stdout=fd):
+            pass
+        return True
+
+    def _cache_files(self, args, chunks):
+        """
+        Returns list of local files wkhtmltopdf reads by itself for a command:
+        input files unless input is piped, and cover page, TOC stylesheet,
+        header and footer given by path
+        """
+        files = []
+        if chunks is None and self.source.isFile():
+            files = self.source.source if isinstance(self.source.source, list) else [self.source.source]
+        return files + [value for arg, value in zip(args, args[1:])
+                        if arg in _FILE_ARGS and os.path.isfile(value)]
+
+    def _to_pdf_cached(self, args, path, timeout):
+        """
+        Looks up rendered PDF in cache and runs wkhtmltopdf only on a miss.
+
+        Input is read once into memory, as it is needed both for the cache key
+        and for wkhtmltopdf. Local files referenced by arguments, like a cover
+        page, are hashed into the key as well.
+        """
+        chunks = self._stdin_chunks()
+        chunks = [bytes(chunk) for chunk in chunks] if chunks is not None else None
+        files = self._cache_files(args, chunks)
+
+        key = cache_key(args[:-1] + ['-'], self._binary_identity(), chunks, files)
+        pdf = self.cache.get(key)
+
+        if pdf is None:
+            pdf = b''.join(self._run(args, chunks, path, timeout=timeout))
+            if path:
+                with open(path, 'rb') as f:
+                    pdf = f.read()
+            else:
+                self._check_pdf(args, pdf[:_HEAD_SIZE], pdf[-_TAIL_SIZE:])
+            self.cache.set(key, pdf)
+        elif path:
+            with open(path, 'wb') as f:
+                f.write(pdf)
+
+        return True if path else pdf
+
+    def iter_pdf(self, chunk_size=64 * 1024, timeout=None):
+        """
+        Generates PDF in chunks as wkhtmltopdf writes them to stdout, so the whole
+        document is never held in memory.
+
+        Errors are checked with :meth:`handle_error` when the process exits, i.e.
+        after all chunks were yielded. Closing the generator early kills
+        wkhtmltopdf.
+
+        With ``optimize`` the output is collected first, as the whole PDF is
+        needed to optimize it, and optimized PDF is generated in chunks.
+
+        :param chunk_size: (optional) max size of yielded chunks in bytes
+        :param timeout: (optional) seconds to wait for wkhtmltopdf, see :meth:`to_pdf`
+        """
+        if self.optimize:
+            pdf = self.to_pdf(timeout=timeout)
+            for pos in range(0, len(pdf), chunk_size):
+                yield pdf[pos:pos + chunk_size]
+            return
+
+        args = self.command()
+        yield from self._run(args, self._stdin_chunks(), chunk_size=chunk_size,
+                             timeout=self._timeout(timeout))
+
+    def _run(self, args, stdin, path=None, chunk_size=64 * 1024, timeout=None, stdout=None):
+        """
+        Runs wkhtmltopdf with configured backend and generates chunks of its stdout.
+
+        :param stdin: iterable of bytes to pipe to wkhtmltopdf or None
+        :param timeout: seconds after which wkhtmltopdf is killed
+        :param stdout: file descriptor to pass to wkhtmltopdf as stdout, nothing
+                       is generated then
+
+        Results are checked when the process exits. If render hooks are registered,
+        phase timings and resource usage are passed to them.
+        """
+        scheduler = getattr(self.configuration, 'scheduler', None)
+        ticket = scheduler.acquire(self.priority, self._input_size()) if scheduler is not None else None
+        xvfb = getattr(self.configuration, 'xvfb', None)
+        display = None
+        stats = None
+        try:
+            # Stats are also collected for adaptive concurrency of scheduler
+            if instrumentation.enabled() or (ticket is not None and scheduler.controller is not None):
+                stats = instrumentation.RenderStats(args)
+            if stats is not None and ticket is not None:
+                stats.queue_time = ticket.wait_time
+            if xvfb is not None:
+                display = xvfb.acquire()
+
+            execution = self.configuration.backend.start(
+                args, stdin, env=self._environ(display), timeout=timeout, chunk_size=chunk_size,
+                stats=stats, stdout=stdout)
+
+            try:
+                for chunk in execution:
+                    if stats is not None:
+                        if stats.first_output is None:
+                            stats.first_output = time.monotonic()
+                        stats.output_bytes += len(chunk)
+                    yield chunk
+            finally:
+                execution.close()
+        finally:
+            if display is not None:
+                xvfb.release(display)
+            if ticket is not None:
+                scheduler.release(ticket, stats)
+        eof = time.monotonic()
+
+        self._check_execution(args, path, stats, eof, execution.stderr,
+                              execution.exit_code, timeout, execution.timed_out)
+
+    def _environ(self, display):
+        """Environment of wkhtmltopdf, with ``DISPLAY`` of a leased Xvfb server"""
+        if display is None:
+            return self.environ
+        return dict(self.environ, DISPLAY=display)
+
+    def _check_execution(self, args, path, stats, eof, stderr, exit_code, timeout, timed_out):
+        """
+        Checks results of a finished wkhtmltopdf run and reports them to render hooks
+        """
+        if stats is None:
+            self._check_run(args, path, stderr, exit_code, timeout, timed_out)
+            return
+
+        exited = time.monotonic()
+        stats.exit_code = exit_code
+        if stats.first_output is not None:
+            stats.render_time = stats.first_output - stats.started
+            stats.drain_time = eof - stats.first_output
+        else:
+            stats.render_time = exited - stats.started
+        stats.exit_time = exited - eof
+
+        try:
+            self._check_run(args, path, stderr, exit_code, timeout, timed_out)
+            if isinstance(path, _FdOutput):
+                stats.output_bytes = path.size()
+            elif path:
+                stats.output_bytes = os.path.getsize(path)
+        except Exception as e:
+            stats.error = e
+            raise
+        finally:
+            now = time.monotonic()
+            stats.validation_time = now - exited
+            stats.total_time = now - stats.started
+            self.render_stats = stats
+            instrumentation.emit(stats)
+
+    def _check_run(self, args, path, stderr, exit_code, timeout, timed_out):
+        if timed_out:
+            self._discard_output(path)
+            raise self.RenderTimeout(timeout, stderr.decode('utf-8', errors='replace'))
+
+        self._finish(args, path, None, stderr, exit_code)
+
+    @staticmethod
+    def _discard_output(path):
+        """Removes partially written output file"""
+        if path and not isinstance(path, _FdOutput):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    async def to_pdf_async(self, path=None, timeout=None):
+        """
+        Coroutine version of :meth:`to_pdf`.
+
+        With default backend wkhtmltopdf is started with
+        ``asyncio.create_subprocess_exec`` so input and output pipes are served by
+        the running event loop. If the task is cancelled the child process is
+        killed. Renders with ``cache``, ``parallel`` or ``prefetch``, which
+        fetches subresources while input is generated, run like :meth:`to_pdf`
+        in the default executor of the loop.
+        """
+        timeout = self._timeout(timeout)
+        loop = asyncio.get_running_loop()
+        fd = None
+        if _is_sink(path):
+            fd = _output_fd(path)
+            if (fd is None or self.cache is not None or self.parallel or self.optimize
+                    or self._prefetches()):
+                pdf = await self.to_pdf_async(timeout=timeout)
+                if fd is None:
+                    path.write(pdf)
+                else:
+                    backends.write_fd(fd, pdf)
+                return True
+            path = _FdOutput(fd, getattr(path, 'name', None))
+            args = self.command()
+        elif self.cache is not None or self.parallel or self._prefetches():
+            # Cache lookups, parallel renders and prefetching block, like to_pdf they fall back
+            # to a single render when they don't apply
+            result = await loop.run_in_executor(None, self._render_pdf, path, timeout)
+            if self.optimize:
+                result = await loop.run_in_executor(None, self._optimize_output, path, result)
+            return result
+        else:
+            args = self.command(path)
+        scheduler = getattr(self.configuration, 'scheduler', None)
+        ticket = None
+        if scheduler is not None:
+            ticket = await scheduler.acquire_async(self.priority, self._input_size())
+        stats = None
+        if instrumentation.enabled() or (ticket is not None and scheduler.controller is not None):
+            stats = instrumentation.RenderStats(args)
+        if stats is not None and ticket is not None:
+            stats.queue_time = ticket.wait_time
+
+        xvfb = getattr(self.configuration, 'xvfb', None)
+        display = None
+        timed_out = False
+        try:
+            if xvfb is not None:
+                display = await xvfb.acquire_async()
+            stdout, stderr, exit_code = await self.configuration.backend.execute_async(
+                args, self._stdin_chunks(), env=self._environ(display), timeout=timeout, stats=stats,
+                stdout=fd)
+        except backends.ExecutionTimeout as e:
+            stdout, stderr, exit_code, timed_out = b'', e.stderr, None, True
+        finally:
+            if display is not None:
+                xvfb.release(display)
+            if ticket is not None:
+                scheduler.release(ticket, stats)
+
+        if stats is not None:
+            stats.output_bytes = len(stdout)
+        self._check_execution(args, path, stats, time.monotonic(), stderr, exit_code,
+                              timeout, timed_out)
+        if not path:
+            self._check_pdf(args, stdout[:_HEAD_SIZE], stdout[-_TAIL_SIZE:])
+
+        result = True if path else stdout
+        if self.optimize:
+            result = await loop.run_in_executor(None, self._optimize_output, path, result)
+        return result
 
     def _normalize_options(self, options):
         """ Generator of 2-tuples (option-key, option-value).
@@ -243,41 +800,41 @@ class PDFKit(object):
     def _normalize_arg(self, arg):
         return arg.lower()
 
-    def _style_tag_for(self, stylesheet):
-        return "<style>%s</style>" % stylesheet
-
     def _prepend_css(self, path):
-        if self.source.isUrl() or isinstance(self.source.source, list):
+        """
+        Reads CSS files, the style tag is added to input by :meth:`_stdin_chunks`
+        """
+        if self.source.isUrl() or (self.source.isFile() and isinstance(self.source.source, list)):
             raise self.ImproperSourceError('CSS files can be added only to a single '
                                            'file or string')
 
         if not isinstance(path, list):
             path = [path]
 
-        css_data = []
-        for p in path:
-            with codecs.open(p, encoding="UTF-8") as f:
-                css_data.append(f.read())
-        css_data = "\n".join(css_data)
-
-        if self.source.isFile():
-            with codecs.open(self.source.to_s(), encoding="UTF-8") as f:
-                inp = f.read()
-            self.source = Source(
-                inp.replace('</head>', self._style_tag_for(css_data) + '</head>'),
-                'string')
-
-        elif self.source.isString():
-            if '</head>' in self.source.to_s():
-                self.source.source = self.source.to_s().replace(
-                    '</head>', self._style_tag_for(css_data) + '</head>')
-            else:
-                self.source.source = self._style_tag_for(css_data) + self.source.to_s()
+        self._style = stylesheets.style_tag(path)
+
+    def _css_chunks(self, chunks):
+        """
+        Inserts style tag before ``</head>`` while input chunks are piped, so the
+        input is never copied as a whole. Strings without ``</head>`` get the tag
+        prepended, files are left as is.
+        """
+        if self.source.isString() and not self._has_head():
+            return itertools.chain([self._style], chunks)
+        return splice(chunks, b'</head>', self._style)
+
+    def _has_head(self):
+        source = self.source.source
+        if self.source.isStream():
+            return b'</head>' in self.source.peek(stops=(b'</head>',))
+        if isinstance(source, unicode):
+            return '</head>' in source
+        return _HEAD_END.search(source) is not None
 
     def _find_options_in_meta(self, content):
         """Reads 'content' and extracts options encoded in HTML meta tags
 
-        :param content: str or file-like object - contains HTML to parse
+        :param content: str, bytes or file-like object - contains HTML to parse
 
         returns:
           dict: {config option: value}
@@ -286,12 +843,20 @@ class PDFKit(object):
                 or content.__class__.__name__ == 'StreamReaderWriter'):
             content = content.read()
 
+        tag_re, name_re, content_re = _meta_patterns(
+            self.configuration.meta_tag_prefix, isinstance(content, BYTES_TYPES))
+
         found = {}
 
-        for x in re.findall('<meta [^>]*>', content):
-            if re.search('name=["\']%s' % self.configuration.meta_tag_prefix, x):
-                name = re.findall('name=["\']%s([^"\']*)' %
-                                  self.configuration.meta_tag_prefix, x)[0]
-                found[name] = re.findall('content=["\']([^"\']*)', x)[0]
+        # Meta tags can only be in a head, stop scanning where the body starts
+        for match in tag_re.finditer(content):
+            tag = match.group('meta')
+            if tag is None:
+                break
+
+            name = name_re.search(tag)
+            value = content_re.search(tag)
+            if name and value:
+                found[_to_text(name.group(1))] = _to_text(value.group(1))
 
         return found
@@ -0,0 +1,496 @@
+# -*- coding: utf-8 -*-
+"""
+Local cache of subresources referenced by HTML inputs.
+
+Before a string or file source is piped to wkhtmltopdf, absolute http(s)
+references in ``src`` attributes, stylesheet links, ``url()`` and ``@import``
+are fetched in parallel into a local directory and rewritten to ``file://``
+URLs, so fonts, logos and stylesheets shared by many documents are not
+downloaded again on every render. Stylesheets are rewritten the same way, so
+fonts they use are cached too.
+"""
+import bisect
+import hashlib
+import html
+import http.client
+import json
+import mimetypes
+import os
+import re
+import ssl
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urljoin, urlsplit, urlunsplit
+
+from .cache import _remove
+
+# Tags and attributes with references to subresources. Links of <a> and <area>
+# are kept, they are part of the document.
+_TAG = re.compile(rb'<([a-zA-Z][\w:-]*)(\s[^>]*)?>')
+_ATTRIBUTE = re.compile(
+    rb'''(?i)(?<![\w:-])([\w:-]+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))''')
+_SOURCE_ATTRIBUTES = (b'src', b'poster')
+_LINK_RELS = (b'stylesheet', b'icon')
+_CSS_URL = re.compile(rb'''(?i)url\(\s*(?:"([^"]*)"|'([^']*)'|([^\s"')]+))\s*\)''')
+_CSS_IMPORT = re.compile(rb'''(?i)@import\s+(?:"([^"]*)"|'([^']*)')''')
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+# Stylesheets importing stylesheets are followed this deep
+MAX_DEPTH = 3
+
+
+def references(data, css=False):
+    """
+    Finds references to subresources in HTML or CSS.
+
+    Returns: list of (start, end, reference, attribute) tuples, start and end
+             delimit the reference in ``data`` without quotes, ``attribute`` is
+             set for references in HTML attributes, which are HTML escaped
+    """
+    found = []
+    # References inside tags, including url() in style attributes, are in attributes
+    tags = [] if css else list(_TAG.finditer(data))
+    starts = [tag.start() for tag in tags]
+
+    def add(match, first=1):
+        for group in range(first, (match.lastindex or 0) + 1):
+            if match.group(group) is not None and match.group(group).strip():
+                start = match.start(group)
+                index = bisect.bisect_right(starts, start) - 1
+                attribute = index >= 0 and start < tags[index].end()
+                found.append((start, match.end(group), match.group(group), attribute))
+                return
+
+    if not css:
+        for tag in tags:
+            name = tag.group(1).lower()
+            if tag.group(2) is None or name in (b'a', b'area'):
+                continue
+            attributes = list(_ATTRIBUTE.finditer(data, tag.start(2), tag.end(2)))
+            if name == b'link':
+                rel = [a for a in attributes if a.group(1).lower() == b'rel']
+                rel = (rel[0].group(2) or rel[0].group(3) or rel[0].group(4) or b'').lower() if rel else b''
+                wanted = (b'href',) if any(r in rel for r in _LINK_RELS) else ()
+            else:
+                wanted = _SOURCE_ATTRIBUTES
+            for attribute in attributes:
+                if attribute.group(1).lower() in wanted:
+                    add(attribute, 2)
+
+    for pattern in (_CSS_URL, _CSS_IMPORT):
+        for match in pattern.finditer(data):
+            add(match)
+
+    found.sort()
+    return found
+
+
+def _file_url(path):
+    return Path(path).as_uri()
+
+
+class _ConnectionPool(object):
+    """Keep-alive HTTP(S) connections reused across requests, per host"""
+
+    def __init__(self, timeout=10, max_idle=4):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._context = ssl.create_default_context()
+
+    def _connect(self, key):
+        scheme, host, port = key
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, port, timeout=self.timeout,
+                                               context=self._context)
+        return http.client.HTTPConnection(host, port, timeout=self.timeout)
+
+    def _take(self, key):
+        with self._lock:
+            connections = self._idle.get(key)
+            if connections:
+                return connections.pop()
+        return None
+
+    def _put(self, key, connection):
+        with self._lock:
+            connections = self._idle.setdefault(key, [])
+            if len(connections) < self.max_idle:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def _send(self, key, target, headers):
+        connection = self._take(key)
+        if connection is not None:
+            try:
+                connection.request('GET', target, headers=headers)
+                return connection, connection.getresponse()
+            except (http.client.HTTPException, OSError):
+                # Idle connection was closed by the server, retry on a new one
+                connection.close()
+        connection = self._connect(key)
+        try:
+            connection.request('GET', target, headers=headers)
+            return connection, connection.getresponse()
+        except Exception:
+            connection.close()
+            raise
+
+    def get(self, url, headers=None, max_bytes=None):
+        """
+        Requests URL following redirects.
+
+        Returns: tuple (status, :class:`http.client.HTTPResponse`, body)
+        Raises: IOError on network errors or body larger than ``max_bytes``
+        """
+        headers = dict({'User-Agent': 'pdfkit', 'Accept-Encoding': 'identity'}, **(headers or {}))
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            key = (parts.scheme, parts.hostname, parts.port)
+            target = urlunsplit(('', '', parts.path or '/', parts.query, ''))
+            try:
+                connection, response = self._send(key, target, headers)
+                location = response.getheader('Location')
+                body = response.read(None if max_bytes is None else max_bytes + 1)
+            except (http.client.HTTPException, OSError) as e:
+                raise IOError('Failed to fetch %s: %s' % (url, e))
+
+            if max_bytes is not None and len(body) > max_bytes:
+                connection.close()
+                raise IOError('Failed to fetch %s: larger than %d bytes' % (url, max_bytes))
+            if response.will_close:
+                connection.close()
+            else:
+                self._put(key, connection)
+
+            if response.status in REDIRECT_CODES and location:
+                url = urljoin(url, location)
+                continue
+            return response.status, response, body
+
+        raise IOError('Failed to fetch %s: too many redirects' % url)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+class AssetCache(object):
+    """
+    Size bounded on-disk cache of subresources fetched over HTTP.
+
+    Entries are fresh for ``ttl`` seconds, after that they are revalidated with
+    ``If-None-Match``/``If-Modified-Since`` and downloaded again only if changed.
+    If a resource can't be fetched, a stale copy is used, or the reference is
+    left for wkhtmltopdf. Files are written atomically, so several processes can
+    share one directory.
+
+    :param directory: (optional) path to cache directory, ``pdfkit-assets`` in
+                      the temporary directory by default
+    :param max_bytes: (optional) size limit of cached files
+    :param ttl: (optional) seconds before an entry is revalidated
+    :param max_asset_bytes: (optional) resources larger than this are not cached
+    :param max_workers: (optional) max number of concurrent downloads
+    :param timeout: (optional) network timeout of requests in seconds
+    """
+
+    def __init__(self, directory=None, max_bytes=256 * 1024 * 1024, ttl=3600,
+                 max_asset_bytes=16 * 1024 * 1024, max_workers=8, timeout=10):
+        self.directory = os.path.abspath(
+            directory or os.path.join(tempfile.gettempdir(), 'pdfkit-assets'))
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_asset_bytes = max_asset_bytes
+        self.max_workers = max_workers
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.errors = 0
+
+        self._pool = _ConnectionPool(timeout)
+        self._lock = threading.Lock()
+        # Download threads, shared by all renders and started on first use
+        self._executor = None
+        self._local = threading.local()
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    def stats(self):
+        """Returns dict with hit, miss, revalidation and error counters"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'revalidated': self.revalidated,
+                'errors': self.errors,
+            }
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def rewrite(self, data, base_url=None):
+        """
+        Fetches subresources referenced by HTML and rewrites references to
+        cached files.
+
+        :param data: HTML as bytes
+        :param base_url: (optional) URL relative references are resolved against.
+                         With a ``file://`` base, relative references are made
+                         absolute so they work when HTML is piped to wkhtmltopdf.
+        Returns: rewritten HTML as bytes
+        """
+        return self._rewrite(data, base_url, css=False, depth=0)[0]
+
+    def rewrite_chunks(self, chunks, base_url=None):
+        """
+        Generator version of :meth:`rewrite` for HTML in chunks. Every chunk is
+        rewritten up to its last ``>``, only the rest, e.g. a tag split between
+        chunks, is held until the next one.
+
+        :param chunks: iterable of bytes-like chunks of HTML
+        :param base_url: (optional) see :meth:`rewrite`
+        Returns: generator of rewritten HTML chunks
+        """
+        pending = []
+        for chunk in chunks:
+            chunk = bytes(chunk)
+            end = chunk.rfind(b'>') + 1
+            if not end:
+                pending.append(chunk)
+                continue
+            pending.append(chunk[:end])
+            yield self.rewrite(b''.join(pending), base_url)
+            pending = [chunk[end:]]
+
+        data = b''.join(pending)
+        if data:
+            yield self.rewrite(data, base_url)
+
+    def _rewrite(self, data, base_url, css, depth):
+        """Returns rewritten data and list of URLs it references"""
+        found = []
+        for start, end, reference, attribute in references(data, css):
+            url = self._resolve(reference, base_url, attribute)
+            if url is not None:
+                found.append((start, end, url, attribute))
+        if not found:
+            return data, []
+
+        remote = list(dict.fromkeys(url for _, _, url, _ in found if not url.startswith('file:')))
+        paths = dict(zip(remote, self._map(lambda url: self.fetch(url, depth + 1), remote)))
+
+        parts = []
+        position = 0
+        for start, end, url, attribute in found:
+            if url.startswith('file:'):
+                replacement = url
+            elif paths.get(url) is not None:
+                replacement = _file_url(paths[url])
+            else:
+                continue
+            parts.append(data[position:start])
+            parts.append((html.escape(replacement) if attribute else replacement).encode('utf-8'))
+            position = end
+        parts.append(data[position:])
+        return b''.join(parts), remote
+
+    def _map(self, function, urls):
+        """
+        Returns results of function for URLs, run by the download threads.
+        Stylesheets are fetched by these threads, URLs they reference are
+        fetched by the same thread instead of waiting for a free one.
+        """
+        if len(urls) < 2 or getattr(self._local, 'worker', False):
+            return [function(url) for url in urls]
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix='pdfkit-prefetch')
+            executor = self._executor
+        return list(executor.map(lambda url: self._work(function, url), urls))
+
+    def _work(self, function, url):
+        self._local.worker = True
+        return function(url)
+
+    @staticmethod
+    def _resolve(reference, base_url, attribute=False):
+        """
+        Returns absolute URL of a reference worth rewriting or None. References
+        in HTML attributes are unescaped, CSS in stylesheets and ``<style>``
+        isn't HTML escaped.
+        """
+        reference = reference.strip().decode('utf-8', errors='replace')
+        if attribute:
+            reference = html.unescape(reference)
+        if reference.startswith('//'):
+            reference = 'https:' + reference
+        url = urljoin(base_url, reference) if base_url else reference
+        scheme = urlsplit(url).scheme.lower()
+        if scheme in ('http', 'https'):
+            return url
+        if scheme == 'file' and base_url and url != reference:
+            return url
+        return None
+
+    def _meta_path(self, url):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key + '.json')
+
+    def _read_meta(self, meta_path):
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            path = os.path.join(self.directory, meta['file'])
+            if os.path.exists(path):
+                return meta, path
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        return None, None
+
+    def _write(self, path, data):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except (IOError, OSError):
+            _remove(tmp)
+            raise
+
+    def fetch(self, url, depth=0):
+        """
+        Returns path to a cached copy of URL, downloading or revalidating it if
+        needed, or None if it can't be fetched
+        """
+        meta_path = self._meta_path(url)
+        meta, path = self._read_meta(meta_path)
+        now = time.time()
+
+        if meta is not None and now - meta['fetched'] < self.ttl:
+            self._count('hits')
+            self._touch(path, now)
+            self._fetch_dependencies(meta, depth)
+            return path
+
+        headers = {}
+        if meta is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        try:
+            status, response, body = self._pool.get(url, headers, self.max_asset_bytes)
+            if meta is not None and status == 304:
+                meta['fetched'] = now
+                self._write(meta_path, json.dumps(meta).encode('utf-8'))
+                self._count('revalidated')
+                self._touch(path, now)
+                self._fetch_dependencies(meta, depth)
+                return path
+            if status != 200:
+                raise IOError('Failed to fetch %s: HTTP %d' % (url, status))
+
+            self._count('misses')
+            content_type = (response.getheader('Content-Type') or '').split(';')[0].strip().lower()
+            name = os.path.basename(meta_path)[:-len('.json')] + _extension(url, content_type)
+            dependencies = []
+            if content_type == 'text/css' or name.endswith('.css'):
+                if depth < MAX_DEPTH:
+                    body, dependencies = self._rewrite(body, url, css=True, depth=depth)
+            path = os.path.join(self.directory, name)
+            self._write(path, body)
+            self._write(meta_path, json.dumps({
+                'url': url,
+                'file': name,
+                'fetched': now,
+                'etag': response.getheader('ETag'),
+                'last_modified': response.getheader('Last-Modified'),
+                'dependencies': dependencies,
+            }).encode('utf-8'))
+        except (IOError, OSError):
+            self._count('errors')
+            # Stale copy is better than fetching it again in wkhtmltopdf
+            return path
+
+        self._evict()
+        return path
+
+    def _fetch_dependencies(self, meta, depth):
+        """Fetches files used by a cached stylesheet again if they were evicted"""
+        if depth < MAX_DEPTH:
+            for url in meta.get('dependencies', ()):
+                self.fetch(url, depth + 1)
+
+    @staticmethod
+    def _touch(path, now):
+        try:
+            os.utime(path, (now, os.stat(path).st_mtime))
+        except OSError:
+            pass
+
+    def _entries(self):
+        try:
+            return [entry for entry in os.scandir(self.directory)
+                    if not entry.name.endswith(('.json', '.tmp'))]
+        except OSError:
+            return []
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for entry in self._entries():
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            entries.append((st.st_atime, st.st_size, entry.path))
+            total += st.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            _remove(path)
+            _remove(os.path.splitext(path)[0] + '.json')
+            total -= size
+
+    def clear(self):
+        """Removes all cached files"""
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError:
+            return
+        for entry in entries:
+            _remove(entry.path)
+
+    def close(self):
+        """Stops download threads and closes idle HTTP connections"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+        self._pool.close()
+
+
+def _extension(url, content_type):
+    """
+    Returns file extension for a cached resource. WebKit guesses type of local
+    files from their extension, so it is kept from URL or made from content type.
+    """
+    extension = os.path.splitext(urlsplit(url).path)[1]
+    if re.match(r'^\.[A-Za-z0-9]{1,8}$', extension):
+        return extension.lower()
+    return (mimetypes.guess_extension(content_type) if content_type else None) or '.bin'
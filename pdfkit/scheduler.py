@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import heapq
+import itertools
+import os
+import sys
+import threading
+import time
+
+
+class QueueFull(IOError):
+    """Queue of a priority class is full and the class rejects new renders"""
+
+
+class _Ticket(object):
+    """Render waiting for or holding a slot of :class:`RenderScheduler`"""
+
+    def __init__(self, priority, index, size, loop=None):
+        self.priority = priority
+        self.index = index
+        self.size = size
+        self.submitted = time.monotonic()
+        self.wait_time = None
+        # 'blocked' until admitted to the queue, then 'queued', 'running', 'done'
+        self.state = None
+        self.loop = loop
+        if loop is None:
+            self._event = threading.Event()
+        else:
+            self._future = loop.create_future()
+
+    def wake(self):
+        if self.loop is None:
+            self._event.set()
+        else:
+            self.loop.call_soon_threadsafe(_resolve, self._future)
+
+    def wait(self):
+        self._event.wait()
+
+    async def wait_async(self):
+        await self._future
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+def _physical_memory():
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def _load():
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return None
+
+
+class AIMDController(object):
+    """
+    Adjusts concurrency limit of :class:`RenderScheduler` from finished renders
+    with additive increase, multiplicative decrease.
+
+    The limit grows by one after a limit's worth of renders finished without
+    signs of overload, and is multiplied by ``decrease`` (at most once per
+    ``cooldown`` seconds) when a render took longer than ``target_latency``,
+    children would not fit into ``memory_limit`` with their average max RSS,
+    or system load is above ``max_load``.
+
+    :param min_concurrent: (optional) lowest limit
+    :param max_concurrent: (optional) highest limit, twice the number of CPUs by default
+    :param target_latency: (optional) seconds a render may take, latency is not
+                           checked by default as it depends on documents
+    :param memory_limit: (optional) bytes of memory for all children, 80% of
+                         physical memory by default
+    :param max_load: (optional) highest 1 minute load average, number of CPUs
+                     by default
+    :param decrease: (optional) factor the limit is multiplied by on overload
+    :param cooldown: (optional) min seconds between two decreases
+    """
+
+    def __init__(self, min_concurrent=1, max_concurrent=None, target_latency=None,
+                 memory_limit=None, max_load=None, decrease=0.5, cooldown=1.0):
+        cpus = os.cpu_count() or 1
+        self.min_concurrent = min_concurrent
+        self.max_concurrent = max_concurrent or 2 * cpus
+        self.target_latency = target_latency
+        physical = _physical_memory()
+        self.memory_limit = memory_limit or (int(physical * 0.8) if physical else None)
+        self.max_load = max_load or cpus
+        self.decrease = decrease
+        self.cooldown = cooldown
+
+        self.rss = None
+        self._credit = 0.0
+        self._last_decrease = None
+
+    def clamp(self, limit):
+        return max(self.min_concurrent, min(self.max_concurrent, limit))
+
+    def overloaded(self, limit, latency):
+        """Returns reason of overload or None"""
+        if self.target_latency is not None and latency is not None and latency > self.target_latency:
+            return 'latency'
+        if self.rss is not None and self.memory_limit and self.rss * limit > self.memory_limit:
+            return 'memory'
+        load = _load()
+        if load is not None and load > self.max_load:
+            return 'load'
+        return None
+
+    def update(self, limit, latency=None, max_rss=None):
+        """
+        Returns new limit after a render finished
+
+        :param limit: current limit
+        :param latency: seconds the render took
+        :param max_rss: max resident set size of the child as reported by OS
+                        (kilobytes, bytes on macOS)
+        """
+        if max_rss:
+            rss = max_rss if sys.platform == 'darwin' else max_rss * 1024
+            self.rss = rss if self.rss is None else 0.8 * self.rss + 0.2 * rss
+
+        now = time.monotonic()
+        if self.overloaded(limit, latency) is not None:
+            if self._last_decrease is not None and now - self._last_decrease < self.cooldown:
+                return limit
+            self._last_decrease = now
+            self._credit = 0.0
+            return self.clamp(int(limit * self.decrease))
+
+        if self.rss is not None and self.memory_limit and self.rss * (limit + 1) > self.memory_limit:
+            # One more child would not fit
+            return self.clamp(limit)
+        self._credit += 1.0 / limit
+        if self._credit >= 1:
+            self._credit -= 1
+            return self.clamp(limit + 1)
+        return self.clamp(limit)
+
+
+class RenderScheduler(object):
+    """
+    Runs wkhtmltopdf processes of a whole application under one concurrency
+    limit, starting waiting renders by priority class.
+
+    Renders wait in a queue per class. A freed slot goes to the oldest render of
+    the highest class, or to the one with the smallest input if
+    ``shortest_first`` is set (inputs of unknown size, e.g. URLs, go last). When
+    the queue of a class is full, new renders of that class either block until
+    it has room or fail with :class:`QueueFull`.
+
+    :param max_concurrent: (optional) max number of running wkhtmltopdf
+                           processes, number of CPUs by default
+    :param priorities: (optional) names of priority classes from highest to lowest
+    :param default_priority: (optional) class of renders without priority,
+                             the middle class by default
+    :param max_queue: (optional) max number of queued renders, int for all
+                      classes or dict class -> int. Unbounded by default
+    :param reject: (optional) True to raise :class:`QueueFull` instead of
+                   blocking when a queue is full, bool or dict class -> bool
+    :param shortest_first: (optional) order renders of a class by input size
+    :param controller: (optional) :class:`AIMDController` which adjusts
+                       ``max_concurrent`` from finished renders
+    """
+
+    PRIORITIES = ('interactive', 'normal', 'bulk')
+
+    def __init__(self, max_concurrent=None, priorities=PRIORITIES, default_priority=None,
+                 max_queue=None, reject=False, shortest_first=False, controller=None):
+        self.max_concurrent = max_concurrent or os.cpu_count() or 1
+        self.controller = controller
+        if controller is not None:
+            self.max_concurrent = controller.clamp(self.max_concurrent)
+        self.priorities = tuple(priorities)
+        self.default_priority = (self.priorities[len(self.priorities) // 2]
+                                 if default_priority is None else default_priority)
+        self._index(self.default_priority)
+        self.max_queue = [_per_class(max_queue, name) for name in self.priorities]
+        self.reject = [_per_class(reject, name) for name in self.priorities]
+        if any(limit is not None and limit < 1 for limit in self.max_queue):
+            raise ValueError('max_queue must be at least 1')
+        self.shortest_first = shortest_first
+
+        self._lock = threading.Lock()
+        self._running = 0
+        self._queue = []
+        self._sequence = itertools.count()
+        self._queued = [0] * len(self.priorities)
+        self._blocked = [[] for _ in self.priorities]
+
+        self._started = [0] * len(self.priorities)
+        self._rejected = [0] * len(self.priorities)
+        self._wait_total = [0.0] * len(self.priorities)
+        self._wait_max = [0.0] * len(self.priorities)
+
+    def _index(self, priority):
+        try:
+            return self.priorities.index(priority)
+        except ValueError:
+            raise ValueError('Unknown priority %r, expected one of: %s'
+                             % (priority, ', '.join(self.priorities)))
+
+    def stats(self):
+        """
+        Returns dict with gauges: running processes, queue depth and renders
+        blocked on a full queue per class, and per class counters of started
+        and rejected renders and their total and max wait time in seconds
+        """
+        with self._lock:
+            classes = {}
+            for i, name in enumerate(self.priorities):
+                classes[name] = {
+                    'queued': self._queued[i],
+                    'blocked': len(self._blocked[i]),
+                    'started': self._started[i],
+                    'rejected': self._rejected[i],
+                    'wait_time_total': self._wait_total[i],
+                    'wait_time_max': self._wait_max[i],
+                }
+            return {
+                'running': self._running,
+                'max_concurrent': self.max_concurrent,
+                'queued': sum(self._queued),
+                'classes': classes,
+            }
+
+    def _ticket(self, priority, size, loop=None):
+        priority = self.default_priority if priority is None else priority
+        return _Ticket(priority, self._index(priority), size, loop)
+
+    def acquire(self, priority=None, size=None):
+        """
+        Waits for a slot to run wkhtmltopdf.
+
+        :param priority: (optional) priority class name
+        :param size: (optional) input size in bytes used by ``shortest_first``
+        Returns: ticket to pass to :meth:`release`
+        Raises: :class:`QueueFull` if queue of the class is full and rejects renders
+        """
+        ticket = self._ticket(priority, size)
+        with self._lock:
+            self._enter(ticket)
+        if ticket.state != 'running':
+            ticket.wait()
+        return ticket
+
+    async def acquire_async(self, priority=None, size=None):
+        """
+        Coroutine version of :meth:`acquire`, waits without blocking the event
+        loop. A cancelled render leaves the queue.
+        """
+        ticket = self._ticket(priority, size, asyncio.get_running_loop())
+        with self._lock:
+            self._enter(ticket)
+        if ticket.state != 'running':
+            try:
+                await ticket.wait_async()
+            except asyncio.CancelledError:
+                self._cancel(ticket)
+                raise
+        return ticket
+
+    def release(self, ticket, stats=None):
+        """
+        Frees the slot of a finished render
+
+        :param stats: (optional) :class:`pdfkit.instrumentation.RenderStats` of
+                      the render for ``controller``
+        """
+        with self._lock:
+            if ticket.state != 'running':
+                return
+            ticket.state = 'done'
+            self._running -= 1
+            if self.controller is not None and stats is not None:
+                self.max_concurrent = self.controller.update(
+                    self.max_concurrent, time.monotonic() - stats.started, stats.max_rss)
+            self._dispatch()
+
+    def _cancel(self, ticket):
+        with self._lock:
+            if ticket.state == 'running':
+                # Slot was granted meanwhile
+                ticket.state = 'done'
+                self._running -= 1
+            elif ticket.state == 'queued':
+                ticket.state = 'done'
+                self._queued[ticket.index] -= 1
+            elif ticket.state == 'blocked':
+                ticket.state = 'done'
+                self._blocked[ticket.index].remove(ticket)
+            self._dispatch()
+
+    def _enter(self, ticket):
+        i = ticket.index
+        if self._running < self.max_concurrent and not any(self._queued):
+            self._start(ticket)
+        elif self.max_queue[i] is None or self._queued[i] < self.max_queue[i]:
+            self._push(ticket)
+        elif self.reject[i]:
+            self._rejected[i] += 1
+            raise QueueFull('Render queue of %r priority is full (%d renders)'
+                            % (ticket.priority, self._queued[i]))
+        else:
+            ticket.state = 'blocked'
+            self._blocked[i].append(ticket)
+
+    def _push(self, ticket):
+        if self.shortest_first:
+            key = float('inf') if ticket.size is None else ticket.size
+        else:
+            key = 0
+        ticket.state = 'queued'
+        self._queued[ticket.index] += 1
+        heapq.heappush(self._queue, (ticket.index, key, next(self._sequence), ticket))
+
+    def _start(self, ticket):
+        i = ticket.index
+        ticket.state = 'running'
+        ticket.wait_time = time.monotonic() - ticket.submitted
+        self._running += 1
+        self._started[i] += 1
+        self._wait_total[i] += ticket.wait_time
+        self._wait_max[i] = max(self._wait_max[i], ticket.wait_time)
+
+    def _dispatch(self):
+        """Starts queued renders while there are free slots"""
+        while True:
+            for i, blocked in enumerate(self._blocked):
+                while blocked and (self.max_queue[i] is None or self._queued[i] < self.max_queue[i]):
+                    self._push(blocked.pop(0))
+            if self._running >= self.max_concurrent or not self._queue:
+                return
+            ticket = heapq.heappop(self._queue)[-1]
+            if ticket.state != 'queued':
+                # Cancelled while waiting
+                continue
+            self._queued[ticket.index] -= 1
+            self._start(ticket)
+            ticket.wake()
+
+
+def _per_class(value, name):
+    return value.get(name) if isinstance(value, dict) else value
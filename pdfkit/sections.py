@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Documents made of sections rendered and cached one by one.
+
+Every section is rendered by its own wkhtmltopdf process and cached under a
+key of its content and the shared options, so rendering a new version of a
+document runs wkhtmltopdf only for sections that changed and merges cached
+partial PDFs with :func:`pdfkit.pdf.merge`. TOC and page numbers are fixed up
+across sections like in :mod:`pdfkit.parallel`.
+"""
+import json
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+
+from .batch import imap_bounded
+from .cache import RenderCache, cache_key
+from .parallel import (_grouped, numbered, read_outline, toc_html, HEADER_FOOTER_PREFIXES,
+                       MAX_TOC_PASSES, UNSUPPORTED_OPTIONS, UNSUPPORTED_TOC_OPTIONS)
+from .optimizer import optimize_pdf
+from .pdfkit import PDFKit
+from . import pdf
+
+
+class SectionedDocument(object):
+    """
+    Document rendered from a list of sections with incremental re-rendering.
+
+    Sections can be changed, added or removed between calls of :meth:`to_pdf`,
+    only sections whose content or command changed are rendered again. With
+    headers or footers showing page numbers, sections are rendered with
+    ``--page-offset``, so sections after one whose page count changed are
+    rendered again too. A changed section is then rendered twice, once to
+    count its pages and once with its offset, except the first section of a
+    document without TOC.
+
+    :param sections: list of HTML strings or bytes, or paths to HTML files with
+                     ``type_='file'``
+    :param type_: (optional) either 'string' or 'file'
+    :param options: (optional) dict with wkhtmltopdf options shared by all sections
+    :param toc: (optional) dict with TOC options, a TOC is added if not None
+    :param cover: (optional) url/filename with a cover html page
+    :param css: (optional) path or list of paths to CSS files added to every section
+    :param configuration: (optional) instance of pdfkit.configuration.Configuration()
+    :param cover_first: (optional) if True, cover always precedes TOC
+    :param verbose: (optional) don't pass '--quiet' to wkhtmltopdf
+    :param cache: (optional) instance of pdfkit.cache.RenderCache() for partial
+                  PDFs, a private in-memory cache by default
+    :param max_workers: (optional) number of concurrent renders, number of CPUs by default
+    :param priority: (optional) priority class of renders for configuration scheduler
+    :param optimize: (optional) 'fast', 'size' or True for 'fast', optimize size of
+                     merged PDF with :func:`pdfkit.optimizer.optimize_pdf`
+    """
+
+    def __init__(self, sections, type_='string', options=None, toc=None, cover=None,
+                 css=None, configuration=None, cover_first=False, verbose=False,
+                 cache=None, max_workers=None, priority=None, optimize=None):
+        if type_ not in ('string', 'file'):
+            raise ValueError('Sections must be strings or files, got type %r' % type_)
+        self.sections = list(sections)
+        self.type = type_
+        self.options = OrderedDict() if options is None else options
+        self.toc = toc
+        self.cover = cover
+        self.css = css
+        self.cover_first = cover_first
+        self.verbose = verbose
+        self.cache = RenderCache() if cache is None else cache
+        self.max_workers = max_workers
+        self.priority = priority
+        self.optimize = optimize
+        # Template for option normalization and configuration lookup
+        self._base = PDFKit('', 'string', configuration=configuration)
+        self.configuration = self._base.configuration
+        #: Indices of sections rendered by wkhtmltopdf during last :meth:`to_pdf`
+        self.rendered = []
+
+    def _kit(self, source, type_, options, extra=None, exclude=(), css=None):
+        opts = OrderedDict((k, v) for k, v in options.items() if not k.startswith(exclude))
+        opts.update(extra or {})
+        return PDFKit(source, type_, options=opts, css=css, configuration=self.configuration,
+                      verbose=self.verbose, priority=self.priority)
+
+    def _render(self, kit, outline, timeout):
+        """
+        Returns (PDF, outline items, whether wkhtmltopdf was run) for a part,
+        from cache if possible. Outline items are collected with
+        ``--dump-outline`` if ``outline`` is set.
+        """
+        if kit.source.isUrl():
+            # Content behind a URL can't be hashed
+            return kit.to_pdf(timeout=timeout), None, True
+
+        chunks = kit._stdin_chunks()
+        chunks = [bytes(chunk) for chunk in chunks] if chunks is not None else None
+        args = kit.command()[:-1] + (['--dump-outline'] if outline else [])
+        files = kit._cache_files(args, chunks)
+        key = cache_key(args, self.configuration.binary_identity(), chunks, files)
+
+        data = self.cache.get(key)
+        items = self.cache.get(key + '-outline') if outline and data is not None else None
+        if data is not None and (not outline or items is not None):
+            return data, json.loads(items.decode('utf-8')) if outline else None, False
+
+        tmpdir = tempfile.mkdtemp(prefix='pdfkit-') if outline else None
+        try:
+            if outline:
+                path = os.path.join(tmpdir, 'outline.xml')
+                kit.options['--dump-outline'] = path
+            data = kit.to_pdf(timeout=timeout)
+            if outline:
+                items = read_outline(path)
+        finally:
+            if tmpdir is not None:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+
+        self.cache.set(key, data)
+        if outline:
+            self.cache.set(key + '-outline', json.dumps(items).encode('utf-8'))
+        return data, items, True
+
+    def _render_all(self, parts, timeout):
+        """Renders (index, kit, outline) parts, returns list of results in order"""
+        results = []
+        for (index, _, _), result in imap_bounded(lambda part: self._render(part[1], part[2], timeout),
+                                                  parts, self.max_workers, ordered=True):
+            if isinstance(result, Exception):
+                raise result
+            if result[2] and index is not None:
+                self.rendered.append(index)
+            results.append(result)
+        return results
+
+    def to_pdf(self, path=None, timeout=None):
+        """
+        Renders changed sections and merges them with cached ones.
+
+        :param path: (optional) path to output PDF file. By default, PDF will be returned.
+        :param timeout: (optional) seconds to wait for each wkhtmltopdf process
+
+        Returns: PDF or True if path is given
+        """
+        if not self.sections:
+            raise ValueError('Document has no sections')
+
+        options = _grouped(self._base._normalize_options(self.options))
+        toc = _grouped(self._base._normalize_options(self.toc)) if self.toc is not None else None
+        for key in UNSUPPORTED_OPTIONS:
+            if key in options:
+                raise ValueError('Option %s is not supported for sectioned documents' % key)
+        for key in UNSUPPORTED_TOC_OPTIONS:
+            if toc is not None and key in toc:
+                raise ValueError('TOC option %s is not supported for sectioned documents' % key)
+
+        page_offset = int(options.pop('--page-offset', [0])[0] or 0)
+        renumber = numbered(options)
+        # Without TOC pages before it, the first section gets its final offset now
+        first_offset = renumber and toc is None
+        self.rendered = []
+
+        parts = [(i, self._kit(section, self.type, options, css=self.css), toc is not None)
+                 for i, section in enumerate(self.sections)]
+        if first_offset:
+            parts[0] = (0, self._kit(self.sections[0], self.type, options,
+                                     {'--page-offset': [str(page_offset)]}, css=self.css), False)
+        if self.cover:
+            # Cover has no headers, footers or outline entries like in wkhtmltopdf
+            cover_type = 'file' if os.path.isfile(self.cover) else 'url'
+            parts.append((None, self._kit(self.cover, cover_type, options,
+                                          {'--exclude-from-outline': [None]},
+                                          exclude=HEADER_FOOTER_PREFIXES), False))
+
+        results = self._render_all(parts, timeout)
+        cover_pdf = results.pop()[0] if self.cover else None
+        counts = [pdf.page_count(data) for data, _, _ in results]
+        starts = [sum(counts[:i]) for i in range(len(counts))]
+        pdfs = [data for data, _, _ in results]
+
+        toc_pdf = None
+        toc_pages = 0
+        if toc is not None:
+            items = []
+            for (_, outline, _), start in zip(results, starts):
+                items.extend((level, title, start + page) for level, title, page in outline)
+
+            toc_pages = 1
+            for _ in range(MAX_TOC_PASSES):
+                base = page_offset + toc_pages
+                html = toc_html([(level, title, base + page) for level, title, page in items], toc)
+                extra = {'--page-offset': [str(page_offset)]} if renumber else None
+                toc_pdf = self._render(self._kit(html, 'string', options, extra), False, timeout)[0]
+                pages = pdf.page_count(toc_pdf)
+                if pages == toc_pages:
+                    break
+                toc_pages = pages
+
+        if renumber:
+            # Page count doesn't depend on the offset, so only the numbers change
+            skip = 1 if first_offset else 0
+            parts = [(i, self._kit(section, self.type, options,
+                                   {'--page-offset': [str(page_offset + toc_pages + start)]},
+                                   css=self.css), False)
+                     for (i, section), start in list(zip(enumerate(self.sections), starts))[skip:]]
+            pdfs[skip:] = [data for data, _, _ in self._render_all(parts, timeout)]
+
+        front = [toc_pdf, cover_pdf] if not self.cover_first else [cover_pdf, toc_pdf]
+        merged = pdf.merge([part for part in front if part is not None] + pdfs)
+        if self.optimize:
+            merged = optimize_pdf(merged, self.optimize).data
+        self.rendered = sorted(set(self.rendered))
+
+        if path:
+            with open(path, 'wb') as f:
+                f.write(merged)
+            return True
+        return merged
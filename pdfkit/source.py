@@ -6,11 +6,15 @@ import io
 basestring = str.__mro__[-2]
 unicode = type(u'')
 
+BYTES_TYPES = (bytes, bytearray, memoryview)
+
 
 class Source(object):
     def __init__(self, url_or_file, type_):
         self.source = url_or_file
         self.type = type_
+        # chunks already read from a stream by peek(), emitted again by chunks()
+        self._pushback = []
 
         if self.type == 'file':
             self.checkFiles()
@@ -41,6 +45,81 @@ class Source(object):
     def isFileObj(self):
         return hasattr(self.source, 'read')
 
+    def isBytes(self):
+        return isinstance(self.source, BYTES_TYPES)
+
+    def isChunks(self):
+        """String source given as an iterable of str or bytes chunks"""
+        return (self.isString() and not isinstance(self.source, (basestring,) + BYTES_TYPES)
+                and not self.isFileObj() and hasattr(self.source, '__iter__'))
+
+    def isStream(self):
+        """Source which can be read only once: file-like object or chunks iterable"""
+        return self.isFileObj() or self.isChunks()
+
+    def _read_chunks(self, chunk_size):
+        if self.isFileObj():
+            return iter(lambda: self.source.read(chunk_size), self.source.read(0))
+        return iter(self.source)
+
+    def chunks(self, chunk_size=64 * 1024):
+        """
+        Generates source content as UTF-8 encoded chunks without building
+        a copy of the whole content. Bytes-like sources are sliced without
+        copying.
+        """
+        while self._pushback:
+            yield self._pushback.pop(0)
+
+        if self.isFile() and not self.isFileObj():
+            with open(self.source, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    yield chunk
+        elif isinstance(self.source, unicode):
+            for i in range(0, len(self.source), chunk_size):
+                yield self.source[i:i + chunk_size].encode('utf-8')
+        elif self.isBytes():
+            view = memoryview(self.source)
+            if view.ndim != 1 or view.format != 'B':
+                view = view.cast('B')
+            for i in range(0, len(view), chunk_size):
+                yield view[i:i + chunk_size]
+        else:
+            for chunk in self._read_chunks(chunk_size):
+                yield _encode(chunk)
+
+    def peek(self, stops=(b'</head', b'<body'), limit=1024 * 1024, chunk_size=64 * 1024):
+        """
+        Reads a stream until one of ``stops`` markers is found or ``limit`` bytes
+        are read and returns what was read. The data is kept and emitted again by
+        :meth:`chunks`, so the stream is not consumed.
+        """
+        head = b''.join(self._pushback)
+        if not self.isStream():
+            return head
+
+        chunks = self._read_chunks(chunk_size)
+        # Only the newly read part and a marker overlapping it need to be searched
+        overlap = max(len(stop) for stop in stops) - 1
+        searched = 0
+        while len(head) < limit:
+            lowered = head[max(searched - overlap, 0):].lower()
+            if any(stop in lowered for stop in stops):
+                break
+            searched = len(head)
+
+            try:
+                chunk = _encode(next(chunks))
+            except StopIteration:
+                break
+            self._pushback.append(chunk)
+            head += bytes(chunk)
+
+        if self.isChunks():
+            # iter() of a list starts over, keep position of this iterator
+            self.source = chunks
+        return head
+
     def to_s(self):
         # String should be in unicode(python2)/str(python3) type since we will
         # later encode it to utf-8 bytes array to pipe into subprocess
@@ -49,5 +128,41 @@ class Source(object):
         # See issue #42
         if isinstance(self.source, unicode):
             return self.source
+        elif self.isStream():
+            # Stream can be read only once, keep its content
+            self.source = b''.join(self.chunks()).decode('utf-8')
+            return self.source
         else:
             return unicode(self.source, 'utf-8')
+
+
+def splice(chunks, marker, data):
+    """
+    Generates bytes chunks with ``data`` inserted before the first occurrence of
+    ``marker``, which may span chunk boundaries. Only ``len(marker) - 1`` bytes
+    are held back between chunks, chunks after the marker are passed through.
+    """
+    chunks = iter(chunks)
+    keep = len(marker) - 1
+    tail = b''
+    for chunk in chunks:
+        chunk = tail + chunk if tail else bytes(chunk)
+        index = chunk.find(marker)
+        if index >= 0:
+            if index:
+                yield chunk[:index]
+            yield data
+            yield chunk[index:]
+            for chunk in chunks:
+                yield chunk
+            return
+        if len(chunk) > keep:
+            yield chunk[:len(chunk) - keep]
+            chunk = chunk[len(chunk) - keep:]
+        tail = chunk
+    if tail:
+        yield tail
+
+
+def _encode(chunk):
+    return chunk.encode('utf-8') if isinstance(chunk, unicode) else chunk
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+
+from .batch import imap_bounded
+from .configuration import cached_configuration
+from .pdfkit import PDFKit
+
+
+class RenderTemplate(object):
+    """
+    Fixed set of options, TOC, cover and CSS normalized once and used to render
+    many inputs.
+
+    The part of wkhtmltopdf command between binary and input is built on
+    construction, so each render only fills in the input and output. Sources
+    which set options through meta tags are rendered with those options merged
+    in, same as with :class:`PDFKit`.
+
+    :param options: dict (optional) with wkhtmltopdf options, with or w/o '--'
+    :param toc: dict (optional) - toc-specific wkhtmltopdf options, with or w/o '--'
+    :param cover: str (optional) - url/filename with a cover html page
+    :param css: (optional) path to css file or list of paths added to file or string sources
+    :param configuration: (optional) instance of pdfkit.configuration.Configuration()
+    :param cover_first: (optional) if True, cover always precedes TOC
+    :param verbose: (optional) By default '--quiet' is passed to all calls
+    :param cache: (optional) instance of pdfkit.cache.RenderCache() used by renders
+    :param prefetch: (optional) instance of pdfkit.prefetch.AssetCache() used by renders
+    """
+
+    def __init__(self, options=None, toc=None, cover=None, css=None,
+                 configuration=None, cover_first=False, verbose=False, cache=None,
+                 prefetch=None):
+        self.configuration = (cached_configuration() if configuration is None
+                              else configuration)
+        self.options = OrderedDict(options or {})
+        self.toc = dict(toc or {})
+        self.cover = cover
+        self.css = css
+        self.cover_first = cover_first
+        self.verbose = verbose
+        self.cache = cache
+        self.prefetch = prefetch
+
+        # Validates and normalizes options, errors are raised here and not on render
+        self.options_argv = tuple(self._pdfkit('', 'url')._options_args())
+
+    def _pdfkit(self, source, type_):
+        return PDFKit(source, type_, options=self.options, toc=self.toc, cover=self.cover,
+                      css=self.css, configuration=self.configuration,
+                      cover_first=self.cover_first, verbose=self.verbose, cache=self.cache,
+                      prefetch=self.prefetch)
+
+    def pdfkit(self, source, type_='string'):
+        """
+        Returns :class:`PDFKit` for given source with precompiled options
+        """
+        r = self._pdfkit(source, type_)
+        if list(r.options) == list(self.options):
+            # No extra options from meta tags, reuse normalized arguments
+            r._options_argv = self.options_argv
+        return r
+
+    def command(self, source, type_='string', output_path=None):
+        return self.pdfkit(source, type_).command(output_path)
+
+    def render(self, source, type_='string', output_path=None, timeout=None):
+        """
+        Converts source to PDF document
+
+        :param source: URL, path to file, string with HTML or other input accepted by :class:`PDFKit`
+        :param type_: (optional) either 'url', 'file' or 'string'
+        :param output_path: (optional) path to output PDF file. By default, PDF will be returned.
+        :param timeout: (optional) seconds to wait for wkhtmltopdf, see :meth:`PDFKit.to_pdf`
+
+        Returns: PDF or True on success if output_path is given
+        """
+        return self.pdfkit(source, type_).to_pdf(output_path, timeout=timeout)
+
+    async def render_async(self, source, type_='string', output_path=None, timeout=None):
+        """Coroutine version of :meth:`render`"""
+        return await self.pdfkit(source, type_).to_pdf_async(output_path, timeout=timeout)
+
+    def render_many(self, jobs, max_workers=None, ordered=False):
+        """
+        Renders many inputs with a bounded number of concurrent wkhtmltopdf
+        processes, see :func:`pdfkit.render_many`.
+
+        :param jobs: iterable of sources to render as strings or dicts with
+                     ``source`` and optional ``type``, ``output_path`` and
+                     ``timeout`` keys
+
+        Returns: iterator of 2-tuples (job, result) where result is PDF, True or
+                 exception raised by the job
+        """
+        def render(job):
+            if not isinstance(job, dict):
+                return self.render(job)
+            return self.render(job['source'], job.get('type', 'string'), job.get('output_path'),
+                               timeout=job.get('timeout'))
+
+        return imap_bounded(render, jobs, max_workers=max_workers, ordered=ordered)
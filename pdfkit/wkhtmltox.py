@@ -0,0 +1,581 @@
+# -*- coding: utf-8 -*-
+"""
+Backend which renders with ``libwkhtmltox`` in long-lived worker processes.
+
+Starting wkhtmltopdf means loading Qt and WebKit, which dominates the time of
+small renders. Here every worker process loads the library and initializes it
+once, then converts documents sent to it over a pipe. ``wkhtmltopdf_init`` can
+only be called once per process and the library is not thread safe, so workers
+are separate processes running one job at a time. They are retired after
+``max_jobs`` renders to bound memory leaked by WebKit.
+
+Commands are translated from wkhtmltopdf command line arguments to library
+settings. Commands using options without a library setting and all commands
+when the library can't be found or loaded are run by :class:`SubprocessBackend`.
+"""
+import ctypes
+import ctypes.util
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+from .backends import Backend, Execution, SubprocessBackend, write_fd
+
+# Command line option -> (object, setting, value). Object is 'global' for
+# global settings, 'page' for settings of every page object (including cover
+# and TOC) and 'toc' for settings of TOC object. Value is a fixed string for
+# switches, None for options taking one value and 'pair' for options taking
+# two values, which are appended to a list setting.
+OPTIONS = {
+    # Global options
+    '--collate': ('global', 'collate', 'true'),
+    '--no-collate': ('global', 'collate', 'false'),
+    '--cookie-jar': ('global', 'load.cookieJar', None),
+    '--copies': ('global', 'copies', None),
+    '--dpi': ('global', 'dpi', None),
+    '--grayscale': ('global', 'colorMode', 'Grayscale'),
+    '--image-dpi': ('global', 'imageDPI', None),
+    '--image-quality': ('global', 'imageQuality', None),
+    '--margin-bottom': ('global', 'margin.bottom', None),
+    '--margin-left': ('global', 'margin.left', None),
+    '--margin-right': ('global', 'margin.right', None),
+    '--margin-top': ('global', 'margin.top', None),
+    '--orientation': ('global', 'orientation', None),
+    '--page-height': ('global', 'size.height', None),
+    '--page-width': ('global', 'size.width', None),
+    '--page-size': ('global', 'size.pageSize', None),
+    '--no-pdf-compression': ('global', 'useCompression', 'false'),
+    '--title': ('global', 'documentTitle', None),
+    '--outline': ('global', 'outline', 'true'),
+    '--no-outline': ('global', 'outline', 'false'),
+    '--outline-depth': ('global', 'outlineDepth', None),
+    '--dump-outline': ('global', 'dumpOutline', None),
+    '--page-offset': ('global', 'pageOffset', None),
+    '--viewport-size': ('global', 'viewportSize', None),
+
+    # Page options
+    '--background': ('page', 'web.background', 'true'),
+    '--no-background': ('page', 'web.background', 'false'),
+    '--cookie': ('page', 'load.cookies', 'pair'),
+    '--custom-header': ('page', 'load.customHeaders', 'pair'),
+    '--custom-header-propagation': ('page', 'load.repeatCustomHeaders', 'true'),
+    '--no-custom-header-propagation': ('page', 'load.repeatCustomHeaders', 'false'),
+    '--debug-javascript': ('page', 'load.debugJavascript', 'true'),
+    '--no-debug-javascript': ('page', 'load.debugJavascript', 'false'),
+    '--encoding': ('page', 'web.defaultEncoding', None),
+    '--disable-external-links': ('page', 'useExternalLinks', 'false'),
+    '--enable-external-links': ('page', 'useExternalLinks', 'true'),
+    '--disable-internal-links': ('page', 'useLocalLinks', 'false'),
+    '--enable-internal-links': ('page', 'useLocalLinks', 'true'),
+    '--disable-javascript': ('page', 'web.enableJavascript', 'false'),
+    '--enable-javascript': ('page', 'web.enableJavascript', 'true'),
+    '--disable-forms': ('page', 'produceForms', 'false'),
+    '--enable-forms': ('page', 'produceForms', 'true'),
+    '--images': ('page', 'web.loadImages', 'true'),
+    '--no-images': ('page', 'web.loadImages', 'false'),
+    '--disable-local-file-access': ('page', 'load.blockLocalFileAccess', 'true'),
+    '--enable-local-file-access': ('page', 'load.blockLocalFileAccess', 'false'),
+    '--javascript-delay': ('page', 'load.jsdelay', None),
+    '--load-error-handling': ('page', 'load.loadErrorHandling', None),
+    '--load-media-error-handling': ('page', 'load.mediaLoadErrorHandling', None),
+    '--minimum-font-size': ('page', 'web.minimumFontSize', None),
+    '--print-media-type': ('page', 'web.printMediaType', 'true'),
+    '--no-print-media-type': ('page', 'web.printMediaType', 'false'),
+    '--disable-plugins': ('page', 'web.enablePlugins', 'false'),
+    '--enable-plugins': ('page', 'web.enablePlugins', 'true'),
+    '--password': ('page', 'load.password', None),
+    '--username': ('page', 'load.username', None),
+    '--proxy': ('page', 'load.proxy', None),
+    '--disable-smart-shrinking': ('page', 'web.enableIntelligentShrinking', 'false'),
+    '--enable-smart-shrinking': ('page', 'web.enableIntelligentShrinking', 'true'),
+    '--stop-slow-scripts': ('page', 'load.stopSlowScript', 'true'),
+    '--no-stop-slow-scripts': ('page', 'load.stopSlowScript', 'false'),
+    '--user-style-sheet': ('page', 'web.userStyleSheet', None),
+    '--window-status': ('page', 'load.windowStatus', None),
+    '--zoom': ('page', 'load.zoomFactor', None),
+    '--enable-toc-back-links': ('page', 'toc.backLinks', 'true'),
+    '--disable-toc-back-links': ('page', 'toc.backLinks', 'false'),
+    '--include-in-outline': ('page', 'includeInOutline', 'true'),
+    '--exclude-from-outline': ('page', 'includeInOutline', 'false'),
+    '--replace': ('page', 'replacements', 'pair'),
+    '--footer-center': ('page', 'footer.center', None),
+    '--footer-left': ('page', 'footer.left', None),
+    '--footer-right': ('page', 'footer.right', None),
+    '--footer-font-name': ('page', 'footer.fontName', None),
+    '--footer-font-size': ('page', 'footer.fontSize', None),
+    '--footer-html': ('page', 'footer.htmlUrl', None),
+    '--footer-line': ('page', 'footer.line', 'true'),
+    '--no-footer-line': ('page', 'footer.line', 'false'),
+    '--footer-spacing': ('page', 'footer.spacing', None),
+    '--header-center': ('page', 'header.center', None),
+    '--header-left': ('page', 'header.left', None),
+    '--header-right': ('page', 'header.right', None),
+    '--header-font-name': ('page', 'header.fontName', None),
+    '--header-font-size': ('page', 'header.fontSize', None),
+    '--header-html': ('page', 'header.htmlUrl', None),
+    '--header-line': ('page', 'header.line', 'true'),
+    '--no-header-line': ('page', 'header.line', 'false'),
+    '--header-spacing': ('page', 'header.spacing', None),
+
+    # TOC options
+    '--disable-dotted-lines': ('toc', 'toc.useDottedLines', 'false'),
+    '--toc-header-text': ('toc', 'toc.captionText', None),
+    '--toc-level-indentation': ('toc', 'toc.indentation', None),
+    '--disable-toc-links': ('toc', 'toc.forwardLinks', 'false'),
+    '--toc-text-size-shrink': ('toc', 'toc.fontScale', None),
+    '--xsl-style-sheet': ('toc', 'tocXsl', None),
+}
+
+# Options which don't change output
+IGNORED_OPTIONS = {'--quiet': 0, '--log-level': 1}
+
+# Cover pages have no headers, footers or outline entries and aren't counted
+COVER_SETTINGS = [
+    ('includeInOutline', 'false'),
+    ('pagesCount', 'false'),
+    ('header.left', ''), ('header.center', ''), ('header.right', ''),
+    ('header.htmlUrl', ''), ('header.line', 'false'),
+    ('footer.left', ''), ('footer.center', ''), ('footer.right', ''),
+    ('footer.htmlUrl', ''), ('footer.line', 'false'),
+]
+
+
+class UnsupportedCommand(ValueError):
+    """Command can't be translated to library settings"""
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return str(value)
+
+
+def translate(argv):
+    """
+    Translates a wkhtmltopdf command built by :class:`PDFKit` to library settings.
+
+    Returns: tuple (global_settings, objects, output_path) where settings are lists
+    of (name, value) pairs, objects is a list of (settings, reads_stdin) tuples in
+    document order and output_path is None when PDF is written to stdout.
+
+    Raises: :class:`UnsupportedCommand`
+    """
+    if os.path.basename(_text(argv[0])).startswith('wkhtmltoimage'):
+        raise UnsupportedCommand('Image converter is not supported')
+    args = [_text(arg) for arg in argv[1:]]
+    if len(args) < 2:
+        raise UnsupportedCommand('No input or output')
+    output = args.pop()
+
+    global_settings = []
+    page_settings = []
+    lists = {}
+    objects = []
+    toc = None
+
+    def setting(scope, name, value):
+        if scope == 'toc':
+            if toc is None:
+                raise UnsupportedCommand('TOC option outside of TOC: %s' % name)
+            toc.append((name, value))
+        elif scope == 'global':
+            global_settings.append((name, value))
+        else:
+            page_settings.append((name, value))
+
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg in IGNORED_OPTIONS:
+            i += 1 + IGNORED_OPTIONS[arg]
+        elif arg in OPTIONS:
+            scope, name, value = OPTIONS[arg]
+            if value == 'pair':
+                if i + 2 >= len(args):
+                    raise UnsupportedCommand('Missing values of %s' % arg)
+                index = lists.get(name, 0)
+                lists[name] = index + 1
+                setting(scope, name + '.append', '')
+                setting(scope, '%s[%d].first' % (name, index), args[i + 1])
+                setting(scope, '%s[%d].second' % (name, index), args[i + 2])
+                i += 3
+            elif value is None:
+                if i + 1 >= len(args):
+                    raise UnsupportedCommand('Missing value of %s' % arg)
+                setting(scope, name, args[i + 1])
+                i += 2
+            else:
+                setting(scope, name, value)
+                i += 1
+        elif arg.startswith('-') and arg != '-':
+            raise UnsupportedCommand('Option has no library setting: %s' % arg)
+        elif arg == 'cover':
+            if i + 1 >= len(args):
+                raise UnsupportedCommand('Missing cover page')
+            objects.append(('cover', [('page', args[i + 1])] + COVER_SETTINGS))
+            toc = None
+            i += 2
+        elif arg == 'toc':
+            toc = [('isTableOfContent', 'true')]
+            objects.append(('toc', toc))
+            i += 1
+        else:
+            toc = None
+            objects.append(('page', [] if arg == '-' else [('page', arg)]))
+            i += 1
+
+    if not any(kind == 'page' for kind, _ in objects):
+        raise UnsupportedCommand('No input')
+
+    result = []
+    for kind, settings in objects:
+        if kind == 'cover':
+            # Cover settings win over options of other pages
+            settings = [settings[0]] + page_settings + settings[1:]
+        else:
+            settings = page_settings + settings
+        reads_stdin = kind == 'page' and not any(name == 'page' for name, _ in settings)
+        result.append((settings, reads_stdin))
+
+    return global_settings, result, None if output == '-' else output
+
+
+def find_library():
+    """
+    Returns name or path of libwkhtmltox shared library which can be loaded, or None
+    """
+    name = 'wkhtmltox.dll' if sys.platform == 'win32' else 'wkhtmltox'
+    return ctypes.util.find_library(name)
+
+
+_CALLBACK = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_char_p)
+
+
+def _load(library):
+    lib = ctypes.CDLL(library)
+    lib.wkhtmltopdf_init.argtypes = [ctypes.c_int]
+    lib.wkhtmltopdf_create_global_settings.restype = ctypes.c_void_p
+    lib.wkhtmltopdf_set_global_setting.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p]
+    lib.wkhtmltopdf_create_object_settings.restype = ctypes.c_void_p
+    lib.wkhtmltopdf_set_object_setting.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p]
+    lib.wkhtmltopdf_create_converter.restype = ctypes.c_void_p
+    lib.wkhtmltopdf_create_converter.argtypes = [ctypes.c_void_p]
+    lib.wkhtmltopdf_add_object.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_char_p]
+    lib.wkhtmltopdf_set_error_callback.argtypes = [ctypes.c_void_p, _CALLBACK]
+    lib.wkhtmltopdf_set_warning_callback.argtypes = [ctypes.c_void_p, _CALLBACK]
+    lib.wkhtmltopdf_convert.argtypes = [ctypes.c_void_p]
+    lib.wkhtmltopdf_get_output.restype = ctypes.c_long
+    lib.wkhtmltopdf_get_output.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.POINTER(ctypes.c_ubyte))]
+    lib.wkhtmltopdf_http_error_code.argtypes = [ctypes.c_void_p]
+    lib.wkhtmltopdf_destroy_converter.argtypes = [ctypes.c_void_p]
+    return lib
+
+
+def _encode(value):
+    return value.encode('utf-8')
+
+
+def _convert(lib, global_settings, objects, output, data):
+    """
+    Runs one conversion in a worker, returns (stdout, stderr, exit_code) like
+    wkhtmltopdf would
+    """
+    messages = []
+
+    def collect(prefix):
+        return _CALLBACK(lambda converter, msg: messages.append(prefix + msg + b'\n'))
+
+    on_error, on_warning = collect(b'Error: '), collect(b'Warning: ')
+
+    gs = lib.wkhtmltopdf_create_global_settings()
+    for name, value in global_settings:
+        lib.wkhtmltopdf_set_global_setting(gs, _encode(name), _encode(value))
+    if output is not None:
+        lib.wkhtmltopdf_set_global_setting(gs, b'out', _encode(output))
+
+    converter = lib.wkhtmltopdf_create_converter(gs)
+    try:
+        lib.wkhtmltopdf_set_error_callback(converter, on_error)
+        lib.wkhtmltopdf_set_warning_callback(converter, on_warning)
+
+        for settings, reads_stdin in objects:
+            obj = lib.wkhtmltopdf_create_object_settings()
+            for name, value in settings:
+                lib.wkhtmltopdf_set_object_setting(obj, _encode(name), _encode(value))
+            lib.wkhtmltopdf_add_object(converter, obj, data if reads_stdin else None)
+
+        if not lib.wkhtmltopdf_convert(converter):
+            code = lib.wkhtmltopdf_http_error_code(converter)
+            if code:
+                messages.append(b'Error: HTTP error code %d\n' % code)
+            return b'', b''.join(messages) or b'Error: conversion failed\n', 1
+
+        stdout = b''
+        if output is None:
+            buf = ctypes.POINTER(ctypes.c_ubyte)()
+            size = lib.wkhtmltopdf_get_output(converter, ctypes.byref(buf))
+            stdout = ctypes.string_at(buf, size)
+        return stdout, b''.join(messages), 0
+    finally:
+        lib.wkhtmltopdf_destroy_converter(converter)
+
+
+def _serve(conn, library, max_jobs):
+    """
+    Worker process main loop: initializes the library and converts jobs received
+    from ``conn`` until ``max_jobs`` are done or the pipe is closed
+    """
+    try:
+        lib = _load(library)
+        if not lib.wkhtmltopdf_init(0):
+            raise OSError('wkhtmltopdf_init failed')
+    except Exception as e:
+        conn.send(('error', '%s: %s' % (library, e)))
+        conn.close()
+        return
+    conn.send(('ready', None))
+
+    try:
+        for _ in range(max_jobs):
+            try:
+                job = conn.recv()
+            except EOFError:
+                break
+            conn.send(_convert(lib, *job))
+    finally:
+        lib.wkhtmltopdf_deinit()
+        conn.close()
+
+
+class _Worker(object):
+
+    def __init__(self, context, library, max_jobs):
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=_serve, args=(child, library, max_jobs))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+
+        self.jobs_left = max_jobs
+        self.ready = False
+
+    def wait_ready(self):
+        """
+        Waits until the library is initialized. Raises OSError if it couldn't be loaded
+        """
+        if self.ready:
+            return
+        try:
+            status, message = self.conn.recv()
+        except EOFError:
+            status, message = 'error', 'worker exited with code %s' % self.process.exitcode
+        if status != 'ready':
+            self.stop()
+            raise OSError(message)
+        self.ready = True
+
+    def stop(self, kill=False):
+        if kill and self.process.is_alive():
+            self.process.kill()
+        self.conn.close()
+        self.process.join()
+
+
+class _WorkerExecution(Execution):
+
+    def __init__(self, backend, worker, timeout, chunk_size, fd):
+        self.backend = backend
+        self.worker = worker
+        self.chunk_size = chunk_size
+        self.fd = fd
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        worker.jobs_left -= 1
+
+    def _result(self):
+        worker, self.worker = self.worker, None
+        timeout = None if self.deadline is None else max(self.deadline - time.monotonic(), 0)
+        if not worker.conn.poll(timeout):
+            self.timed_out = True
+            self.backend._release(worker, kill=True)
+            return b''
+
+        try:
+            stdout, self.stderr, self.exit_code = worker.conn.recv()
+        except EOFError:
+            self.backend._release(worker, kill=True)
+            self.stderr = b'Error: libwkhtmltox worker exited with code %s\n' % worker.process.exitcode
+            self.exit_code = worker.process.exitcode
+            return b''
+
+        self.backend._release(worker)
+        return stdout
+
+    def __iter__(self):
+        if self.worker is None:
+            return
+        stdout = self._result()
+        if self.fd is not None:
+            write_fd(self.fd, stdout)
+            return
+        for i in range(0, len(stdout), self.chunk_size):
+            yield stdout[i:i + self.chunk_size]
+
+    def close(self):
+        # Conversion can't be interrupted, so a worker with a job in progress is killed
+        if self.worker is not None:
+            worker, self.worker = self.worker, None
+            self.backend._release(worker, kill=True)
+
+
+class LibwkhtmltoxBackend(Backend):
+    """
+    Renders with libwkhtmltox in a pool of warm worker processes.
+
+    Workers are started on demand, or ahead of time with :meth:`warm_up`. Each
+    one inherits environment of this process, ``environ`` configuration option
+    only applies to commands run by :class:`SubprocessBackend` fallback.
+
+    :param library: (optional) name or path of libwkhtmltox, found with
+                    ``ctypes.util.find_library`` by default
+    :param workers: (optional) max number of worker processes, number of CPUs by default
+    :param max_jobs: (optional) number of renders after which a worker is replaced
+    :param fallback: (optional) backend for commands the library can't run
+    """
+
+    def __init__(self, library=None, workers=None, max_jobs=100, fallback=None):
+        self.library = library or find_library()
+        self.workers = workers or os.cpu_count() or 1
+        self.max_jobs = max_jobs
+        self.fallback = fallback or SubprocessBackend()
+
+        # spawn, because forking a process with running threads isn't safe
+        self._context = multiprocessing.get_context('spawn')
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.workers)
+        self._idle = []
+        self.error = None
+
+    @property
+    def requires_binary(self):
+        # wkhtmltopdf is still looked up on PATH for fallback commands
+        return self.library is None
+
+    def warm_up(self, count=None):
+        """
+        Starts ``count`` workers (all by default), so first renders don't wait for
+        the library to load
+        """
+        with self._lock:
+            if self.library is None:
+                return
+            for _ in range(min(count or self.workers, self.workers) - len(self._idle)):
+                self._idle.append(_Worker(self._context, self.library, self.max_jobs))
+
+    def _acquire(self):
+        """
+        Returns a ready worker or None if the library can't be used
+        """
+        self._slots.acquire()
+        try:
+            with self._lock:
+                worker = self._idle.pop() if self._idle else None
+                library = self.library
+            if library is None:
+                if worker is not None:
+                    worker.stop(kill=True)
+                self._slots.release()
+                return None
+            if worker is None:
+                worker = _Worker(self._context, library, self.max_jobs)
+            worker.wait_ready()
+            return worker
+        except OSError as e:
+            # Library is missing or broken, stop using it
+            with self._lock:
+                self.library = None
+                idle, self._idle = self._idle, []
+            for worker in idle:
+                worker.stop(kill=True)
+            self.error = e
+            self._slots.release()
+            return None
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _release(self, worker, kill=False):
+        replacement = None
+        if kill or worker.jobs_left <= 0:
+            worker.stop(kill=kill)
+            if self.library is not None:
+                # Start the next worker now, so it's warm when needed
+                replacement = _Worker(self._context, self.library, self.max_jobs)
+        else:
+            replacement = worker
+
+        if replacement is not None:
+            with self._lock:
+                self._idle.append(replacement)
+        self._slots.release()
+
+    def start(self, argv, stdin=None, env=None, timeout=None, chunk_size=64 * 1024, stats=None,
+              stdout=None):
+        try:
+            global_settings, objects, output = translate(argv)
+        except UnsupportedCommand:
+            return self.fallback.start(argv, stdin, env=env, timeout=timeout,
+                                       chunk_size=chunk_size, stats=stats, stdout=stdout)
+        if self.library is None:
+            return self.fallback.start(argv, stdin, env=env, timeout=timeout,
+                                       chunk_size=chunk_size, stats=stats, stdout=stdout)
+
+        started = time.monotonic()
+        data = b''.join(bytes(chunk) for chunk in stdin) if stdin is not None else b''
+        if stats is not None:
+            stats.input_bytes = len(data)
+            stats.stdin_time = time.monotonic() - started
+
+        started = time.monotonic()
+        job = (global_settings, objects, output, data)
+        worker = self._submit(job)
+        if worker is None:
+            return self.fallback.start(argv, [data], env=env, timeout=timeout,
+                                       chunk_size=chunk_size, stats=stats, stdout=stdout)
+        if stats is not None:
+            stats.spawn_time = time.monotonic() - started
+
+        return _WorkerExecution(self, worker, timeout, chunk_size, stdout)
+
+    def _submit(self, job):
+        """
+        Sends ``job`` to a ready worker and returns it, or None if the library
+        can't be used. A worker which died while idle is killed, releasing its
+        slot, and the job is sent to a fresh one.
+
+        Raises: IOError if the fresh worker can't receive the job either
+        """
+        for _ in range(2):
+            worker = self._acquire()
+            if worker is None:
+                return None
+            try:
+                worker.conn.send(job)
+                return worker
+            except (OSError, ValueError) as e:
+                self._release(worker, kill=True)
+                error = e
+            except BaseException:
+                self._release(worker, kill=True)
+                raise
+        raise IOError('libwkhtmltox worker failed to receive job: %s' % error)
+
+    def close(self):
+        """
+        Stops idle workers
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for worker in idle:
+            worker.stop()
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Pool of long-lived Xvfb displays for wkhtmltopdf builds without patched Qt,
+which need an X server. Starting a server for every render, like ``xvfb-run``
+does, costs about as much as the render itself.
+"""
+import asyncio
+import atexit
+import os
+import select
+import socket
+import subprocess
+import threading
+import time
+
+
+class _Display(object):
+
+    def __init__(self, process, number):
+        self.process = process
+        self.number = number
+        self.name = ':%d' % number
+        self.leases = 0
+
+
+class XvfbPool(object):
+    """
+    Starts ``size`` Xvfb servers on first use and spreads renders over them.
+
+    A display is leased by a render for its duration, renders share a display
+    with the fewest leases. Before a display is leased, its server is checked to
+    be running and accepting connections, and is started again if it isn't.
+    Servers pick free display numbers themselves (``-displayfd``). All servers
+    are stopped by :meth:`close`, which also runs at interpreter exit.
+
+    :param size: (optional) number of servers
+    :param binary: (optional) Xvfb executable
+    :param screen: (optional) screen geometry and depth
+    :param args: (optional) list of extra Xvfb arguments
+    :param start_timeout: (optional) seconds to wait for a server to start
+    """
+
+    #: Directory with sockets of local X servers
+    socket_dir = '/tmp/.X11-unix'
+
+    def __init__(self, size=2, binary='Xvfb', screen='1280x1024x24', args=(), start_timeout=10):
+        self.size = size
+        self.binary = binary
+        self.screen = screen
+        self.args = list(args)
+        self.start_timeout = start_timeout
+        self.restarts = 0
+
+        self._displays = []
+        self._lock = threading.Lock()
+        self._closed = False
+        atexit.register(self.close)
+
+    def displays(self):
+        """Returns names of running displays, e.g. [':0', ':1']"""
+        with self._lock:
+            return [display.name for display in self._displays]
+
+    def _spawn(self):
+        read_fd, write_fd = os.pipe()
+        try:
+            try:
+                process = subprocess.Popen(
+                    [self.binary, '-displayfd', str(write_fd), '-screen', '0', self.screen,
+                     '-nolisten', 'tcp', '-noreset'] + self.args,
+                    stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL, pass_fds=(write_fd,), start_new_session=True)
+            except OSError as e:
+                raise IOError('Failed to start Xvfb "%s": %s' % (self.binary, e))
+            finally:
+                os.close(write_fd)
+
+            # Server writes its display number when it is ready for connections
+            data = b''
+            deadline = time.monotonic() + self.start_timeout
+            while not data.endswith(b'\n'):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not select.select([read_fd], [], [], remaining)[0]:
+                    _stop(process)
+                    raise IOError('Xvfb did not start in %s seconds' % self.start_timeout)
+                chunk = os.read(read_fd, 16)
+                if not chunk:
+                    _stop(process)
+                    raise IOError('Xvfb exited with code %s' % process.poll())
+                data += chunk
+        finally:
+            os.close(read_fd)
+
+        return _Display(process, int(data))
+
+    def _alive(self, display):
+        if display.process.poll() is not None:
+            return False
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.settimeout(1)
+            connection.connect(os.path.join(self.socket_dir, 'X%d' % display.number))
+            return True
+        except OSError:
+            return False
+        finally:
+            connection.close()
+
+    def acquire(self):
+        """
+        Leases a display, starting servers if needed.
+
+        Returns: display name to set as ``DISPLAY``
+        Raises: IOError if a server can't be started
+        """
+        with self._lock:
+            if self._closed:
+                raise IOError('Xvfb pool is closed')
+            while len(self._displays) < self.size:
+                self._displays.append(self._spawn())
+
+            index = min(range(len(self._displays)), key=lambda i: self._displays[i].leases)
+            display = self._displays[index]
+            if not self._alive(display):
+                _stop(display.process)
+                display = self._displays[index] = self._spawn()
+                self.restarts += 1
+            display.leases += 1
+            return display.name
+
+    async def acquire_async(self):
+        """
+        Coroutine version of :meth:`acquire`. Starting servers blocks, so it
+        runs in the default executor of the running loop. A display leased
+        after the awaiting task was cancelled is returned to the pool.
+        """
+        future = asyncio.get_running_loop().run_in_executor(None, self.acquire)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            future.add_done_callback(self._release_abandoned)
+            raise
+
+    def _release_abandoned(self, future):
+        if not future.cancelled() and future.exception() is None:
+            self.release(future.result())
+
+    def release(self, name):
+        """Returns a display leased with :meth:`acquire`"""
+        with self._lock:
+            for display in self._displays:
+                if display.name == name and display.leases > 0:
+                    display.leases -= 1
+                    return
+
+    def close(self):
+        """Stops all servers, the pool can't be used afterwards"""
+        with self._lock:
+            self._closed = True
+            displays, self._displays = self._displays, []
+        for display in displays:
+            _stop(display.process)
+        atexit.unregister(self.close)
+
+
+_shared_pool = None
+_shared_pool_lock = threading.Lock()
+
+
+def shared_pool():
+    """
+    Returns the pool used by configurations with ``xvfb=True``, one per
+    process. A new pool is made if the previous one was closed.
+    """
+    global _shared_pool
+    with _shared_pool_lock:
+        if _shared_pool is None or _shared_pool._closed:
+            _shared_pool = XvfbPool()
+        return _shared_pool
+
+
+def _stop(process, timeout=5):
+    if process.poll() is not None:
+        return
+    process.terminate()
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
@@ -1,9 +1,18 @@
 # -*- coding: utf-8 -*-
 import os
 import io
+import re
 import sys
 import codecs
+import shutil
+import stat
+import asyncio
+import tempfile
+import threading
+import time
 import unittest
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 
 if sys.version_info[0] == 2 and sys.version_info[1] == 7:
@@ -15,6 +24,11 @@ TESTS_ROOT = os.path.abspath(os.path.dirname(__file__))
 sys.path.insert(0, os.path.realpath(os.path.join(TESTS_ROOT, '..')))
 
 import pdfkit
+import pdfkit.capabilities
+import pdfkit.parallel
+import pdfkit.optimizer
+import pdfkit.pdf
+import pdfkit.wkhtmltox
 
 
 class TestPDFKitInitialization(unittest.TestCase):
@@ -131,6 +145,79 @@ class TestPDFKitInitialization(unittest.TestCase):
         with self.assertRaises(IOError):
             conf = pdfkit.configuration(wkhtmltopdf='wrongpath')
 
+    def test_cached_configuration(self):
+        conf = pdfkit.cached_configuration()
+        self.assertIs(conf, pdfkit.cached_configuration())
+        self.assertIs(conf, pdfkit.PDFKit('html', 'string').configuration)
+        self.assertIsNot(conf, pdfkit.cached_configuration(meta_tag_prefix='prefix-'))
+
+    def test_cached_configuration_invalidated_on_binary_change(self):
+        binary = os.path.join(TESTS_ROOT, 'fixtures', 'wkhtmltopdf.tmp')
+        with open(binary, 'w') as f:
+            f.write('binary')
+        try:
+            conf = pdfkit.cached_configuration(wkhtmltopdf=binary)
+            self.assertIs(conf, pdfkit.cached_configuration(wkhtmltopdf=binary))
+
+            st = os.stat(binary)
+            os.utime(binary, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+            self.assertIsNot(conf, pdfkit.cached_configuration(wkhtmltopdf=binary))
+        finally:
+            os.remove(binary)
+            pdfkit.clear_configuration_cache()
+
+    def test_cached_configuration_eviction(self):
+        closed = []
+
+        class ClosingBackend(pdfkit.LoopbackBackend):
+            def close(self):
+                closed.append(self)
+
+        # pdfkit.configuration is the API function, not the module
+        module = sys.modules['pdfkit.configuration']
+        pdfkit.register_backend('closing', ClosingBackend)
+        limit = module.MAX_CACHED_CONFIGURATIONS
+        module.MAX_CACHED_CONFIGURATIONS = 2
+        try:
+            first = pdfkit.cached_configuration(backend='closing', timeout=1)
+            second = pdfkit.cached_configuration(backend='closing', timeout=2)
+            self.assertIs(first, pdfkit.cached_configuration(backend='closing', timeout=1))
+            pdfkit.cached_configuration(backend='closing', timeout=3)
+            # Least recently used entry is dropped and its backend closed
+            self.assertEqual(closed, [second.backend])
+            self.assertIs(first, pdfkit.cached_configuration(backend='closing', timeout=1))
+        finally:
+            module.MAX_CACHED_CONFIGURATIONS = limit
+            pdfkit.backends._backends.pop('closing', None)
+            pdfkit.clear_configuration_cache()
+        self.assertEqual(len(closed), 3)
+
+    def test_configuration_environ_snapshot(self):
+        environ = {'PATH': '/usr/bin', 'NUMBER': 1}
+        conf = pdfkit.configuration(environ=environ)
+        self.assertEqual(conf.environ['NUMBER'], '1')
+        self.assertEqual(environ['NUMBER'], 1)
+
+        conf = pdfkit.configuration()
+        self.assertEqual(conf.environ, os.environ)
+        os.environ['PDFKIT_TEST'] = '1'
+        try:
+            self.assertNotIn('PDFKIT_TEST', conf.environ)
+        finally:
+            del os.environ['PDFKIT_TEST']
+
+    def test_cached_configuration_follows_environ(self):
+        conf = pdfkit.cached_configuration()
+        os.environ['PDFKIT_TEST'] = '1'
+        try:
+            changed = pdfkit.cached_configuration()
+            self.assertIsNot(conf, changed)
+            self.assertEqual(changed.environ['PDFKIT_TEST'], '1')
+            self.assertIs(changed, pdfkit.cached_configuration())
+        finally:
+            del os.environ['PDFKIT_TEST']
+        self.assertNotIn('PDFKIT_TEST', pdfkit.cached_configuration().environ)
+
 
 class TestPDFKitCommandGeneration(unittest.TestCase):
     """Test command() method"""
@@ -200,6 +287,41 @@ class TestPDFKitCommandGeneration(unittest.TestCase):
         self.assertEqual(command[command.index('--page-size') + 1], 'Legal')
         self.assertEqual(command[command.index('--orientation') + 1], 'Landscape')
 
+    def test_pdfkit_meta_tags_only_in_head(self):
+        body = """
+        <html>
+          <HEAD>
+            <META name="pdfkit-page-size" content="Legal"/>
+          </HEAD>
+          <body>
+            <meta name="pdfkit-orientation" content="Landscape"/>
+          </body>
+        </html>
+        """
+
+        r = pdfkit.PDFKit(body, 'string')
+        command = r.command()
+        self.assertEqual(command[command.index('--page-size') + 1], 'Legal')
+        self.assertNotIn('--orientation', command)
+
+    def test_pdfkit_meta_tags_in_bytes(self):
+        body = b'<html><head><meta name="pdfkit-page-size" content="Legal"/></head></html>'
+        for data in (body, memoryview(body)):
+            command = pdfkit.PDFKit(data, 'string').command()
+            self.assertEqual(command[command.index('--page-size') + 1], 'Legal')
+
+    def test_pdfkit_meta_tags_with_custom_prefix(self):
+        body = '<html><head><meta name="my.pdf-page-size" content="Legal"/></head></html>'
+        conf = pdfkit.configuration(meta_tag_prefix='my.pdf-')
+        command = pdfkit.PDFKit(body, 'string', configuration=conf).command()
+        self.assertEqual(command[command.index('--page-size') + 1], 'Legal')
+
+    def test_pdfkit_meta_tags_disabled(self):
+        body = '<html><head><meta name="pdfkit-page-size" content="Legal"/></head></html>'
+        conf = pdfkit.configuration(meta_tags=False)
+        command = pdfkit.PDFKit(body, 'string', configuration=conf).command()
+        self.assertNotIn('--page-size', command)
+
     def test_skip_nonpdfkit_tags(self):
         body = """
         <html>
@@ -370,7 +492,7 @@ class TestPDFKitGeneration(unittest.TestCase):
             css = f.read()
 
         r._prepend_css('fixtures/example.css')
-        self.assertIn('<style>%s</style>' % css, r.source.to_s())
+        self.assertIn('<style>%s</style>' % css, b''.join(r._stdin_chunks()).decode('utf-8'))
 
     def test_stylesheet_adding_without_head_tag(self):
         r = pdfkit.PDFKit('<html><body>Hai!</body></html>', 'string',
@@ -380,7 +502,7 @@ class TestPDFKitGeneration(unittest.TestCase):
             css = f.read()
 
         r._prepend_css('fixtures/example.css')
-        self.assertIn('<style>%s</style><html>' % css, r.source.to_s())
+        self.assertIn('<style>%s</style><html>' % css, b''.join(r._stdin_chunks()).decode('utf-8'))
 
     def test_multiple_stylesheets_adding_to_the_head(self):
         #TODO rewrite this part of pdfkit.py
@@ -394,7 +516,7 @@ class TestPDFKitGeneration(unittest.TestCase):
                 css.append(f.read())
 
         r._prepend_css(css_files)
-        self.assertIn('<style>%s</style>' % "\n".join(css), r.source.to_s())
+        self.assertIn('<style>%s</style>' % "\n".join(css), b''.join(r._stdin_chunks()).decode('utf-8'))
 
     def test_multiple_stylesheet_adding_without_head_tag(self):
         css_files = ['fixtures/example.css', 'fixtures/example2.css']
@@ -407,7 +529,58 @@ class TestPDFKitGeneration(unittest.TestCase):
                 css.append(f.read())
 
         r._prepend_css(css_files)
-        self.assertIn('<style>%s</style><html>' % "\n".join(css), r.source.to_s())
+        self.assertIn('<style>%s</style><html>' % "\n".join(css), b''.join(r._stdin_chunks()).decode('utf-8'))
+
+    def test_stylesheet_cache(self):
+        path = os.path.join(TESTS_ROOT, 'fixtures', 'cached.css')
+        with open(path, 'w') as f:
+            f.write('body { color: red; }')
+        try:
+            pdfkit.preload_css(path)
+            self.assertEqual(pdfkit.css.stylesheets.get([path]), 'body { color: red; }')
+
+            with open(path, 'w') as f:
+                f.write('body { color: blue; border: none; }')
+            r = pdfkit.PDFKit('<html><head></head></html>', 'string', css=path)
+            r._prepend_css(path)
+            self.assertIn('<style>body { color: blue; border: none; }</style>', b''.join(r._stdin_chunks()).decode('utf-8'))
+        finally:
+            os.remove(path)
+            pdfkit.clear_css_cache()
+
+    def test_stylesheet_cache_eviction(self):
+        cache = pdfkit.css.StylesheetCache(max_entries=1)
+        cache.get(['fixtures/example.css'])
+        cache.get(['fixtures/example2.css'])
+        self.assertEqual(len(cache._entries), 1)
+
+    def test_stylesheet_cache_size_limit(self):
+        first = pdfkit.css.StylesheetCache().style_tag(['fixtures/example.css'])
+        second = pdfkit.css.StylesheetCache().style_tag(['fixtures/example2.css'])
+        cache = pdfkit.css.StylesheetCache(max_bytes=max(len(first), len(second)))
+        cache.get(['fixtures/example.css'])
+        cache.get(['fixtures/example2.css'])
+        self.assertEqual(list(cache._entries.values()), [second])
+        self.assertEqual(cache._size, len(second))
+
+        # Contents larger than the limit are returned without being cached
+        both = cache.get(['fixtures/example.css', 'fixtures/example2.css'])
+        self.assertEqual(both.encode('utf-8'), first[7:-8] + b'\n' + second[7:-8])
+        self.assertEqual(list(cache._entries.values()), [second])
+
+    def test_stylesheet_cache_counts_bytes(self):
+        path = os.path.join(TESTS_ROOT, 'fixtures', 'cached.css')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('p:after { content: "———"; }')
+        try:
+            cache = pdfkit.css.StylesheetCache()
+            tag = cache.style_tag([path])
+            self.assertEqual(tag, '<style>p:after { content: "———"; }</style>'.encode('utf-8'))
+            self.assertEqual(cache._size, len(tag))
+            # Cached payload is reused as is
+            self.assertIs(cache.style_tag([path]), tag)
+        finally:
+            os.remove(path)
 
     def test_stylesheet_throw_error_when_url(self):
         r = pdfkit.PDFKit('http://ya.ru', 'url', css='fixtures/example.css')
@@ -420,7 +593,32 @@ class TestPDFKitGeneration(unittest.TestCase):
         r = pdfkit.PDFKit('fixtures/example.html', 'file', css=css)
         self.assertEqual(r.css, css)
         r._prepend_css(css)
-        self.assertIn('font-size', r.source.to_s())
+        self.assertIn('font-size', b''.join(r._stdin_chunks()).decode('utf-8'))
+        self.assertEqual(r.command()[-2], '-')
+
+    def test_stylesheet_splicing_across_chunks(self):
+        html = b'<html><head><title>x</title></head><body>' + b'x' * 1000 + b'</body></html>'
+        for size in (1, 3, 7, 64):
+            chunks = [html[i:i + size] for i in range(0, len(html), size)]
+            spliced = b''.join(pdfkit.source.splice(chunks, b'</head>', b'<style></style>'))
+            self.assertEqual(spliced, html.replace(b'</head>', b'<style></style></head>'))
+        self.assertEqual(b''.join(pdfkit.source.splice([b'<html>', b'</ht'], b'</head>', b'X')),
+                         b'<html></ht')
+
+    def test_stylesheet_adding_to_stream(self):
+        with open('fixtures/example.css') as f:
+            css = f.read()
+        chunks = ['<html><he', 'ad></he', 'ad><body>Hai!</body></html>']
+        r = pdfkit.PDFKit(iter(chunks), 'string', css='fixtures/example.css')
+        r._prepend_css('fixtures/example.css')
+        self.assertEqual(b''.join(r._stdin_chunks()).decode('utf-8'),
+                         '<html><head><style>%s</style></head><body>Hai!</body></html>' % css)
+
+        r = pdfkit.PDFKit(io.BytesIO(b'<html><body>Hai!</body></html>'), 'string',
+                          css='fixtures/example.css')
+        r._prepend_css('fixtures/example.css')
+        self.assertEqual(b''.join(r._stdin_chunks()).decode('utf-8'),
+                         '<style>%s</style><html><body>Hai!</body></html>' % css)
 
     def test_wkhtmltopdf_error_handling(self):
         r = pdfkit.PDFKit('clearlywrongurl.asdf', 'url')
@@ -446,7 +644,68 @@ class TestPDFKitGeneration(unittest.TestCase):
             r.to_pdf()
 
         raised_exception = cm.exception
-        self.assertRegex(str(raised_exception), '^wkhtmltopdf exited with non-zero code 1. error:\nUnknown long argument --bad-option\r?\n')
+        # Rejected before start if wkhtmltopdf could be probed for its options
+        self.assertRegex(str(raised_exception), '^(wkhtmltopdf exited with non-zero code 1. error:\nUnknown long argument --bad-option\r?\n'
+                                                '|Unknown option --bad-option for wkhtmltopdf)')
+
+    def test_pdf_generation_streaming(self):
+        r = pdfkit.PDFKit('html', 'string', options={'page-size': 'Letter'})
+        chunks = list(r.iter_pdf(chunk_size=16))
+        self.assertTrue(len(chunks) > 1)
+        self.assertTrue(all(len(chunk) <= 16 for chunk in chunks))
+        self.assertEqual(b''.join(chunks)[:4].decode('utf-8'), '%PDF')
+
+    def test_pdf_generation_streaming_error_handling(self):
+        r = pdfkit.PDFKit('clearlywrongurl.asdf', 'url')
+        with self.assertRaises(IOError):
+            list(r.iter_pdf())
+
+    def test_pdf_generation_from_bytes(self):
+        for data in (b'<html><body>Hai!</body></html>',
+                     bytearray(b'<html><body>Hai!</body></html>'),
+                     memoryview(b'<html><body>Hai!</body></html>')):
+            output = pdfkit.PDFKit(data, 'string').to_pdf()
+            self.assertEqual(output[:4].decode('utf-8'), '%PDF')
+
+    def test_pdf_generation_from_chunks(self):
+        chunks = (chunk for chunk in ['<html><head>',
+                                      b'<meta name="pdfkit-page-size" content="Legal"/>',
+                                      '</head><body>Hai!</body></html>'])
+        r = pdfkit.PDFKit(chunks, 'string')
+        command = r.command()
+        self.assertEqual(command[command.index('--page-size') + 1], 'Legal')
+        self.assertEqual(b''.join(r.source.chunks()),
+                         b'<html><head><meta name="pdfkit-page-size" content="Legal"/>'
+                         b'</head><body>Hai!</body></html>')
+
+    def test_pdf_generation_from_binary_file_object(self):
+        with open('fixtures/example.html', 'rb') as f:
+            r = pdfkit.PDFKit(f, 'file')
+            output = r.to_pdf()
+        self.assertEqual(output[:4].decode('utf-8'), '%PDF')
+
+    def test_meta_tags_in_file_object_not_consumed(self):
+        body = b'<html><head><meta name="pdfkit-orientation" content="Landscape"/></head>Hai!</html>'
+        r = pdfkit.PDFKit(io.BytesIO(body), 'string')
+        command = r.command()
+        self.assertEqual(command[command.index('--orientation') + 1], 'Landscape')
+        self.assertEqual(b''.join(r.source.chunks(chunk_size=8)), body)
+
+    def test_raise_error_on_timeout(self):
+        r = pdfkit.PDFKit('html', 'string', options={'javascript-delay': 10000})
+        with self.assertRaises(pdfkit.RenderTimeout) as cm:
+            r.to_pdf('out.pdf', timeout=0.5)
+        self.assertIsInstance(cm.exception, IOError)
+        self.assertEqual(cm.exception.timeout, 0.5)
+        self.assertFalse(os.path.exists('out.pdf'))
+
+    def test_timeout_from_configuration(self):
+        conf = pdfkit.configuration(timeout=0.5)
+        with self.assertRaises(pdfkit.RenderTimeout):
+            pdfkit.from_string('html', options={'javascript-delay': 10000}, configuration=conf)
+        with self.assertRaises(pdfkit.RenderTimeout):
+            asyncio.run(pdfkit.from_string_async('html', options={'javascript-delay': 10000},
+                                                 configuration=conf))
 
     def test_issue_42_encode_file_with_unicode_char(self):
         with open('fixtures/issue_42_bad_char_page.html', 'r') as f:
@@ -492,5 +751,1498 @@ class TestPDFKitGeneration(unittest.TestCase):
         output = r.to_pdf()
         self.assertEqual(output[:4].decode('utf-8'), '%PDF')
 
+
+class TestPDFKitAsyncGeneration(unittest.TestCase):
+    """Test to_pdf_async() method and async API"""
+
+    def tearDown(self):
+        if os.path.exists('out.pdf'):
+            os.remove('out.pdf')
+
+    def test_pdf_generation_into_variable(self):
+        r = pdfkit.PDFKit('html', 'string', options={'page-size': 'Letter'})
+        pdf = asyncio.run(r.to_pdf_async())
+        self.assertEqual(pdf[:4].decode('utf-8'), '%PDF')
+
+    def test_pdf_generation(self):
+        pdf = asyncio.run(pdfkit.from_string_async('html', 'out.pdf'))
+        self.assertTrue(pdf)
+
+    def test_concurrent_generation(self):
+        async def render():
+            return await asyncio.gather(
+                pdfkit.from_string_async('html'),
+                pdfkit.from_file_async('fixtures/example.html'),
+                pdfkit.from_file_async('fixtures/example.html', css='fixtures/example.css'))
+
+        for output in asyncio.run(render()):
+            self.assertEqual(output[:4].decode('utf-8'), '%PDF')
+
+    def test_wkhtmltopdf_error_handling(self):
+        with self.assertRaises(IOError):
+            asyncio.run(pdfkit.from_url_async('clearlywrongurl.asdf'))
+
+
+class TestPDFKitRenderMany(unittest.TestCase):
+    """Test render_many() batch API"""
+
+    def tearDown(self):
+        for path in ('out.pdf', 'out2.pdf'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_render_many(self):
+        jobs = [
+            {'source': 'html'},
+            {'source': 'fixtures/example.html', 'type': 'file', 'css': 'fixtures/example.css'},
+            {'source': 'html', 'output_path': 'out.pdf', 'options': {'page-size': 'Letter'}},
+        ]
+        results = list(pdfkit.render_many(jobs, max_workers=2))
+        self.assertEqual(len(results), 3)
+        for job, output in results:
+            self.assertIn(job, jobs)
+            if job.get('output_path'):
+                self.assertTrue(output)
+            else:
+                self.assertEqual(output[:4].decode('utf-8'), '%PDF')
+
+    def test_render_many_ordered(self):
+        jobs = [{'source': 'html %d' % i} for i in range(5)]
+        results = list(pdfkit.render_many(jobs, max_workers=3, ordered=True))
+        self.assertEqual([job for job, _ in results], jobs)
+
+    def test_render_many_reports_errors(self):
+        jobs = [
+            {'source': 'clearlywrongurl.asdf', 'type': 'url'},
+            {'source': 'html', 'output_path': 'out2.pdf'},
+        ]
+        results = list(pdfkit.render_many(jobs, ordered=True))
+        self.assertIsInstance(results[0][1], IOError)
+        self.assertIs(results[1][1], True)
+
+    def test_render_many_pulls_jobs_lazily(self):
+        pulled = []
+
+        def jobs():
+            for i in range(100):
+                pulled.append(i)
+                yield {'source': 'html'}
+
+        results = pdfkit.render_many(jobs(), max_workers=1)
+        next(results)
+        results.close()
+        self.assertLess(len(pulled), 100)
+
+
+class TestPDFKitRenderCache(unittest.TestCase):
+    """Test RenderCache"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        if os.path.exists('out.pdf'):
+            os.remove('out.pdf')
+
+    def test_cache_hit_skips_wkhtmltopdf(self):
+        cache = pdfkit.RenderCache()
+        pdf = pdfkit.from_string('html', cache=cache)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+        r = pdfkit.PDFKit('html', 'string', cache=cache)
+        r._run = None  # would fail if wkhtmltopdf was started
+        self.assertEqual(r.to_pdf(), pdf)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_cache_async(self):
+        cache = pdfkit.RenderCache()
+        pdf = asyncio.run(pdfkit.PDFKit('html', 'string', cache=cache).to_pdf_async())
+        r = pdfkit.PDFKit('html', 'string', cache=cache)
+        r._run = None  # would fail if wkhtmltopdf was started
+        self.assertEqual(asyncio.run(r.to_pdf_async()), pdf)
+        self.assertEqual(cache.stats()['misses'], 1)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+        asyncio.run(pdfkit.from_string_async('html', cache=cache))
+        self.assertEqual(cache.stats()['hits'], 2)
+
+    def test_cache_key_depends_on_options_and_css(self):
+        cache = pdfkit.RenderCache()
+        pdfkit.from_string('<html><head></head></html>', cache=cache)
+        pdfkit.from_string('<html><head></head></html>', cache=cache, options={'page-size': 'Letter'})
+        pdfkit.from_string('<html><head></head></html>', cache=cache, css='fixtures/example.css')
+        self.assertEqual(cache.stats()['misses'], 3)
+        self.assertEqual(cache.stats()['hits'], 0)
+
+    def test_cache_key_depends_on_cover_and_header_files(self):
+        cache = pdfkit.RenderCache()
+        cover = os.path.join(self.directory, 'cover.html')
+        header = os.path.join(self.directory, 'header.html')
+        for path in (cover, header):
+            with open(path, 'w') as f:
+                f.write('<p>1</p>')
+
+        def render():
+            pdfkit.from_string('html', cache=cache, cover=cover, options={'header-html': header})
+
+        render()
+        render()
+        self.assertEqual(cache.stats()['hits'], 1)
+        for path in (cover, header):
+            with open(path, 'w') as f:
+                f.write('<p>2</p>')
+            render()
+        self.assertEqual(cache.stats()['misses'], 3)
+
+    def test_cache_output_path(self):
+        cache = pdfkit.RenderCache()
+        pdf = pdfkit.from_file('fixtures/example.html', cache=cache)
+        self.assertTrue(pdfkit.from_file('fixtures/example.html', 'out.pdf', cache=cache))
+        with open('out.pdf', 'rb') as f:
+            self.assertEqual(f.read(), pdf)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_disk_tier_shared_between_caches(self):
+        pdf = pdfkit.from_string('html', cache=pdfkit.RenderCache(directory=self.directory))
+        cache = pdfkit.RenderCache(directory=self.directory)
+        self.assertEqual(pdfkit.from_string('html', cache=cache), pdf)
+        self.assertEqual(cache.stats()['disk_hits'], 1)
+
+    def test_memory_tier_eviction(self):
+        cache = pdfkit.RenderCache(max_memory_bytes=10)
+        cache.set('a', b'12345')
+        cache.set('b', b'12345')
+        self.assertEqual(cache.get('a'), b'12345')
+        cache.set('c', b'12345')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), b'12345')
+
+    def test_disk_tier_eviction_and_ttl(self):
+        cache = pdfkit.RenderCache(max_memory_bytes=0, directory=self.directory, max_disk_bytes=10)
+        cache.set('a', b'12345')
+        os.utime(os.path.join(self.directory, 'a.pdf'), (1, 1))
+        cache.set('b', b'12345')
+        cache.set('c', b'12345')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('c'), b'12345')
+
+        cache = pdfkit.RenderCache(max_memory_bytes=0, directory=self.directory, ttl=60)
+        os.utime(os.path.join(self.directory, 'c.pdf'), (1, 1))
+        self.assertIsNone(cache.get('c'))
+        self.assertEqual(cache.get('b'), b'12345')
+
+    def test_disk_tier_scanned_only_over_limit(self):
+        cache = pdfkit.RenderCache(max_memory_bytes=0, directory=self.directory, max_disk_bytes=12)
+        scans = []
+        evict = cache._disk_evict
+        cache._disk_evict = lambda: scans.append(1) or evict()
+
+        cache.set('a', b'12345')
+        cache.set('a', b'1234')
+        cache.set('b', b'12345')
+        # Only the first write scans the directory, replaced entry isn't counted twice
+        self.assertEqual(len(scans), 1)
+        cache.set('c', b'12345')
+        self.assertEqual(len(scans), 2)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['b.pdf', 'c.pdf'])
+
+
+class _AssetHandler(BaseHTTPRequestHandler):
+    """Serves fixed assets with ETags and counts requests"""
+    protocol_version = 'HTTP/1.1'
+    assets = {
+        '/logo.png': ('image/png', b'PNG'),
+        '/style.css': ('text/css', b'@font-face { src: url("fonts/a.woff") }'),
+        '/fonts/a.woff': ('font/woff', b'WOFF'),
+        '/logo': ('image/png', b'PNG'),
+    }
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        path = self.path.split('?')[0]
+        if path not in self.assets:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        content_type, body = self.assets[path]
+        etag = '"%d"' % len(body)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestPDFKitPrefetch(unittest.TestCase):
+    """Test subresource prefetching with AssetCache"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), _AssetHandler)
+        cls.url = 'http://127.0.0.1:%d' % cls.server.server_address[1]
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        del _AssetHandler.requests[:]
+        self.directory = tempfile.mkdtemp()
+        self.assets = pdfkit.AssetCache(directory=self.directory)
+        self.config = pdfkit.configuration(backend='loopback')
+
+    def tearDown(self):
+        self.assets.close()
+        shutil.rmtree(self.directory)
+
+    def render(self, source, type_='string'):
+        pdfkit.PDFKit(source, type_, configuration=self.config, prefetch=self.assets).to_pdf()
+        return self.config.backend.calls[-1]
+
+    def test_references(self):
+        html = (b'<a href="x.html"><img src="a.png"></a><link rel="stylesheet" href=b.css>'
+                b'<link rel="canonical" href="c.html"><div style="background: url(\'d.png\')">')
+        self.assertEqual([ref for _, _, ref, _ in pdfkit.prefetch.references(html)],
+                         [b'a.png', b'b.css', b'd.png'])
+
+        html = b'<style>p { background: url("a.png?x=1&amp;y=2") }</style><img src="a.png?x=1&amp;y=2">'
+        self.assertEqual([(ref, attribute) for _, _, ref, attribute in pdfkit.prefetch.references(html)],
+                         [(b'a.png?x=1&amp;y=2', False), (b'a.png?x=1&amp;y=2', True)])
+
+    def test_escaping_by_context(self):
+        html = ('<style>p {{ background: url("{0}/logo.png?a=1&amp;b=2") }}</style>'
+                '<div style="background: url(\'{0}/logo.png?a=1&amp;b=2\')"></div>').format(self.url)
+        data = self.assets.rewrite(html.encode('utf-8')).decode('utf-8')
+        # In CSS '&amp;' is a literal part of the URL, in attributes it is '&'
+        self.assertEqual(sorted(_AssetHandler.requests), ['/logo.png?a=1&amp;b=2', '/logo.png?a=1&b=2'])
+        self.assertRegex(data, r'<style>p \{ background: url\("file://[^"&]+"\) \}</style>'
+                               r'<div style="background: url\(\'file://[^\'&]+\'\)"></div>')
+
+    def test_rewrite_to_cached_files(self):
+        html = ('<html><head><link rel="stylesheet" href="{0}/style.css"></head>'
+                '<body><img src="{0}/logo.png"><a href="{0}/logo.png">x</a></body></html>').format(self.url)
+        argv, data = self.render(html)
+
+        self.assertEqual(argv[1:3], ['--allow', self.directory])
+        self.assertEqual(data.count(self.url.encode('utf-8')), 1)
+        paths = re.findall(r'(?:src|href)="file://([^"]+)"', data.decode('utf-8'))
+        self.assertEqual(len(paths), 2)
+        with open(paths[1], 'rb') as f:
+            self.assertEqual(f.read(), b'PNG')
+        with open(paths[0], 'rb') as f:
+            font = re.search(r'url\("file://([^"]+)"\)', f.read().decode('utf-8')).group(1)
+        with open(font, 'rb') as f:
+            self.assertEqual(f.read(), b'WOFF')
+
+    def test_prefetch_async(self):
+        html = '<img src="{0}/logo.png">'.format(self.url)
+        asyncio.run(pdfkit.from_string_async(html, configuration=self.config, prefetch=self.assets))
+        argv, data = self.config.backend.calls[-1]
+        self.assertEqual(_AssetHandler.requests, ['/logo.png'])
+        self.assertNotIn(self.url.encode('utf-8'), data)
+
+    def test_download_threads_shared(self):
+        self.assets.max_workers = 1
+        html = ('<link rel="stylesheet" href="{0}/style.css"><img src="{0}/logo.png">'
+                '<img src="{0}/logo">').format(self.url)
+        # Stylesheet dependencies are fetched by the thread fetching the stylesheet
+        self.render(html)
+        executor = self.assets._executor
+        self.assertEqual(sorted(_AssetHandler.requests),
+                         ['/fonts/a.woff', '/logo', '/logo.png', '/style.css'])
+
+        self.render(html.replace('logo"', 'logo?2"'))
+        self.assertIs(self.assets._executor, executor)
+        self.assets.close()
+        self.assertIsNone(self.assets._executor)
+
+    def test_cache_hits_and_revalidation(self):
+        html = '<img src="{0}/logo.png"><img src="{0}/logo.png">'.format(self.url)
+        self.render(html)
+        self.render(html)
+        self.assertEqual(_AssetHandler.requests, ['/logo.png'])
+        self.assertEqual(self.assets.stats()['hits'], 1)
+
+        self.assets.ttl = 0
+        self.render(html)
+        self.assertEqual(_AssetHandler.requests, ['/logo.png', '/logo.png'])
+        self.assertEqual(self.assets.stats()['revalidated'], 1)
+
+    def test_rewrite_chunks(self):
+        html = ('<html><head><link rel="stylesheet" href="{0}/style.css"></head>'
+                '<body><img src="{0}/logo.png"><p>text</p></body></html>').format(self.url).encode('utf-8')
+        chunks = [html[i:i + 7] for i in range(0, len(html), 7)]
+        rewritten = list(self.assets.rewrite_chunks(chunks))
+        self.assertGreater(len(rewritten), 1)
+        self.assertEqual(b''.join(rewritten), self.assets.rewrite(html))
+        self.assertNotIn(self.url.encode('utf-8'), b''.join(rewritten))
+
+    def test_missing_asset_is_kept(self):
+        html = '<img src="{0}/missing.png">'.format(self.url)
+        _, data = self.render(html)
+        self.assertEqual(data.decode('utf-8'), html)
+        self.assertEqual(self.assets.stats()['errors'], 1)
+
+    def test_extension_from_content_type(self):
+        self.assertTrue(self.assets.fetch(self.url + '/logo').endswith('.png'))
+
+    def test_file_source(self):
+        argv, data = self.render('fixtures/example.html', 'file')
+        self.assertEqual(argv[-2:], ['-', '-'])
+        self.assertIn(os.path.abspath('fixtures'), argv)
+
+    def test_eviction(self):
+        assets = pdfkit.AssetCache(directory=self.directory, max_bytes=4)
+        first = assets.fetch(self.url + '/logo.png')
+        os.utime(first, (1, 1))
+        assets.fetch(self.url + '/fonts/a.woff')
+        self.assertFalse(os.path.exists(first))
+        assets.close()
+
+
+class TestPDFKitCapabilities(unittest.TestCase):
+    """Test validation of options against wkhtmltopdf help"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.binary = os.path.join(self.directory, 'wkhtmltopdf')
+        self.write_binary('0.12.6 (with patched qt)')
+        self.config = pdfkit.configuration(wkhtmltopdf=self.binary)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_binary(self, version):
+        with open(self.binary, 'w') as f:
+            f.write('#!%s\n'
+                    'import sys\n'
+                    'if sys.argv[1] == "--version":\n'
+                    '    print("wkhtmltopdf %s")\n'
+                    'elif sys.argv[1] == "--extended-help":\n'
+                    '    sys.stdout.write(open(%r).read())\n'
+                    'else:\n'
+                    '    sys.exit(3)\n' % (sys.executable, version,
+                                          os.path.join(TESTS_ROOT, 'fixtures', 'extended-help.txt')))
+        os.chmod(self.binary, 0o755)
+
+    def test_parse_help(self):
+        capabilities = self.config.capabilities()
+        self.assertEqual(capabilities.version, '0.12.6')
+        self.assertTrue(capabilities.patched_qt)
+        self.assertEqual(capabilities.options['--page-size'], ('--page-size', 1, 'global'))
+        self.assertIs(capabilities.options['-s'], capabilities.options['--page-size'])
+        self.assertEqual(capabilities.options['--custom-header'].arity, 2)
+        self.assertEqual(capabilities.options['--footer-line'], ('--footer-line', 0, 'page'))
+        self.assertEqual(capabilities.options['--toc-header-text'].scope, 'toc')
+        self.assertNotIn('--header-left=', capabilities.options)
+
+    def test_probed_once_per_binary(self):
+        capabilities = self.config.capabilities()
+        self.assertIs(self.config.capabilities(), capabilities)
+        # Shared by configurations of the same binary
+        config = pdfkit.configuration(wkhtmltopdf=self.binary)
+        self.assertIs(config.capabilities(), capabilities)
+
+        self.write_binary('0.12.5')
+        os.utime(self.binary, (1, 1))
+        self.assertEqual(self.config.capabilities().version, '0.12.5')
+
+    def test_valid_options(self):
+        r = pdfkit.PDFKit('html', 'string', configuration=self.config,
+                          options={'page-size': 'Letter', 'footer-line': None, 'grayscale': '',
+                                   'custom-header': [('Accept-Encoding', 'gzip')]},
+                          toc={'toc-header-text': 'Contents', 'footer-line': ''})
+        self.assertIn('--toc-header-text', r.command())
+
+    def test_invalid_options_fail_before_start(self):
+        cases = [
+            ({'page-sise': 'A4'}, None, 'Unknown option --page-sise'),
+            ({'page-size': None}, None, '--page-size takes 1 value, got 0'),
+            ({'grayscale': 'yes'}, None, '--grayscale takes 0 values, got 1'),
+            ({'custom-header': 'Accept'}, None, '--custom-header takes 2 values, got 1'),
+            ({'toc-header-text': 'Contents'}, None, 'can be used only for TOC'),
+            ({}, {'page-size': 'A4'}, 'global option'),
+        ]
+        for options, toc, message in cases:
+            r = pdfkit.PDFKit('html', 'string', configuration=self.config, options=options, toc=toc)
+            r._run = None  # would fail if wkhtmltopdf was started
+            with self.assertRaisesRegex(pdfkit.InvalidOption, message):
+                r.to_pdf()
+
+    def test_validation_disabled(self):
+        config = pdfkit.configuration(wkhtmltopdf=self.binary, validate_options=False)
+        self.assertIsNone(config.capabilities())
+        r = pdfkit.PDFKit('html', 'string', configuration=config, options={'page-sise': 'A4'})
+        self.assertIn('--page-sise', r.command())
+
+    def test_unpatched_qt(self):
+        help_text = '\nPage Options:\n      --print-media-type              Use print media\n' \
+                    '      --disable-smart-shrinking *     Disable shrinking\n'
+        capabilities = pdfkit.capabilities.parse('wkhtmltopdf 0.12.6', help_text)
+        self.assertFalse(capabilities.patched_qt)
+        self.assertIn('--print-media-type', capabilities.options)
+        self.assertNotIn('--disable-smart-shrinking', capabilities.options)
+        self.assertIsNone(pdfkit.capabilities.parse('', 'not a help'))
+
+
+class TestPDFKitScheduler(unittest.TestCase):
+    """Test RenderScheduler"""
+
+    def wait_queued(self, scheduler, count):
+        for _ in range(500):
+            stats = scheduler.stats()
+            if stats['queued'] + sum(c['blocked'] for c in stats['classes'].values()) >= count:
+                return
+            time.sleep(0.01)
+        self.fail('renders were not queued')
+
+    def render_in_threads(self, scheduler, jobs):
+        """Renders (html, priority) jobs while a slot is held, returns order of renders"""
+        order = []
+        config = pdfkit.configuration(
+            backend=pdfkit.LoopbackBackend(responder=lambda argv, data: (
+                order.append(data.decode('utf-8')) or pdfkit.backends.MINIMAL_PDF, b'', 0)),
+            scheduler=scheduler)
+        held = scheduler.acquire()
+        threads = []
+        for i, (html, priority) in enumerate(jobs):
+            thread = threading.Thread(target=pdfkit.from_string, args=(html,),
+                                      kwargs={'configuration': config, 'priority': priority})
+            thread.start()
+            threads.append(thread)
+            self.wait_queued(scheduler, i + 1)
+        scheduler.release(held)
+        for thread in threads:
+            thread.join()
+        return order
+
+    def test_priority_order(self):
+        scheduler = pdfkit.RenderScheduler(max_concurrent=1)
+        order = self.render_in_threads(scheduler, [('b1', 'bulk'), ('n', None), ('b2', 'bulk'),
+                                                   ('i', 'interactive')])
+        self.assertEqual(order, ['i', 'n', 'b1', 'b2'])
+
+        stats = scheduler.stats()
+        self.assertEqual(stats['running'], 0)
+        self.assertEqual(stats['classes']['bulk']['started'], 2)
+        self.assertGreater(stats['classes']['bulk']['wait_time_max'], 0)
+
+    def test_shortest_first(self):
+        scheduler = pdfkit.RenderScheduler(max_concurrent=1, shortest_first=True)
+        order = self.render_in_threads(scheduler, [('ccc', None), ('a', None), ('bb', None)])
+        self.assertEqual(order, ['a', 'bb', 'ccc'])
+
+    def test_full_queue_rejects(self):
+        scheduler = pdfkit.RenderScheduler(max_concurrent=1, max_queue={'bulk': 1},
+                                           reject={'bulk': True})
+        held = scheduler.acquire()
+        thread = threading.Thread(target=lambda: scheduler.release(scheduler.acquire('bulk')))
+        thread.start()
+        self.wait_queued(scheduler, 1)
+        with self.assertRaises(pdfkit.QueueFull):
+            scheduler.acquire('bulk')
+        scheduler.release(held)
+        thread.join()
+        self.assertEqual(scheduler.stats()['classes']['bulk']['rejected'], 1)
+
+    def test_full_queue_blocks(self):
+        scheduler = pdfkit.RenderScheduler(max_concurrent=1, max_queue=1)
+        order = self.render_in_threads(scheduler, [('a', 'bulk'), ('b', 'bulk')])
+        self.assertEqual(order, ['a', 'b'])
+
+    def test_async_cancel_leaves_queue(self):
+        scheduler = pdfkit.RenderScheduler(max_concurrent=1)
+        held = scheduler.acquire()
+
+        async def cancelled():
+            task = asyncio.ensure_future(scheduler.acquire_async())
+            await asyncio.sleep(0.01)
+            self.assertEqual(scheduler.stats()['queued'], 1)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(cancelled())
+        self.assertEqual(scheduler.stats()['queued'], 0)
+        scheduler.release(held)
+        self.assertEqual(scheduler.stats()['running'], 0)
+
+    def test_async_render_and_queue_time(self):
+        scheduler = pdfkit.RenderScheduler(max_concurrent=2)
+        config = pdfkit.configuration(backend='loopback', scheduler=scheduler)
+        stats = []
+        pdfkit.add_render_hook(stats.append)
+        try:
+            pdf = asyncio.run(pdfkit.from_string_async('html', configuration=config,
+                                                       priority='interactive'))
+        finally:
+            pdfkit.remove_render_hook(stats.append)
+        self.assertEqual(pdf, pdfkit.backends.MINIMAL_PDF)
+        self.assertIsNotNone(stats[0].queue_time)
+        self.assertEqual(scheduler.stats()['classes']['interactive']['started'], 1)
+        self.assertEqual(scheduler.stats()['running'], 0)
+
+    def test_adaptive_concurrency(self):
+        scheduler = pdfkit.RenderScheduler(
+            max_concurrent=4, controller=pdfkit.AIMDController(target_latency=0, cooldown=0,
+                                                               max_load=10 ** 6))
+        config = pdfkit.configuration(backend='loopback', scheduler=scheduler)
+        for _ in range(3):
+            pdfkit.from_string('html', configuration=config)
+        self.assertEqual(scheduler.stats()['max_concurrent'], 1)
+
+    def test_aimd_controller(self):
+        controller = pdfkit.AIMDController(max_concurrent=4, target_latency=1, memory_limit=100 * 2 ** 20,
+                                           max_load=10 ** 6, cooldown=60)
+        self.assertEqual(controller.update(2, latency=0.1), 2)
+        self.assertEqual(controller.update(2, latency=0.1), 3)
+        self.assertEqual([controller.update(4, latency=0.1) for _ in range(4)], [4] * 4)
+
+        # Halved on overload, at most once per cooldown
+        self.assertEqual(controller.update(4, latency=5), 2)
+        self.assertEqual(controller.update(2, latency=5), 2)
+
+        # Children of 40 MiB don't fit three times into 100 MiB
+        unit = 1 if sys.platform == 'darwin' else 1024
+        controller = pdfkit.AIMDController(max_concurrent=4, memory_limit=100 * 2 ** 20,
+                                           max_load=10 ** 6)
+        self.assertEqual(controller.update(3, latency=0.1, max_rss=40 * 2 ** 20 // unit), 1)
+        self.assertEqual([controller.update(2, latency=0.1) for _ in range(3)], [2] * 3)
+
+    def test_unknown_priority(self):
+        config = pdfkit.configuration(backend='loopback', scheduler=pdfkit.RenderScheduler())
+        with self.assertRaisesRegex(ValueError, 'Unknown priority'):
+            pdfkit.from_string('html', configuration=config, priority='urgent')
+
+
+class TestPDFKitXvfb(unittest.TestCase):
+    """Test pool of Xvfb displays with a stand-in server"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.binary = os.path.join(self.directory, 'Xvfb')
+        with open(self.binary, 'w') as f:
+            f.write('#!%s\n'
+                    'import os, socket, sys\n'
+                    'number = os.getpid()\n'
+                    'server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)\n'
+                    'server.bind(os.path.join(%r, "X%%d" %% number))\n'
+                    'server.listen(8)\n'
+                    'os.write(int(sys.argv[sys.argv.index("-displayfd") + 1]), b"%%d\\n" %% number)\n'
+                    'while True:\n'
+                    '    server.accept()[0].close()\n' % (sys.executable, self.directory))
+        os.chmod(self.binary, 0o755)
+        self.pool = pdfkit.XvfbPool(size=2, binary=self.binary)
+        self.pool.socket_dir = self.directory
+
+    def tearDown(self):
+        self.pool.close()
+        shutil.rmtree(self.directory)
+
+    def test_displays_are_shared(self):
+        first = self.pool.acquire()
+        second = self.pool.acquire()
+        self.assertNotEqual(first, second)
+        self.assertEqual(sorted(self.pool.displays()), sorted([first, second]))
+        self.pool.release(first)
+        self.assertEqual(self.pool.acquire(), first)
+
+    def test_render_gets_display(self):
+        class EnvironBackend(pdfkit.LoopbackBackend):
+            def start(self, argv, stdin=None, env=None, **kwargs):
+                self.env = env
+                return super(EnvironBackend, self).start(argv, stdin, env=env, **kwargs)
+
+        config = pdfkit.configuration(backend=EnvironBackend(), xvfb=self.pool,
+                                      environ={'LANG': 'C'})
+        pdfkit.from_string('html', configuration=config)
+        self.assertIn(config.backend.env['DISPLAY'], self.pool.displays())
+        self.assertEqual(config.backend.env['LANG'], 'C')
+        self.assertNotIn('DISPLAY', config.environ)
+
+    def test_async_render_acquires_in_executor(self):
+        threads = []
+        acquire = self.pool.acquire
+
+        def record():
+            threads.append(threading.current_thread())
+            return acquire()
+
+        self.pool.acquire = record
+        config = pdfkit.configuration(backend='loopback', xvfb=self.pool)
+        asyncio.run(pdfkit.from_string_async('html', configuration=config))
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.main_thread())
+        self.assertEqual([display.leases for display in self.pool._displays], [0, 0])
+
+    def test_dead_server_is_restarted(self):
+        display = self.pool.acquire()
+        self.pool.release(display)
+        process = self.pool._displays[0].process
+        process.kill()
+        process.wait()
+
+        self.assertNotIn(display, [self.pool.acquire(), self.pool.acquire()])
+        self.assertEqual(self.pool.restarts, 1)
+
+    def test_close_stops_servers(self):
+        self.pool.acquire()
+        processes = [display.process for display in self.pool._displays]
+        self.pool.close()
+        self.assertTrue(all(process.poll() is not None for process in processes))
+        with self.assertRaises(IOError):
+            self.pool.acquire()
+
+    def test_shared_pool(self):
+        first = pdfkit.configuration(backend='loopback', xvfb=True)
+        second = pdfkit.configuration(backend='loopback', xvfb=True)
+        self.assertIs(first.xvfb, second.xvfb)
+        first.close()
+        self.assertIs(pdfkit.xvfb.shared_pool(), first.xvfb)
+
+        first.xvfb.close()
+        self.assertIsNot(pdfkit.xvfb.shared_pool(), first.xvfb)
+
+    def test_missing_binary(self):
+        pool = pdfkit.XvfbPool(binary=os.path.join(self.directory, 'missing'))
+        with self.assertRaisesRegex(IOError, 'Failed to start Xvfb'):
+            pool.acquire()
+        pool.close()
+
+
+class TestPDFKitRenderTemplate(unittest.TestCase):
+    """Test RenderTemplate"""
+
+    def test_template_command(self):
+        options = {'page-size': 'Letter', 'margin-top': '0.75in'}
+        template = pdfkit.RenderTemplate(options=options, toc={'xsl-style-sheet': 'test.xsl'},
+                                         cover='test.html')
+        self.assertEqual(template.command('html'),
+                         pdfkit.PDFKit('html', 'string', options=options,
+                                       toc={'xsl-style-sheet': 'test.xsl'},
+                                       cover='test.html').command())
+        self.assertEqual(template.command('http://ya.ru', 'url', 'out.pdf')[-2:],
+                         ['http://ya.ru', 'out.pdf'])
+        self.assertIs(template.pdfkit('html')._options_argv, template.options_argv)
+
+    def test_template_with_meta_tags(self):
+        body = '<html><head><meta name="pdfkit-orientation" content="Landscape"/></head></html>'
+        template = pdfkit.RenderTemplate(options={'page-size': 'Letter'})
+        command = template.command(body)
+        self.assertEqual(command[command.index('--orientation') + 1], 'Landscape')
+        self.assertEqual(command[command.index('--page-size') + 1], 'Letter')
+
+    def test_template_validates_options_once(self):
+        with self.assertRaises(AssertionError):
+            pdfkit.RenderTemplate(options={'cookie': [('name', '')]})
+
+    def test_template_render(self):
+        template = pdfkit.RenderTemplate(options={'page-size': 'Letter'}, css='fixtures/example.css')
+        output = template.render('<html><head></head><body>Hai!</body></html>')
+        self.assertEqual(output[:4].decode('utf-8'), '%PDF')
+
+        results = list(template.render_many(['html', {'source': 'fixtures/example.html', 'type': 'file'}],
+                                            ordered=True))
+        self.assertEqual(len(results), 2)
+        for _, output in results:
+            self.assertEqual(output[:4].decode('utf-8'), '%PDF')
+
+    def test_command_does_not_change_options(self):
+        r = pdfkit.PDFKit('<html><head></head></html>', 'string', css='fixtures/example.css')
+        self.assertEqual(r.command(), r.command())
+        self.assertNotIn('--quiet', r.options)
+
+
+class TestPDFKitInstrumentation(unittest.TestCase):
+    """Test render hooks"""
+
+    def setUp(self):
+        self.records = []
+        pdfkit.add_render_hook(self.records.append)
+
+    def tearDown(self):
+        pdfkit.remove_render_hook(self.records.append)
+        if os.path.exists('out.pdf'):
+            os.remove('out.pdf')
+
+    def test_render_stats(self):
+        r = pdfkit.PDFKit('html', 'string')
+        pdf = r.to_pdf()
+        self.assertEqual(len(self.records), 1)
+
+        stats = self.records[0]
+        self.assertIs(r.render_stats, stats)
+        self.assertEqual(stats.argv, r.command())
+        self.assertEqual(stats.input_bytes, 4)
+        self.assertEqual(stats.output_bytes, len(pdf))
+        self.assertEqual(stats.exit_code, 0)
+        self.assertIsNone(stats.error)
+        for field in ('spawn_time', 'stdin_time', 'render_time', 'drain_time',
+                      'exit_time', 'validation_time'):
+            self.assertGreaterEqual(getattr(stats, field), 0)
+        self.assertGreaterEqual(stats.total_time, stats.render_time)
+        if hasattr(os, 'wait4'):
+            self.assertGreater(stats.max_rss, 0)
+            self.assertIsNotNone(stats.user_time)
+
+    def test_render_stats_output_path(self):
+        pdfkit.from_string('html', 'out.pdf')
+        self.assertEqual(self.records[0].output_bytes, os.path.getsize('out.pdf'))
+        self.assertIsNone(self.records[0].drain_time)
+
+    def test_render_stats_on_error(self):
+        with self.assertRaises(IOError):
+            pdfkit.from_url('clearlywrongurl.asdf')
+        self.assertIsInstance(self.records[0].error, IOError)
+        self.assertNotEqual(self.records[0].exit_code, 0)
+
+    def test_render_stats_async(self):
+        pdf = asyncio.run(pdfkit.from_string_async('html'))
+        self.assertEqual(self.records[0].output_bytes, len(pdf))
+        self.assertEqual(self.records[0].exit_code, 0)
+
+
+class TestPDFKitBackends(unittest.TestCase):
+    """Test pluggable rendering backends"""
+
+    def tearDown(self):
+        pdfkit.backends._backends.pop('test', None)
+        if os.path.exists('out.pdf'):
+            os.remove('out.pdf')
+
+    def test_loopback_backend(self):
+        config = pdfkit.configuration(backend='loopback')
+        pdf = pdfkit.from_string('html', options={'page-size': 'A4'}, configuration=config)
+        self.assertEqual(pdf, pdfkit.backends.MINIMAL_PDF)
+
+        argv, data = config.backend.calls[0]
+        self.assertEqual(argv[0], 'wkhtmltopdf')
+        self.assertIn('A4', argv)
+        self.assertEqual(data, b'html')
+
+    def test_loopback_backend_output_path(self):
+        config = pdfkit.configuration(backend=pdfkit.LoopbackBackend(pdf=b'%PDF-fake'))
+        self.assertTrue(pdfkit.from_string('html', 'out.pdf', configuration=config))
+        with open('out.pdf', 'rb') as f:
+            self.assertEqual(f.read(), b'%PDF-fake')
+
+    def test_subprocess_async_reads_input_in_executor(self):
+        threads = []
+
+        def chunks():
+            for chunk in (b'a', b'b'):
+                threads.append(threading.current_thread())
+                yield chunk
+
+        backend = pdfkit.SubprocessBackend()
+        argv = [sys.executable, '-c', 'import sys; sys.stdout.write(sys.stdin.read())']
+        stdout, _, exit_code = asyncio.run(backend.execute_async(argv, chunks()))
+        self.assertEqual((stdout, exit_code), (b'ab', 0))
+        self.assertNotIn(threading.main_thread(), threads)
+
+    def test_loopback_backend_probe(self):
+        backend = pdfkit.LoopbackBackend(pdf=b'wkhtmltopdf 0.12.6')
+        self.assertEqual(backend.execute(['wkhtmltopdf', '--extended-help']),
+                         (b'wkhtmltopdf 0.12.6', b'', 0))
+        self.assertFalse(os.path.exists('--extended-help'))
+
+    def test_loopback_backend_error(self):
+        config = pdfkit.configuration(backend=pdfkit.LoopbackBackend(stderr=b'Boom', exit_code=1))
+        with self.assertRaisesRegex(IOError, 'Boom'):
+            pdfkit.from_string('html', configuration=config)
+
+    @unittest.skipIf(sys.platform == 'win32', 'resource limits are POSIX only')
+    def test_subprocess_resource_limits(self):
+        directory = tempfile.mkdtemp()
+        try:
+            binary = os.path.join(directory, 'wkhtmltopdf')
+            with open(binary, 'w') as f:
+                f.write('#!%s\n'
+                        'import sys\n'
+                        'if sys.argv[1] in ("--version", "--extended-help"):\n'
+                        '    sys.exit(0)\n'
+                        'if "--cpu" in sys.argv:\n'
+                        '    while True:\n'
+                        '        pass\n'
+                        'data = bytearray(1024 * 1024 * 1024)\n' % sys.executable)
+            os.chmod(binary, 0o755)
+
+            backend = pdfkit.SubprocessBackend(memory_limit=512 * 2 ** 20, cpu_limit=1)
+            config = pdfkit.configuration(wkhtmltopdf=binary, backend=backend)
+            with self.assertRaisesRegex(IOError, 'MemoryError'):
+                pdfkit.from_string('html', configuration=config, options={'quiet': ''})
+            with self.assertRaisesRegex(IOError, 'CPU time limit'):
+                pdfkit.from_string('html', configuration=config, options={'cpu': ''})
+        finally:
+            shutil.rmtree(directory)
+
+    def test_registered_backend(self):
+        class UpperBackend(pdfkit.LoopbackBackend):
+            def respond(self, argv, data):
+                return b'%PDF ' + data.upper(), b'', 0
+
+        pdfkit.register_backend('test', UpperBackend)
+        config = pdfkit.configuration(backend='test')
+        self.assertIsInstance(config.backend, UpperBackend)
+        self.assertEqual(pdfkit.from_string('html', configuration=config), b'%PDF HTML')
+        self.assertEqual(
+            asyncio.run(pdfkit.from_string_async('html', configuration=config)), b'%PDF HTML')
+
+    def test_libwkhtmltox_translate(self):
+        r = pdfkit.PDFKit('html', 'string', options={'page-size': 'A4', 'no-background': None,
+                                                     'cookie': [('a', '1'), ('b', '2')]},
+                          toc={'toc-header-text': 'Contents'}, cover='cover.html', cover_first=True)
+        global_settings, objects, output = pdfkit.wkhtmltox.translate(r.command('out.pdf'))
+        self.assertEqual(global_settings, [('size.pageSize', 'A4')])
+        self.assertEqual(output, 'out.pdf')
+
+        cover, toc, page = objects
+        self.assertEqual(cover[0][0], ('page', 'cover.html'))
+        self.assertIn(('includeInOutline', 'false'), cover[0])
+        self.assertIn(('isTableOfContent', 'true'), toc[0])
+        self.assertIn(('toc.captionText', 'Contents'), toc[0])
+        self.assertEqual(page, ([('web.background', 'false'),
+                                 ('load.cookies.append', ''),
+                                 ('load.cookies[0].first', 'a'),
+                                 ('load.cookies[0].second', '1'),
+                                 ('load.cookies.append', ''),
+                                 ('load.cookies[1].first', 'b'),
+                                 ('load.cookies[1].second', '2')], True))
+
+        r = pdfkit.PDFKit('html', 'string', options={'lowquality': None})
+        with self.assertRaises(pdfkit.wkhtmltox.UnsupportedCommand):
+            pdfkit.wkhtmltox.translate(r.command())
+
+    def test_libwkhtmltox_fallback(self):
+        backend = pdfkit.wkhtmltox.LibwkhtmltoxBackend(library='/nonexistent/libwkhtmltox.so')
+        config = pdfkit.configuration(backend=backend)
+        pdf = pdfkit.from_string('html', configuration=config)
+        self.assertEqual(pdf[:4].decode('utf-8'), '%PDF')
+        self.assertIsNone(backend.library)
+        self.assertIsInstance(backend.error, OSError)
+
+    def test_libwkhtmltox_dead_idle_worker(self):
+        workers = []
+        # Indexes of workers which died while idle
+        dead = {0}
+
+        class Conn(object):
+            def __init__(self, index):
+                self.index = index
+
+            def send(self, job):
+                if self.index in dead:
+                    raise BrokenPipeError('worker exited')
+
+            def poll(self, timeout):
+                return True
+
+            def recv(self):
+                return b'%PDF fake', b'', 0
+
+        class Worker(object):
+            def __init__(self, context, library, max_jobs):
+                self.conn = Conn(len(workers))
+                self.jobs_left = max_jobs
+                self.killed = False
+                workers.append(self)
+
+            def wait_ready(self):
+                pass
+
+            def stop(self, kill=False):
+                self.killed = kill
+
+        backend = pdfkit.wkhtmltox.LibwkhtmltoxBackend(library='libwkhtmltox', workers=1)
+        worker_class = pdfkit.wkhtmltox._Worker
+        pdfkit.wkhtmltox._Worker = Worker
+        try:
+            stdout, stderr, exit_code = backend.execute(['wkhtmltopdf', '-', '-'], [b'html'])
+            self.assertEqual((stdout, exit_code), (b'%PDF fake', 0))
+            self.assertEqual([worker.killed for worker in workers], [True, False])
+
+            # Fresh worker fails too
+            dead.update([1, 2])
+            with self.assertRaises(IOError):
+                backend.execute(['wkhtmltopdf', '-', '-'], [b'html'])
+            self.assertEqual(len(workers), 4)
+        finally:
+            pdfkit.wkhtmltox._Worker = worker_class
+        # Slots of killed workers were released
+        self.assertTrue(backend._slots.acquire(blocking=False))
+
+    def test_abstract_backend(self):
+        class NoStart(pdfkit.Backend):
+            pass
+
+        with self.assertRaises(TypeError):
+            NoStart()
+        with self.assertRaises(TypeError):
+            pdfkit.backends.Execution()
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            pdfkit.configuration(backend='nonexistent')
+
+
+class TestPDFKitParallel(unittest.TestCase):
+    """Test parallel rendering of multi-input jobs"""
+
+    def setUp(self):
+        os.environ['FAKE_WKHTMLTOPDF_PAGES'] = '2'
+        self.config = pdfkit.configuration(
+            wkhtmltopdf=os.path.join(TESTS_ROOT, '..', 'benchmarks', 'fake_wkhtmltopdf.py'))
+        self.urls = ['http://example.com/%d' % i for i in range(5)]
+
+    def tearDown(self):
+        os.environ.pop('FAKE_WKHTMLTOPDF_PAGES', None)
+        if os.path.exists('out.pdf'):
+            os.remove('out.pdf')
+
+    def page_labels(self, data):
+        doc = pdfkit.pdf.Document(data)
+        return [re.search(rb'\((.*?)\) Tj', doc.get(doc.get(ref)['Contents']).data).group(1).decode()
+                for ref in doc.page_refs()]
+
+    def test_split(self):
+        self.assertEqual(pdfkit.parallel.split([1, 2, 3, 4, 5], 3), [[1, 2], [3, 4], [5]])
+        self.assertEqual(pdfkit.parallel.split([1, 2], 4), [[1], [2]])
+
+    def test_merge(self):
+        a = pdfkit.from_url('http://a', configuration=self.config)
+        b = pdfkit.from_url('http://b', configuration=self.config)
+        merged = pdfkit.pdf.merge([a, b])
+        self.assertEqual(pdfkit.pdf.page_count(merged), 4)
+        self.assertEqual(self.page_labels(merged),
+                         ['Page 1 http://a', 'Page 2 http://a', 'Page 1 http://b', 'Page 2 http://b'])
+
+    def test_parallel_order(self):
+        pdf = pdfkit.from_url(self.urls, configuration=self.config, parallel=3)
+        # Fake binary labels pages with the last input of its command
+        self.assertEqual(self.page_labels(pdf), [
+            'Page 1 http://example.com/1', 'Page 2 http://example.com/1',
+            'Page 1 http://example.com/3', 'Page 2 http://example.com/3',
+            'Page 1 http://example.com/4', 'Page 2 http://example.com/4'])
+
+        r = pdfkit.PDFKit(self.urls, 'url', configuration=self.config, parallel=3)
+        self.assertEqual(self.page_labels(asyncio.run(r.to_pdf_async())), self.page_labels(pdf))
+
+        self.assertTrue(pdfkit.from_url(self.urls, 'out.pdf', configuration=self.config, parallel=3))
+        with open('out.pdf', 'rb') as f:
+            self.assertEqual(f.read(), pdf)
+
+    def test_parallel_cover_and_toc(self):
+        for cover_first, first in ((True, 'http://cover'), (False, '-')):
+            pdf = pdfkit.from_url(self.urls, configuration=self.config, parallel=2,
+                                  cover='http://cover', toc={'toc-header-text': 'Contents'},
+                                  cover_first=cover_first)
+            labels = self.page_labels(pdf)
+            self.assertEqual(len(labels), 8)
+            self.assertEqual(labels[0], 'Page 1 ' + first)
+            self.assertEqual(labels[-1], 'Page 2 http://example.com/4')
+
+    def test_parallel_toc_page_numbers(self):
+        tocs = []
+
+        def respond(argv, data):
+            if '--dump-outline' in argv:
+                with open(argv[argv.index('--dump-outline') + 1], 'w') as f:
+                    f.write('<outline><item title="" page="0">'
+                            '<item title="%s" page="2"/></item></outline>' % argv[-2])
+            if data:
+                tocs.append(data.decode('utf-8'))
+            return pdfkit.pdf.merge([pdfkit.backends.MINIMAL_PDF] * 3), b'', 0
+
+        config = pdfkit.configuration(backend=pdfkit.LoopbackBackend(responder=respond))
+        pdf = pdfkit.from_url(self.urls[:3], configuration=config, parallel=3,
+                              toc={'toc-header-text': 'Contents'})
+        self.assertEqual(pdfkit.pdf.page_count(pdf), 12)
+        # 3 TOC pages, then 3 pages per input, each heading on second page
+        self.assertIn('<h1>Contents</h1>', tocs[-1])
+        self.assertEqual(re.findall(r'(http://example.com/\d)<span>(\d+)', tocs[-1]),
+                         [('http://example.com/0', '5'), ('http://example.com/1', '8'),
+                          ('http://example.com/2', '11')])
+
+
+    def test_parallel_renders_with_page_numbers(self):
+        commands = []
+
+        def respond(argv, data):
+            commands.append(argv)
+            return pdfkit.backends.MINIMAL_PDF, b'', 0
+
+        config = pdfkit.configuration(backend=pdfkit.LoopbackBackend(responder=respond))
+        # Footer without page numbers doesn't need offsets
+        pdfkit.from_url(self.urls, configuration=config, parallel=3, options={'footer-line': None})
+        self.assertEqual(len(commands), 3)
+        self.assertFalse(any('--page-offset' in argv for argv in commands))
+
+        # First chunk is rendered once, with its final offset
+        commands = []
+        pdfkit.from_url(self.urls, configuration=config, parallel=3, options={'footer-right': '[page]'})
+        self.assertEqual([argv[argv.index('--page-offset') + 1] for argv in commands
+                          if '--page-offset' in argv], ['0', '1', '2'])
+        self.assertEqual(len(commands), 5)
+
+
+class TestPDFKitSections(unittest.TestCase):
+    """Test incremental rendering of sectioned documents"""
+
+    def setUp(self):
+        self.commands = []
+
+        def respond(argv, data):
+            self.commands.append((argv, data.decode('utf-8')))
+            title = re.search(r'<h1>(.*?)</h1>', data.decode('utf-8'))
+            if '--dump-outline' in argv:
+                with open(argv[argv.index('--dump-outline') + 1], 'w') as f:
+                    f.write('<outline><item title="" page="0">'
+                            '<item title="%s" page="1"/></item></outline>' % title.group(1))
+            # A page per paragraph
+            pages = max(data.count(b'<p>'), 1)
+            return pdfkit.pdf.merge([pdfkit.backends.MINIMAL_PDF] * pages), b'', 0
+
+        self.config = pdfkit.configuration(backend=pdfkit.LoopbackBackend(responder=respond))
+        self.sections = ['<h1>One</h1><p>a', '<h1>Two</h1><p>b<p>c', '<h1>Three</h1><p>d']
+
+    def rendered_sections(self):
+        return [re.search(r'<h1>(.*?)</h1>', data).group(1) for argv, data in self.commands
+                if '<h1>' in data]
+
+    def test_only_changed_sections_rendered(self):
+        doc = pdfkit.SectionedDocument(self.sections, configuration=self.config, max_workers=2)
+        pdf = doc.to_pdf()
+        self.assertEqual(pdfkit.pdf.page_count(pdf), 4)
+        self.assertEqual(doc.rendered, [0, 1, 2])
+
+        self.commands = []
+        self.assertEqual(doc.to_pdf(), pdf)
+        self.assertEqual(self.commands, [])
+        self.assertEqual(doc.rendered, [])
+
+        doc.sections[1] = '<h1>Two</h1><p>changed'
+        self.assertEqual(pdfkit.pdf.page_count(doc.to_pdf()), 3)
+        self.assertEqual(self.rendered_sections(), ['Two'])
+        self.assertEqual(doc.rendered, [1])
+
+    def test_options_change_invalidates_sections(self):
+        cache = pdfkit.RenderCache()
+        pdfkit.SectionedDocument(self.sections, configuration=self.config, cache=cache).to_pdf()
+        doc = pdfkit.SectionedDocument(self.sections, configuration=self.config, cache=cache,
+                                       options={'page-size': 'Letter'})
+        doc.to_pdf()
+        self.assertEqual(doc.rendered, [0, 1, 2])
+
+    def test_toc_page_numbers(self):
+        doc = pdfkit.SectionedDocument(self.sections, configuration=self.config,
+                                       toc={'toc-header-text': 'Contents'})
+        self.assertEqual(pdfkit.pdf.page_count(doc.to_pdf()), 5)
+        toc = self.commands[-1][1]
+        self.assertIn('<h1>Contents</h1>', toc)
+        self.assertEqual(re.findall(r'<div>(\w+)<span>(\d+)', toc),
+                         [('One', '2'), ('Two', '3'), ('Three', '5')])
+
+        # Outlines are cached with partial PDFs
+        self.commands = []
+        doc.sections[0] = '<h1>One</h1><p>a<p>b'
+        doc.to_pdf()
+        self.assertEqual(doc.rendered, [0])
+        self.assertEqual(re.findall(r'<div>(\w+)<span>(\d+)', self.commands[-1][1]),
+                         [('One', '2'), ('Two', '4'), ('Three', '6')])
+
+    def test_page_offset_with_footer(self):
+        doc = pdfkit.SectionedDocument(self.sections, configuration=self.config,
+                                       options={'footer-right': '[page]'})
+        doc.to_pdf()
+        offsets = [argv[argv.index('--page-offset') + 1] for argv, _ in self.commands
+                   if '--page-offset' in argv]
+        self.assertEqual(offsets, ['0', '1', '3'])
+
+        # Page count of the last section changed, earlier sections keep their numbers
+        self.commands = []
+        doc.sections[2] = '<h1>Three</h1><p>d<p>e'
+        doc.to_pdf()
+        self.assertEqual(doc.rendered, [2])
+
+        # First section got longer, following sections are numbered again
+        self.commands = []
+        doc.sections[0] = '<h1>One</h1><p>a<p>z'
+        doc.to_pdf()
+        self.assertEqual(doc.rendered, [0, 1, 2])
+
+    def test_footer_without_page_numbers(self):
+        doc = pdfkit.SectionedDocument(self.sections, configuration=self.config,
+                                       options={'footer-line': None})
+        doc.to_pdf()
+        self.assertEqual(len(self.commands), 3)
+        self.assertFalse(any('--page-offset' in argv for argv, _ in self.commands))
+
+    def test_unsupported_options(self):
+        doc = pdfkit.SectionedDocument(self.sections, configuration=self.config,
+                                       options={'dump-outline': 'out.xml'})
+        with self.assertRaisesRegex(ValueError, 'dump-outline'):
+            doc.to_pdf()
+        with self.assertRaises(ValueError):
+            pdfkit.SectionedDocument(self.sections, 'url', configuration=self.config)
+
+
+class TestPDFKitImage(unittest.TestCase):
+    """Test image previews rendered with wkhtmltoimage"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.pdf_binary = os.path.join(self.directory, 'wkhtmltopdf')
+        self.image_binary = os.path.join(self.directory, 'wkhtmltoimage')
+        self.runs = os.path.join(self.directory, 'runs')
+        for path in (self.pdf_binary, self.image_binary):
+            with open(path, 'w') as f:
+                f.write('#!%s\n'
+                        'import sys\n'
+                        'if sys.argv[1] in ("--version", "--extended-help"):\n'
+                        '    sys.exit(0)\n'
+                        'open(%r, "a").write("run\\n")\n'
+                        'if "-" in sys.argv[1:-1]:\n'
+                        '    sys.stdin.buffer.read()\n'
+                        'out = b"%%PDF " if sys.argv[0].endswith("wkhtmltopdf") else b"\\x89PNG\\r\\n\\x1a\\n"\n'
+                        'out += " ".join(sys.argv[1:]).encode()\n'
+                        'if sys.argv[-1] == "-":\n'
+                        '    sys.stdout.buffer.write(out)\n'
+                        'else:\n'
+                        '    open(sys.argv[-1], "wb").write(out)\n' % (sys.executable, self.runs))
+            os.chmod(path, 0o755)
+        self.config = pdfkit.configuration(wkhtmltopdf=self.pdf_binary)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_binary_next_to_wkhtmltopdf(self):
+        self.assertEqual(self.config.image_binary(), self.image_binary)
+
+        config = pdfkit.configuration(wkhtmltopdf=self.pdf_binary, wkhtmltoimage=self.pdf_binary)
+        self.assertEqual(config.image_binary(), self.pdf_binary)
+
+        os.remove(self.image_binary)
+        config = pdfkit.configuration(wkhtmltopdf=self.pdf_binary,
+                                      wkhtmltoimage=self.image_binary)
+        with self.assertRaisesRegex(IOError, 'No wkhtmltoimage executable found'):
+            config.image_binary()
+
+    def test_from_string_image(self):
+        image = pdfkit.from_string_image('<p>html</p>', width=320, quality=50,
+                                         crop=(0, 0, 320, 240), configuration=self.config)
+        self.assertTrue(image.startswith(b'\x89PNG'))
+        self.assertIn(b'--format png --width 320 --quality 50 '
+                      b'--crop-x 0 --crop-y 0 --crop-w 320 --crop-h 240 --quiet - -', image)
+
+        output = os.path.join(self.directory, 'preview.png')
+        self.assertTrue(pdfkit.from_url_image('http://example.com', output, format='PNG',
+                                              configuration=self.config))
+        with open(output, 'rb') as f:
+            self.assertIn(b'--format png --quiet http://example.com', f.read())
+
+    def test_wrong_output_format(self):
+        # Output of the fake binary is PNG
+        output = os.path.join(self.directory, 'preview.jpg')
+        with self.assertRaisesRegex(IOError, 'not a JPG image'):
+            pdfkit.from_url_image('http://example.com', output, format='jpg',
+                                  configuration=self.config)
+        with self.assertRaisesRegex(ValueError, 'Unknown image format'):
+            pdfkit.from_url_image('http://example.com', format='gif', configuration=self.config)
+
+    def test_wrong_output_in_memory(self):
+        config = pdfkit.configuration(backend=pdfkit.LoopbackBackend(pdf=b'<html>error</html>'))
+        with self.assertRaisesRegex(IOError, 'not a PNG image'):
+            pdfkit.from_string_image('html', configuration=config)
+        with self.assertRaisesRegex(IOError, 'not a PNG image'):
+            asyncio.run(pdfkit.ImageKit('html', 'string', configuration=config).to_image_async())
+        with self.assertRaisesRegex(IOError, 'not a PNG image'):
+            pdfkit.from_string_image('html', cache=pdfkit.RenderCache(), configuration=config)
+
+    def test_meta_tags_ignored(self):
+        kit = pdfkit.ImageKit('<html><head><meta name="pdfkit-page-size" content="Legal"/>'
+                              '</head></html>', 'string', configuration=self.config)
+        self.assertEqual(kit.command(), [self.image_binary, '--format', 'png', '--quiet', '-', '-'])
+
+    def test_image_cache(self):
+        cache = pdfkit.RenderCache()
+        first = pdfkit.from_string_image('html', cache=cache, configuration=self.config)
+        self.assertEqual(pdfkit.from_string_image('html', cache=cache, configuration=self.config), first)
+        # Cached PDF of the same input is a different entry
+        pdfkit.from_string('html', cache=cache, configuration=self.config)
+        with open(self.runs) as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+    def test_loopback_backend(self):
+        commands = []
+        config = pdfkit.configuration(backend=pdfkit.LoopbackBackend(
+            responder=lambda argv, data: commands.append(argv) or (b'\x89PNG', b'', 0)))
+        self.assertEqual(pdfkit.from_string_image('html', configuration=config), b'\x89PNG')
+        self.assertEqual(commands[0][0], 'wkhtmltoimage')
+
+    def test_parse_image_help(self):
+        capabilities = pdfkit.capabilities.parse(
+            'wkhtmltoimage 0.12.6 (with patched qt)',
+            'General Options:\n'
+            '      --crop-h <int>                  Set height for cropping\n'
+            '  -f, --format <format>               Output file format\n')
+        self.assertEqual(capabilities.version, '0.12.6')
+        self.assertEqual(capabilities.options['-f'], ('--format', 1, 'global'))
+        self.assertIsNone(capabilities.check('--crop-h', '10'))
+
+
+class TestPDFKitOptimizer(unittest.TestCase):
+    """Test size optimization of rendered PDFs"""
+
+    def setUp(self):
+        os.environ['FAKE_WKHTMLTOPDF_PAGES'] = '2'
+        os.environ['FAKE_WKHTMLTOPDF_SIZE'] = '20000'
+        self.config = pdfkit.configuration(
+            wkhtmltopdf=os.path.join(TESTS_ROOT, '..', 'benchmarks', 'fake_wkhtmltopdf.py'))
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        os.environ.pop('FAKE_WKHTMLTOPDF_PAGES', None)
+        os.environ.pop('FAKE_WKHTMLTOPDF_SIZE', None)
+        shutil.rmtree(self.directory)
+
+    def page_labels(self, data):
+        doc = pdfkit.pdf.Document(data)
+        return [re.search(rb'\((.*?)\) Tj', pdfkit.pdf.decode(doc.get(doc.get(ref)['Contents']))).group(1)
+                for ref in doc.page_refs()]
+
+    def test_merges_duplicates(self):
+        part = pdfkit.from_url('http://a', configuration=self.config)
+        merged = pdfkit.pdf.merge([part, part, part])
+        for mode in ('fast', 'size'):
+            result = pdfkit.optimize_pdf(merged, mode)
+            self.assertEqual(result.original_size, len(merged))
+            self.assertEqual(result.size, len(result.data))
+            self.assertGreater(result.bytes_saved, len(merged) // 2)
+            # Font and content streams of the second and third part
+            self.assertEqual(result.objects_merged, 6)
+            self.assertEqual(self.page_labels(result.data), self.page_labels(merged))
+
+    def test_object_streams(self):
+        merged = pdfkit.pdf.merge([pdfkit.from_url('http://%s' % name, configuration=self.config)
+                                   for name in 'ab'])
+        data = pdfkit.optimize_pdf(merged, 'size').data
+        self.assertTrue(data.startswith(b'%PDF-1.5'))
+        self.assertIn(b'/ObjStm', data)
+        self.assertNotIn(b'\nxref\n', data)
+        self.assertEqual(self.page_labels(data), self.page_labels(merged))
+        # Optimized output can be merged and optimized again
+        again = pdfkit.optimize_pdf(pdfkit.pdf.merge([data, data]), 'fast', object_streams=False)
+        self.assertEqual(pdfkit.pdf.page_count(again.data), 8)
+        self.assertIn(b'\nxref\n', again.data)
+
+    def test_drops_unused_objects(self):
+        writer = pdfkit.pdf.Writer()
+        catalog = writer.reserve()
+        pages = writer.reserve()
+        writer.add(pdfkit.pdf.Stream({}, b'unused ' * 100))
+        page = writer.add({'Type': pdfkit.pdf.Name('Page'), 'Parent': pages})
+        writer.set(pages, {'Type': pdfkit.pdf.Name('Pages'), 'Kids': [page], 'Count': 1})
+        writer.set(catalog, {'Type': pdfkit.pdf.Name('Catalog'), 'Pages': pages})
+        data = writer.write(catalog)
+
+        result = pdfkit.optimize_pdf(data)
+        self.assertEqual(result.objects_removed, 1)
+        self.assertNotIn(b'unused', result.data)
+        self.assertEqual(pdfkit.pdf.page_count(result.data), 1)
+
+    def test_compresses_streams(self):
+        writer = pdfkit.pdf.Writer()
+        catalog = writer.reserve()
+        pages = writer.reserve()
+        contents = writer.add(pdfkit.pdf.Stream({}, b'BT (text) Tj ET\n' * 100))
+        page = writer.add({'Type': pdfkit.pdf.Name('Page'), 'Parent': pages, 'Contents': contents})
+        writer.set(pages, {'Type': pdfkit.pdf.Name('Pages'), 'Kids': [page], 'Count': 1})
+        writer.set(catalog, {'Type': pdfkit.pdf.Name('Catalog'), 'Pages': pages})
+
+        data = pdfkit.optimize_pdf(writer.write(catalog)).data
+        doc = pdfkit.pdf.Document(data)
+        stream = doc.get(doc.get(doc.page_refs()[0])['Contents'])
+        self.assertEqual(stream.dictionary['Filter'], 'FlateDecode')
+        self.assertEqual(pdfkit.pdf.decode(stream), b'BT (text) Tj ET\n' * 100)
+
+    def test_decode_predictor(self):
+        # Rows of 2 bytes with PNG Up predictor, as in cross-reference streams
+        stream = pdfkit.pdf.Stream({'Filter': pdfkit.pdf.Name('FlateDecode'),
+                                    'DecodeParms': {'Predictor': 12, 'Columns': 2}},
+                                   zlib.compress(b'\x02\x01\x02\x02\x01\x01'))
+        self.assertEqual(pdfkit.pdf.decode(stream), b'\x01\x02\x02\x03')
+
+    def test_optimize_file(self):
+        path = os.path.join(self.directory, 'in.pdf')
+        pdfkit.from_url(['http://a', 'http://a'], path, configuration=self.config, parallel=2)
+        size = os.path.getsize(path)
+
+        output = os.path.join(self.directory, 'out.pdf')
+        result = pdfkit.optimize_file(path, output, mode='size')
+        self.assertIsNone(result.data)
+        self.assertEqual(os.path.getsize(output), result.size)
+        self.assertEqual(os.path.getsize(path), size)
+
+        result = pdfkit.optimize_file(path)
+        self.assertEqual(os.path.getsize(path), result.size)
+        self.assertLess(result.size, size)
+        # Temporary file replaced the input
+        self.assertEqual(sorted(os.listdir(self.directory)), ['in.pdf', 'out.pdf'])
+
+    @unittest.skipIf(os.name == 'nt', 'POSIX permissions and symlinks')
+    def test_optimize_file_keeps_mode_and_symlink(self):
+        path = os.path.join(self.directory, 'in.pdf')
+        pdfkit.from_url(['http://a', 'http://a'], path, configuration=self.config, parallel=2)
+        os.chmod(path, 0o640)
+        link = os.path.join(self.directory, 'link.pdf')
+        os.symlink(path, link)
+
+        pdfkit.optimize_file(link)
+        self.assertTrue(os.path.islink(link))
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o640)
+
+        # New outputs get the mode of a regular new file, not mkstemp's 0600
+        output = os.path.join(self.directory, 'out.pdf')
+        pdfkit.optimize_file(path, output)
+        umask = os.umask(0)
+        os.umask(umask)
+        self.assertEqual(stat.S_IMODE(os.stat(output).st_mode), 0o666 & ~umask)
+
+    def test_async_api_forwards_options(self):
+        urls = ['http://a', 'http://a']
+        pdf = pdfkit.from_url(urls, configuration=self.config, parallel=2, optimize='size')
+        self.assertEqual(
+            asyncio.run(pdfkit.from_url_async(urls, configuration=self.config, parallel=2,
+                                              optimize='size')),
+            pdf)
+
+    def test_optimize_option(self):
+        plain = pdfkit.from_url(['http://a', 'http://a'], configuration=self.config, parallel=2)
+        kit = pdfkit.PDFKit(['http://a', 'http://a'], 'url', configuration=self.config,
+                            parallel=2, optimize='size')
+        pdf = kit.to_pdf()
+        self.assertLess(len(pdf), len(plain))
+        self.assertEqual(kit.optimize_stats.size, len(pdf))
+        self.assertIsNone(kit.optimize_stats.data)
+
+        path = os.path.join(self.directory, 'out.pdf')
+        self.assertTrue(pdfkit.from_string('html', path, configuration=self.config, optimize=True))
+        self.assertEqual(pdfkit.pdf.page_count(open(path, 'rb').read()), 2)
+
+        kit = pdfkit.PDFKit('html', 'string', configuration=self.config, optimize='fast')
+        self.assertEqual(b''.join(kit.iter_pdf(chunk_size=100)), kit.to_pdf())
+        self.assertEqual(asyncio.run(kit.to_pdf_async()), kit.to_pdf())
+
+        with self.assertRaisesRegex(ValueError, 'Unknown optimize mode'):
+            pdfkit.from_string('html', configuration=self.config, optimize='best')
+
+
+class TestPDFKitOutputSinks(unittest.TestCase):
+    """Test rendering into open files, sockets and file descriptors"""
+
+    def setUp(self):
+        self.config = pdfkit.configuration(
+            wkhtmltopdf=os.path.join(TESTS_ROOT, '..', 'benchmarks', 'fake_wkhtmltopdf.py'))
+
+    def test_file_object_sink(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(b'prefix')
+            self.assertTrue(pdfkit.from_string('html', f, configuration=self.config))
+            f.seek(0)
+            data = f.read()
+        self.assertTrue(data.startswith(b'prefix%PDF'))
+        self.assertTrue(data.rstrip().endswith(b'%%EOF'))
+
+    def test_fd_sink(self):
+        read_fd, write_fd = os.pipe()
+        try:
+            self.assertTrue(pdfkit.from_string('html', write_fd, configuration=self.config))
+        finally:
+            os.close(write_fd)
+        with os.fdopen(read_fd, 'rb') as f:
+            self.assertEqual(f.read(4), b'%PDF')
+
+    def test_fd_sink_async(self):
+        with tempfile.TemporaryFile() as f:
+            self.assertTrue(asyncio.run(
+                pdfkit.from_string_async('html', f.fileno(), configuration=self.config)))
+            f.seek(0)
+            self.assertEqual(f.read(4), b'%PDF')
+
+    def test_fd_sink_not_pdf(self):
+        config = pdfkit.configuration(backend=pdfkit.LoopbackBackend(pdf=b'<html>'))
+        with tempfile.TemporaryFile() as f:
+            with self.assertRaisesRegex(IOError, 'Command failed'):
+                pdfkit.from_string('html', f, configuration=config)
+
+    def test_bytes_io_sink(self):
+        config = pdfkit.configuration(backend='loopback')
+        output = io.BytesIO()
+        self.assertTrue(pdfkit.from_string('html', output, configuration=config))
+        self.assertEqual(output.getvalue(), pdfkit.backends.MINIMAL_PDF)
+
+    def test_check_eof(self):
+        truncated = pdfkit.backends.MINIMAL_PDF[:-7]
+        config = pdfkit.configuration(backend=pdfkit.LoopbackBackend(pdf=truncated))
+        self.assertEqual(pdfkit.from_string('html', configuration=config), truncated)
+
+        config = pdfkit.configuration(backend=pdfkit.LoopbackBackend(pdf=truncated),
+                                      check_eof=True)
+        with self.assertRaisesRegex(IOError, 'EOF'):
+            pdfkit.from_string('html', configuration=config)
+        with tempfile.TemporaryFile() as f:
+            with self.assertRaisesRegex(IOError, 'EOF'):
+                pdfkit.from_string('html', f, configuration=config)
+
+    def test_empty_output_raises(self):
+        # Successful exit without output used to return b''
+        config = pdfkit.configuration(backend=pdfkit.LoopbackBackend(pdf=b''))
+        with self.assertRaisesRegex(IOError, 'Command failed'):
+            pdfkit.from_string('html', configuration=config)
+        with self.assertRaisesRegex(IOError, 'Command failed'):
+            asyncio.run(pdfkit.from_string_async('html', configuration=config))
+
+
+class TestFakeWkhtmltopdf(unittest.TestCase):
+    """Test stand-in binary used by benchmarks"""
+
+    def tearDown(self):
+        for key in ('FAKE_WKHTMLTOPDF_SIZE', 'FAKE_WKHTMLTOPDF_PAGES', 'FAKE_WKHTMLTOPDF_EXIT_CODE'):
+            os.environ.pop(key, None)
+
+    def configuration(self):
+        # Configuration copies the environment, so it is made after it is set
+        return pdfkit.configuration(
+            wkhtmltopdf=os.path.join(TESTS_ROOT, '..', 'benchmarks', 'fake_wkhtmltopdf.py'))
+
+    def test_fake_pdf_generation(self):
+        os.environ['FAKE_WKHTMLTOPDF_SIZE'] = '100000'
+        os.environ['FAKE_WKHTMLTOPDF_PAGES'] = '3'
+        pdf = pdfkit.from_string('html', configuration=self.configuration())
+        self.assertEqual(pdf[:4].decode('utf-8'), '%PDF')
+        self.assertTrue(pdf.rstrip().endswith(b'%%EOF'))
+        self.assertAlmostEqual(len(pdf), 100000, delta=1000)
+        self.assertIn(b'/Count 3', pdf)
+
+    def test_fake_error(self):
+        os.environ['FAKE_WKHTMLTOPDF_EXIT_CODE'] = '1'
+        with self.assertRaises(IOError):
+            pdfkit.from_string('html', configuration=self.configuration())
+
+
 if __name__ == "__main__":
     unittest.main()